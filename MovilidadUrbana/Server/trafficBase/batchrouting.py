@@ -0,0 +1,97 @@
+from types import MappingProxyType
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+class BatchRouter:
+    """
+    Solves all the route requests of a step together on a sparse adjacency matrix.
+    Requests are grouped by destination, and every destination gets one search from it
+    on the reversed graph, which gives the next cell towards it from every cell at once.
+    The searches on the graph without cars never change, so they are kept per destination.
+    """
+    def __init__(self, graph):
+        """
+        Creates a new batch router.
+        Args:
+            graph: RoadGraph with the legal moves out of each cell
+        """
+        self.graph = graph
+        self.cells = graph.width * graph.height # Number of cells in the map
+        sources = [] # Cell index where each move starts
+        targets = [] # Cell index where each move ends
+        for pos, nexts in graph.successors_of.items():
+            for next in nexts:
+                sources.append(graph.index(pos))
+                targets.append(graph.index(next))
+        self.sources = np.array(sources, dtype=np.int32)
+        self.targets = np.array(targets, dtype=np.int32)
+        self.reverse = self.reversed_graph(np.ones(len(sources), dtype=bool)) # Reversed graph without any car
+        self.rows = {} # Next cell towards each destination index from every cell, on the graph without cars
+        self.batches = 0 # Number of batches solved
+        self.searches = 0 # Number of searches run by all the batches
+
+    def reversed_graph(self, keep):
+        """
+        Builds the reversed adjacency matrix with only the moves in keep.
+        """
+        return csr_matrix((np.ones(int(keep.sum())), (self.targets[keep], self.sources[keep])), shape=(self.cells, self.cells))
+
+    def next_hops(self, destinations):
+        """
+        Returns the next cell towards each destination index from every cell on the graph without cars,
+        searching the destinations that weren't searched before together.
+        """
+        missing = sorted(set(destinations) - self.rows.keys())
+        if missing:
+            _, predecessors = dijkstra(self.reverse, directed=True, indices=missing, unweighted=True, return_predecessors=True)
+            self.rows.update(zip(missing, predecessors))
+            self.searches += len(missing)
+        return self.rows
+
+    def route(self, origin, destination):
+        """
+        Returns the shortest path from origin to destination on the graph without cars.
+        """
+        return self.unwind(self.next_hops([self.graph.index(destination)])[self.graph.index(destination)], origin, destination)
+
+    def solve(self, requests, blocked = None):
+        """
+        Finds the shortest path of every request.
+        Args:
+            requests: List of (origin, destination) cells
+            blocked: Optional boolean array that tells which cell indices can't be entered
+        Returns the path of each request as a read-only dictionary that maps each cell to the next one.
+        """
+        if not requests:
+            return []
+        destinations = sorted({self.graph.index(destination) for origin, destination in requests})
+        if blocked is None: # Reuse the searches without cars
+            rows = self.next_hops(destinations)
+        else:
+            graph = self.reversed_graph(~blocked[self.targets]) # Drop the moves into blocked cells
+            _, predecessors = dijkstra(graph, directed=True, indices=destinations, unweighted=True, return_predecessors=True)
+            rows = dict(zip(destinations, predecessors)) # Next cells towards each destination
+            self.searches += len(destinations)
+        self.batches += 1
+
+        paths = {} # Paths shared by the requests with the same origin and destination
+        for request in requests:
+            if request not in paths:
+                paths[request] = self.unwind(rows[self.graph.index(request[1])], *request)
+        return [paths[request] for request in requests]
+
+    def unwind(self, next_hops, origin, destination):
+        """
+        Follows the next cells from origin until destination.
+        """
+        path = {}
+        current = self.graph.index(origin)
+        goal = self.graph.index(destination)
+        while current != goal:
+            next = next_hops[current] # In the reversed search, the predecessor is the next cell towards the destination
+            if next < 0: # If the destination can't be reached,
+                return MappingProxyType({})
+            path[self.graph.position(current)] = self.graph.position(int(next))
+            current = next
+        return MappingProxyType(path)
@@ -0,0 +1,239 @@
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from model import CityModel
+from agent import a_star_search
+from layers import ROAD
+from demand import DemandModel
+from citygen import generate_city
+
+ENDPOINTS = ("/getAgents", "/getTrafficLights", "/getObstacles", "/getDestinations", "/getRoads") # Read-only endpoints of unityServer
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Drops the prints of the model while it runs.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def latencies(work, count):
+    """
+    Times count calls of work(i), in seconds each.
+    """
+    times = np.empty(count)
+    for i in range(count):
+        start = time.perf_counter()
+        work(i)
+        times[i] = time.perf_counter() - start
+    return times
+
+def peak_memory(work):
+    """
+    Returns the most memory allocated at once while running work, in bytes.
+    It is measured in its own pass, tracing the allocations slows the timed ones down.
+    """
+    tracemalloc.start()
+    try:
+        work()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def result(name, params, times, peak, **extra):
+    """
+    Summarizes the times of one benchmark.
+    """
+    return dict({
+        "name": name, "params": params, "count": len(times),
+        "per_second": len(times) / times.sum() if times.sum() > 0 else None,
+        "p50_ms": float(np.percentile(times, 50) * 1000), "p99_ms": float(np.percentile(times, 99) * 1000),
+        "peak_kb": peak / 1024,
+    }, **extra)
+
+def bench_search(map_file = "2023_base.txt", searches = 2000, seed = 0):
+    """
+    Times a_star_search alone, between random road cells and destinations. Reports searches per second.
+    """
+    with quiet():
+        model = CityModel(0, static_agents = False, map_file = map_file)
+    graph = model.road_graph
+    rng = random.Random(seed)
+    cells = sorted(graph.successors_of)
+    pairs = [(rng.choice(cells), rng.choice(model.layers.destinations)) for search in range(searches)]
+    times = latencies(lambda i: a_star_search(graph, *pairs[i]), searches)
+    peak = peak_memory(lambda: [a_star_search(graph, *pair) for pair in pairs[:200]])
+    return result("a_star_search", {"map": os.path.basename(map_file)}, times, peak)
+
+def fill(model, cars, seed = 0):
+    """
+    Spawns cars on random free road cells, each going to a random destination. Returns how many were spawned.
+    """
+    cells = [pos for pos in model.layers.cells(ROAD) if not model.has_car(pos)]
+    spawned = 0
+    for pos in random.Random(seed).sample(cells, min(cars, len(cells))):
+        destination = model.set_destination()
+        if destination is not None:
+            model.spawn_car(pos, destination)
+            spawned += 1
+    return spawned
+
+def bench_step(map_file = "2023_base.txt", cars = 100, steps = 100, seed = 0, memory = True, warmup = 0, **options):
+    """
+    Times CityModel.step with a number of cars already in the map and no new ones. Reports steps per second.
+    Args:
+        map_file: Map to load, see CityModel
+        cars: Cars spawned before the first step
+        steps: Steps timed
+        seed: Seed of the model and of the cells the cars start in
+        memory: Whether to measure the peak memory too, in a second run
+        warmup: Steps run before the timed ones
+        options: Keyword arguments of CityModel
+    """
+    def build():
+        model = CityModel(0, static_agents = False, map_file = map_file, seed = seed, **options)
+        model.demand = DemandModel.for_model(model, rate = 0) # Only the cars spawned by fill
+        return model, fill(model, cars, seed)
+    def run():
+        model, spawned = build()
+        for step in range(steps):
+            model.step()
+        if hasattr(model.fleet, "close"): # The partitioned engine has processes of its own
+            model.fleet.close()
+    with quiet():
+        model, spawned = build()
+        for step in range(warmup): # The routing rows of the destinations are built at the first steps
+            model.step()
+        times = latencies(lambda i: model.step(), steps)
+        peak = peak_memory(run) if memory else 0
+    if hasattr(model.fleet, "close"):
+        model.fleet.close()
+    params = dict({"map": os.path.basename(map_file), "cars": cars}, **options)
+    return result("CityModel.step", params, times, peak, cars_start = spawned, car_removed = model.car_removed)
+
+def bench_partition(map_file, cars = (500, 2000, 8000), regions = ((2, 1), (2, 2)), steps = 50, seed = 0):
+    """
+    Times the partitioned engine against the fleet engine on the same cars, and finds where it starts paying off.
+    A partitioned step costs a few rounds of messages to every worker whatever the number of cars, so it only wins
+    with one free CPU per region and enough cars per region. On one CPU it never does: on a 162x162 map with
+    4000 cars the fleet engine did 138 steps per second, (2, 1) regions 48 and (2, 2) regions 34.
+    Returns a result per engine and number of cars, then one per regions with the fewest cars that ran faster
+    than the fleet engine (None if none did).
+    Args:
+        map_file: Map to load, see CityModel
+        cars: Numbers of cars to try, from fewest to most
+        regions: Splits of the map to try, see PartitionedFleet
+        steps: Steps timed
+        seed: Seed of the model and of the cells the cars start in
+    """
+    results, crossover = [], {split: None for split in regions}
+    for count in cars:
+        fleet = bench_step(map_file, count, steps, seed, engine = "fleet", memory = False, warmup = 5)
+        results.append(fleet)
+        for split in regions:
+            entry = bench_step(map_file, count, steps, seed, engine = "partitioned", regions = split, memory = False, warmup = 5)
+            results.append(entry)
+            if crossover[split] is None and entry["per_second"] > fleet["per_second"]:
+                crossover[split] = count
+    for split, count in crossover.items():
+        results.append({"name": "partition crossover", "params": {"map": os.path.basename(map_file), "regions": list(split)},
+                        "count": 0, "per_second": None, "cars": count, "cpus": os.cpu_count()})
+    return results
+
+def bench_endpoints(steps = 100, calls = 50):
+    """
+    Times the endpoints of unityServer through Flask's test client. Reports requests per second of each one.
+    Returns no results when unityServer can't be imported, run with PYTHONPATH=../unityTrafficBase to include them.
+    """
+    try:
+        import unityServer
+    except ImportError:
+        return []
+    client = unityServer.app.test_client()
+    results = []
+    with quiet():
+        times = latencies(lambda i: client.post("/init"), 3)
+        results.append(result("POST /init", {}, times, peak_memory(lambda: client.post("/init"))))
+        times = latencies(lambda i: client.get("/update"), steps)
+        results.append(result("GET /update", {"steps": steps}, times, peak_memory(lambda: client.get("/update"))))
+        for endpoint in ENDPOINTS:
+            times = latencies(lambda i: client.get(endpoint), calls)
+            results.append(result(f"GET {endpoint}", {"step": steps + 1}, times, peak_memory(lambda: client.get(endpoint))))
+    return results
+
+def run_suite(quick = False):
+    """
+    Runs every benchmark. The generated maps are written to a temporary folder.
+    Args:
+        quick: Fewer and shorter runs, to check that the suite works
+    """
+    steps = 20 if quick else 100
+    results = [bench_search(searches = 200 if quick else 2000)]
+    with tempfile.TemporaryDirectory() as folder:
+        maps = ["2023_base.txt"]
+        for blocks in ([(6, 6)] if quick else [(6, 6), (12, 12)]):
+            path = os.path.join(folder, f"city_{blocks[0]}x{blocks[1]}.txt")
+            generate_city(path, blocks)
+            maps.append(path)
+        for map_file in maps:
+            for cars in ([50] if quick else [50, 200, 800]):
+                for engine in ("agents", "fleet"):
+                    if engine == "agents" and cars > 200: # Minutes of A* searches just to spawn them
+                        continue
+                    results.append(bench_step(map_file, cars, steps, engine = engine))
+        if not quick and (os.cpu_count() or 1) > 1: # Partitioning can't pay off on a single CPU
+            results.extend(bench_partition(maps[-1], steps = steps))
+    results.extend(bench_endpoints(steps))
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "cpus": os.cpu_count(), "quick": quick,
+        },
+        "results": results,
+    }
+
+def compare(old, new, tolerance = 0.1):
+    """
+    Compares two suite outputs benchmark by benchmark.
+    Returns (name, params, old rate, new rate, change) of every benchmark in both, and the ones slower than tolerance.
+    """
+    key = lambda entry: (entry["name"], json.dumps(entry["params"], sort_keys = True))
+    before = {key(entry): entry for entry in old["results"]}
+    changes, regressions = [], []
+    for entry in new["results"]:
+        previous = before.get(key(entry))
+        if previous is None or not previous["per_second"] or not entry["per_second"]:
+            continue
+        change = entry["per_second"] / previous["per_second"] - 1
+        row = (entry["name"], entry["params"], previous["per_second"], entry["per_second"], change)
+        changes.append(row)
+        if change < -tolerance:
+            regressions.append(row)
+    return changes, regressions
+
+if __name__ == "__main__":
+    # python benchmark.py <output.json> [baseline.json] [quick]
+    arguments = [argument for argument in sys.argv[1:] if argument != "quick"]
+    suite = run_suite("quick" in sys.argv[1:])
+    with open(arguments[0], "w") as file:
+        json.dump(suite, file, indent = 2)
+    for entry in suite["results"]:
+        if entry["per_second"] is None: # Found by other runs, not timed
+            print(f"{entry['name']:<24} {json.dumps(entry['params']):<60} {entry['cars']} cars")
+            continue
+        print(f"{entry['name']:<24} {json.dumps(entry['params']):<60} {entry['per_second']:>10.1f}/s  p50 {entry['p50_ms']:.3f} ms  p99 {entry['p99_ms']:.3f} ms  peak {entry['peak_kb']:.0f} KB")
+    if len(arguments) > 1: # Compare with an earlier run
+        with open(arguments[1]) as file:
+            changes, regressions = compare(json.load(file), suite)
+        for name, params, before, after, change in changes:
+            print(f"{name:<24} {json.dumps(params):<60} {before:>10.1f}/s -> {after:>10.1f}/s  {change:+.1%}")
+        if regressions:
+            print(f"{len(regressions)} benchmarks got slower")
+            sys.exit(1)
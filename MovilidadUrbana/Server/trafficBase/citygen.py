@@ -0,0 +1,101 @@
+import sys
+import numpy as np
+
+WALL, DESTINATION = ord("#"), ord("D") # Characters of the blocks
+LEFT, RIGHT, UP, DOWN = ord("<"), ord(">"), ord("^"), ord("v") # Characters of the roads
+VERTICAL_LIGHT, HORIZONTAL_LIGHT = ord("S"), ord("s") # Lights of the vertical and horizontal streets, they start out of phase
+
+def city_size(blocks, block = 6, lanes = 2):
+    """
+    Returns the width and height of the map generate_city writes.
+    """
+    return tuple(2 * lanes + count * block + (count - 1) * lanes for count in blocks)
+
+def generate_city(path, blocks = (20, 20), block = 6, lanes = 2, light_density = 0.5, destination_density = 0.3, seed = 0):
+    """
+    Writes a city map in the format of city_files, one line at a time.
+    The city is a grid of square blocks surrounded by a ring road that goes around counterclockwise,
+    like the base maps. Between the blocks there are one-way streets whose direction alternates.
+    Args:
+        path: File to write
+        blocks: Number of blocks along x and along y
+        block: Cells on each side of a block
+        lanes: Lanes of every street and of the ring
+        light_density: Chance of a traffic light before each intersection
+        destination_density: Chance of a destination on the edge of each block
+        seed: Seed of the lights and destinations, the same seed writes the same map
+    Returns the width and height of the map.
+    """
+    bx, by = blocks
+    width, height = city_size(blocks, block, lanes)
+    period = block + lanes # A block and the street after it
+
+    # Every column is part of the ring, of a vertical street or of a block
+    columns = np.arange(width) - lanes # Columns counted from the first block
+    column_block = np.where((columns >= 0) & (columns < bx * period - lanes) & (columns % period < block), columns // period, -1) # Block of each column, -1 on roads
+    column_offset = columns % period # Column inside the block
+    street = np.full(width, 0, dtype=np.uint8) # Direction of the vertical road in each column, 0 in the blocks
+    street[column_block < 0] = np.where((columns[column_block < 0] // period) % 2 == 0, DOWN, UP)
+    street[:lanes] = DOWN # Left side of the ring
+    street[width - lanes:] = UP # Right side of the ring
+    inner = np.flatnonzero((column_block < 0) & (columns >= 0) & (columns < bx * period - lanes)) # Columns of the streets between blocks
+    first_lane = inner[(inner - lanes) % period == block] # First column of each vertical street
+
+    with open(path, "w") as file:
+        for r in range(height):
+            row = r - lanes # Row counted from the first block
+            if r < lanes: # Top of the ring, cars go left and turn down at the corner
+                line = np.full(width, LEFT, dtype=np.uint8)
+                line[:lanes] = DOWN
+            elif r >= height - lanes: # Bottom of the ring, cars go right and turn up at the corner
+                line = np.full(width, RIGHT, dtype=np.uint8)
+                line[width - lanes:] = UP
+            elif row % period >= block: # A horizontal street between two rows of blocks
+                j = row // period # Number of the street
+                rng = np.random.default_rng([seed, 1, j]) # Same draws for every lane of the street
+                direction = LEFT if j % 2 == 0 else RIGHT
+                line = np.full(width, direction, dtype=np.uint8)
+                line[:lanes] = DOWN
+                line[width - lanes:] = UP
+                lights = rng.random(bx) < light_density # Light before each intersection, by the block it's in
+                edge = 0 if direction == LEFT else block - 1 # Cars reach the intersection from this side of the block
+                line[(column_block >= 0) & (column_offset == edge) & lights[np.maximum(column_block, 0)]] = HORIZONTAL_LIGHT
+            else: # A row of blocks, crossed by the vertical streets
+                b, k = row // period, row % period # Row of blocks and row inside them
+                rng = np.random.default_rng([seed, 2, b]) # Same draws for every row of the blocks
+                line = np.where(street > 0, street, WALL).astype(np.uint8)
+                lights = rng.random(len(first_lane)) < light_density # Light at the end of each vertical street
+                lights &= k == np.where(street[first_lane] == DOWN, block - 1, 0) # Cars reach the intersection from this side of the blocks
+                line[(first_lane[lights][:, None] + np.arange(lanes)).ravel()] = VERTICAL_LIGHT
+                places = rng.random(bx) < destination_density # Blocks with a destination
+                if b == 0:
+                    places[0] = True # There is always at least one
+                sides = rng.integers(0, 4, bx) # Edge of the block with the destination: top, bottom, left or right
+                spots = rng.integers(0, block, bx) # Position along that edge
+                x = np.choose(sides, [spots, spots, 0, block - 1]) # Column inside the block
+                y = np.choose(sides, [0, block - 1, spots, spots]) # Row inside the block
+                here = np.flatnonzero(places & (y == k)) # Blocks with their destination in this row
+                line[lanes + here * period + x[here]] = DESTINATION
+            file.write(line.tobytes().decode())
+            file.write("\n")
+    return width, height
+
+def tile_map(source, path, tiles = (2, 2)):
+    """
+    Writes a map made of copies of another one, one line at a time.
+    Args:
+        source: Map file to copy
+        path: File to write
+        tiles: Copies along x and along y
+    """
+    with open(path, "w") as file:
+        for copy in range(tiles[1]):
+            with open(source) as original:
+                for line in original:
+                    file.write(line.rstrip("\n") * tiles[0])
+                    file.write("\n")
+
+if __name__ == "__main__":
+    # python citygen.py <file> <blocks along x> <blocks along y> [block] [lanes]
+    sizes = [int(value) for value in sys.argv[2:]]
+    print(generate_city(sys.argv[1], (sizes[0], sizes[1]), *sizes[2:]))
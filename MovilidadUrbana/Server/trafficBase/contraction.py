@@ -0,0 +1,160 @@
+import heapq
+from agent import heuristic
+
+STEPS = {"Right": (1, 0), "Left": (-1, 0), "Up": (0, 1), "Down": (0, -1)} # Cell offset of one move along each road direction
+
+class ContractedGraph:
+    """
+    Road graph where the straight stretches of the corridors are collapsed into single weighted edges.
+    A cell is kept as a node when something can happen there: intersections, turns, lane ends,
+    traffic lights and destinations. Cars only change lanes at the nodes, which gives paths of the
+    same length because the lanes of a corridor run in parallel.
+    """
+    def __init__(self, graph):
+        """
+        Compiles the contracted graph from a RoadGraph.
+        Args:
+            graph: RoadGraph with the legal moves out of each cell
+        """
+        self.graph = graph
+        self.nodes = frozenset(self.find_nodes()) # Cells that are kept
+        self.edges = {node: tuple(self.follow(node, next) for next in graph.successors(node)) for node in self.nodes} # Edges out of each node
+
+    def sides(self, pos):
+        """
+        Returns the cells in the lanes on each side of a road cell.
+        """
+        dx, dy = STEPS[self.graph.direction(pos)]
+        return ((pos[0] + dy, pos[1] + dx), (pos[0] - dy, pos[1] - dx))
+
+    def find_nodes(self):
+        """
+        Returns the cells that can't be collapsed. When a lane has a node, the cells next to it
+        in the parallel lanes are nodes too, so cars in those lanes can change into it.
+        """
+        nodes = {pos for pos in self.graph.successors_of if not self.is_corridor(pos)} # Cells where something happens
+        pending = [pos for pos in nodes if self.graph.direction(pos) is not None] # Road nodes whose side lanes haven't been checked
+        while pending:
+            pos = pending.pop()
+            for side in self.sides(pos): # Spread the node across the lanes of the corridor
+                if side not in nodes and self.graph.direction(side) == self.graph.direction(pos):
+                    nodes.add(side)
+                    pending.append(side)
+        return nodes
+
+    def is_corridor(self, pos):
+        """
+        Checks if a cell is a plain corridor cell: a road that only goes straight,
+        or sideways into parallel lanes going the same way.
+        """
+        direction = self.graph.direction(pos)
+        if direction is None: # Traffic lights and destinations are always nodes
+            return False
+        dx, dy = STEPS[direction]
+        ahead = (pos[0] + dx, pos[1] + dy)
+        behind = (pos[0] - dx, pos[1] - dy)
+        if self.graph.direction(ahead) != direction or self.graph.direction(behind) != direction: # The corridor ends or starts here
+            return False
+        for side in self.sides(pos): # Cells in the lanes on each side
+            if side in self.graph.successors_of and self.graph.direction(side) != direction: # Something else than a parallel lane is next to it
+                return False
+        return ahead in self.graph.successors(pos) and behind in self.graph.predecessors(pos) # Cars go through it
+
+    def follow(self, node, first):
+        """
+        Walks straight from node through first until the next node.
+        Returns the edge as (first, direction of the walk, number of moves, last cell).
+        """
+        current = first # Cell reached so far
+        moves = 1 # Moves done so far
+        step = STEPS[self.graph.direction(first)] if first not in self.nodes else (0, 0) # Corridor cells are left straight ahead
+        while current not in self.nodes:
+            current = (current[0] + step[0], current[1] + step[1])
+            moves += 1
+        return (first, step, moves, current)
+
+    def find_route(self, start, goal):
+        """
+        Finds the shortest route between two cells using A* on the contracted graph.
+        The goal has to be a node. Returns the route as a tuple of (node, edge) pairs, empty if there is none.
+        """
+        if goal not in self.nodes: # Only nodes can be reached by the edges
+            return ()
+        def edges(pos): # Edges out of a cell, built on the fly for the corridor cells
+            if pos in self.nodes:
+                return self.edges[pos]
+            return tuple(self.follow(pos, next) for next in self.graph.successors(pos))
+
+        queue = [(0, start)] # Priority queue
+        wherefrom = {start: None} # Node and edge the best route came from
+        sofar = {start: 0} # Moves to reach each node so far
+        while queue:
+            current = heapq.heappop(queue)[1] # Get the node with the lowest cost
+            if current == goal: # If the goal is reached, stop
+                break
+            for edge in edges(current): # Follow every edge out of the node
+                next = edge[3]
+                new_cost = sofar[current] + edge[2]
+                if next not in sofar or new_cost < sofar[next]: # If the node has not been reached or the cost is lower,
+                    sofar[next] = new_cost
+                    heapq.heappush(queue, (new_cost + heuristic(goal, next), next))
+                    wherefrom[next] = (current, edge)
+        if goal not in wherefrom or start == goal: # If no route was found,
+            return ()
+        route = [] # Edges from the goal back to the start
+        current = goal
+        while current != start:
+            prev, edge = wherefrom[current]
+            route.append((prev, edge))
+            current = prev
+        return tuple(reversed(route))
+
+class ContractedPath:
+    """
+    Path of one car along a contracted route, expanded into cells only when they are asked for.
+    It behaves like the path dictionaries returned by a_star_search (get and in).
+    The route itself is immutable and can be shared, the path only keeps how far the car got.
+    """
+    def __init__(self, route):
+        """
+        Creates a new path.
+        Args:
+            route: Route returned by ContractedGraph.find_route
+        """
+        self.route = route
+        self.cursor = 0 # Edge where the car was last seen
+
+    def edge_of(self, pos):
+        """
+        Returns the edge pos is on, looking from the car's last edge onwards.
+        """
+        count = len(self.route)
+        for i in (self.cursor + k if self.cursor + k < count else self.cursor + k - count for k in range(count)): # The car is usually on the same edge or the next one
+            node, (first, step, moves, last) = self.route[i]
+            if pos == node: # The start of the edge
+                return i
+            j = (pos[0] - first[0]) * step[0] + (pos[1] - first[1]) * step[1] # Moves from first to pos
+            if 0 <= j < moves - 1 and pos == (first[0] + j * step[0], first[1] + j * step[1]): # A cell inside the edge
+                return i
+        return None
+
+    def get(self, pos, default = None):
+        """
+        Returns the cell that comes after pos on the path.
+        """
+        if pos is None:
+            return default
+        i = self.edge_of(pos)
+        if i is None: # pos is not on the path, or it's the goal
+            return default
+        self.cursor = i # Remember where the car is
+        node, (first, step, moves, last) = self.route[i]
+        if pos == node: # Leave the node through the first cell of the edge
+            return first
+        return (pos[0] + step[0], pos[1] + step[1]) # Keep going straight
+
+    def __contains__(self, pos):
+        return self.edge_of(pos) is not None
+
+    def __bool__(self):
+        return len(self.route) > 0
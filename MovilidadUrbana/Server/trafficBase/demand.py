@@ -0,0 +1,180 @@
+from collections import deque
+from functools import partial
+import numpy as np
+
+def constant(level = 1.0):
+    """
+    Profile with the same arrival rate at every step.
+    The profiles are partials of module functions, so a demand model can be pickled into a snapshot.
+    """
+    return partial(constant_rate, float(level))
+
+def constant_rate(level, steps):
+    """
+    Rate multiplier of the constant profile.
+    """
+    return np.full(len(steps), level)
+
+def rush_hour(peaks, width = 50, base = 0.5, peak = 2.0):
+    """
+    Profile with a bell-shaped rush around each peak step.
+    Args:
+        peaks: Steps where the rushes are at their highest
+        width: Steps from a peak to where its rush is down to about 60%
+        base: Rate multiplier outside the rushes
+        peak: Rate multiplier at the top of a rush
+    """
+    return partial(rush_hour_rate, np.asarray(peaks, dtype=float), width, base, peak)
+
+def rush_hour_rate(peaks, width, base, peak, steps):
+    """
+    Rate multiplier of the rush hour profile.
+    """
+    distance = (np.asarray(steps, dtype=float)[:, None] - peaks[None, :]) / width
+    return base + (peak - base) * np.exp(-distance ** 2 / 2).sum(axis=1).clip(max=1)
+
+class DemandModel:
+    """
+    Cars that want to enter the map, from an origin-destination matrix and arrival rates over time.
+    Arrivals are drawn as a Poisson process, a batch of steps at a time. Every origin keeps a queue,
+    and a car waits in it until its origin cell is free instead of being dropped.
+    Destinations disabled in the model's DestinationIndex are never drawn, their share goes to the enabled ones.
+    """
+    def __init__(self, origins, od, rate = 0.1, profile = None, seed = None, batch = 256, max_backlog = None, destinations = None):
+        """
+        Creates a new demand model.
+        Args:
+            origins: Cells where the cars enter the map
+            od: Matrix with the relative demand from each origin (rows) to each destination id (columns)
+            rate: Cars per step arriving at each origin, one value or one per origin
+            profile: Function that gives the rate multiplier of an array of steps, constant if None
+            seed: Seed of the arrivals, drawn from the model's random generator if None
+            batch: Steps of arrivals drawn at a time
+            max_backlog: Cars each queue can hold, the arrivals that don't fit are dropped. No limit if None
+            destinations: Number of destinations of the map, to check the columns of od. Checked at the first step if None
+        """
+        self.origins = list(origins)
+        od = np.asarray(od, dtype=float)
+        if od.ndim != 2 or len(od) != len(self.origins):
+            raise ValueError(f"The od matrix must have one row per origin ({len(self.origins)}), got shape {od.shape}")
+        totals = od.sum(axis=1)
+        if (od < 0).any() or (totals <= 0).any():
+            raise ValueError("Every origin needs a non-negative demand to at least one destination")
+        self.od = od / totals[:, None] # Chance of going to each destination, per origin
+        if destinations is not None:
+            self.check(destinations)
+        self.cumulative = np.cumsum(self.od, axis=1) # Chance of going up to each destination, per origin
+        self.cumulative[:, -1] = 1 # Rounding can't leave any draw out
+        self.rate = np.broadcast_to(np.asarray(rate, dtype=float), (len(self.origins),)).copy()
+        self.profile = profile if profile is not None else constant()
+        self.seed = seed
+        self.rng = None # Generator of the arrivals, created when the first batch is drawn
+        self.batch = batch
+        self.max_backlog = max_backlog
+        self.start = None # First step of the current batch
+        self.bounds = None # Arrivals of step start + k are from bounds[k] to bounds[k + 1]
+        self.arrival_origin = None # Origin id of each arrival in the batch
+        self.arrival_destination = None # Destination id of each arrival in the batch
+        self.queues = [deque() for origin in self.origins] # Destination id and arrival step of the cars waiting at each origin
+        self.waiting = set() # Origins with cars in their queue
+        self.arrived = 0 # Cars that arrived to the queues
+        self.spawned = 0 # Cars that entered the map
+        self.dropped = 0 # Cars that didn't fit in a full queue
+        self.wait = 0 # Steps waited in the queues by the spawned cars
+
+    @classmethod
+    def for_model(cls, model, rate = 0.1, **kwargs):
+        """
+        Demand from the model's corners to every destination, weighted like the destination index.
+        """
+        weights = [weight if enabled else 0 for weight, enabled in zip(model.destinations.weights, model.destinations.enabled)]
+        corners = model.corners()
+        return cls(corners, [weights] * len(corners), rate, destinations = len(model.layers.destinations), **kwargs)
+
+    def check(self, destinations):
+        """
+        Raises ValueError if the od matrix doesn't have one column per destination of a map.
+        """
+        if self.od.shape[1] != destinations:
+            raise ValueError(f"The od matrix has {self.od.shape[1]} destination columns, the map has {destinations} destinations")
+
+    def draw(self, random, start):
+        """
+        Draws the arrivals of the batch of steps that begins at start.
+        """
+        if self.rng is None:
+            self.rng = np.random.default_rng(self.seed if self.seed is not None else random.getrandbits(64))
+        steps = np.arange(start, start + self.batch)
+        counts = self.rng.poisson(self.rate[None, :] * self.profile(steps)[:, None]) # Arrivals of every step at every origin
+        origins = np.tile(np.arange(len(self.origins)), self.batch)
+        self.arrival_origin = np.repeat(origins, counts.ravel()) # Already sorted by step
+        draws = self.rng.random(len(self.arrival_origin))
+        self.arrival_destination = (draws[:, None] > self.cumulative[self.arrival_origin]).sum(axis=1)
+        self.bounds = np.concatenate(([0], np.cumsum(counts.sum(axis=1))))
+        self.start = start
+
+    def arrivals(self, random, step):
+        """
+        Returns the origin ids and destination ids of the cars arriving at step.
+        """
+        if self.start is None or not self.start <= step < self.start + self.batch:
+            self.draw(random, step)
+        k = step - self.start
+        first, last = self.bounds[k], self.bounds[k + 1]
+        return self.arrival_origin[first:last].tolist(), self.arrival_destination[first:last].tolist()
+
+    def redraw(self, origin, enabled):
+        """
+        Draws the destination id of a car from an origin again, among the enabled destinations. None if it has none.
+        """
+        chances = self.od[origin] * enabled
+        total = chances.sum()
+        if total <= 0:
+            return None
+        k = int(np.searchsorted(np.cumsum(chances), self.rng.random() * total, side="right"))
+        return min(k, int(np.flatnonzero(chances)[-1])) # Rounding can't pick a disabled one
+
+    def release(self, model, step):
+        """
+        Queues the arrivals of a step and lets the first car of every queue in if its origin is free.
+        Cars drawn towards a disabled destination are drawn again, and dropped if their origin has no enabled destination.
+        """
+        self.check(len(model.layers.destinations))
+        enabled = model.destinations.enabled
+        mask = None # Enabled destinations as an array, only built if a car goes to a disabled one
+        for origin, destination in zip(*self.arrivals(model.random, step)):
+            queue = self.queues[origin]
+            self.arrived += 1
+            if not enabled[destination]:
+                if mask is None:
+                    mask = np.array(enabled, dtype=bool)
+                destination = self.redraw(origin, mask)
+                if destination is None:
+                    self.dropped += 1
+                    continue
+            if self.max_backlog is not None and len(queue) >= self.max_backlog:
+                self.dropped += 1
+                if model.metrics.enabled:
+                    model.metrics.count("dropped_spawns")
+                continue
+            queue.append((destination, step))
+            self.waiting.add(origin)
+        for origin in sorted(self.waiting):
+            pos = self.origins[origin]
+            if model.has_car(pos): # Backpressure, the car waits for the cell to be free
+                if model.metrics.enabled:
+                    model.metrics.count("delayed_spawns")
+                continue
+            queue = self.queues[origin]
+            destination, arrival = queue.popleft()
+            model.spawn_car(pos, model.layers.destinations[destination])
+            self.spawned += 1
+            self.wait += step - arrival
+            if not queue:
+                self.waiting.discard(origin)
+
+    def backlog(self):
+        """
+        Returns how many cars are waiting at each origin.
+        """
+        return [len(queue) for queue in self.queues]
@@ -0,0 +1,106 @@
+class DestinationIndex:
+    """
+    Destinations of the map with a demand weight each, sampled in constant time.
+    Weighted draws use an alias table (Walker's method), rebuilt only after the weights change.
+    Disabled destinations keep their weight but are never drawn.
+    """
+    def __init__(self, cells):
+        """
+        Creates a new index where every destination is enabled with weight 1.
+        Args:
+            cells: Cell of each destination id
+        """
+        self.cells = list(cells) # Cell of each destination id
+        self.ids = {pos: i for i, pos in enumerate(self.cells)} # Destination id of each cell
+        self.weights = [1.0] * len(self.cells) # Demand weight of each destination
+        self.enabled = [True] * len(self.cells) # Whether each destination can be drawn
+        self.uniform = True # Every destination is enabled with the same weight, a plain choice is enough
+        self.prob = None # Alias table: chance of keeping each column
+        self.alias = None # Alias table: destination drawn instead of each column
+        self.columns = None # Destination id of each column of the alias table
+
+    def id_of(self, destination):
+        """
+        Returns the id of a destination given by its cell or its id.
+        """
+        return self.ids[destination] if isinstance(destination, tuple) else destination
+
+    def set_weight(self, destination, weight):
+        """
+        Changes the demand weight of a destination.
+        """
+        if weight < 0:
+            raise ValueError(f"Negative demand weight: {weight}")
+        self.weights[self.id_of(destination)] = float(weight)
+        self.changed()
+
+    def set_weights(self, weights):
+        """
+        Changes the demand weights of every destination, in id order.
+        """
+        weights = [float(weight) for weight in weights]
+        if len(weights) != len(self.cells) or min(weights, default=0) < 0:
+            raise ValueError("There must be one non-negative weight per destination")
+        self.weights = weights
+        self.changed()
+
+    def enable(self, destination):
+        """
+        Lets cars go to a destination again.
+        """
+        self.enabled[self.id_of(destination)] = True
+        self.changed()
+
+    def disable(self, destination):
+        """
+        Stops sending cars to a destination.
+        """
+        self.enabled[self.id_of(destination)] = False
+        self.changed()
+
+    def changed(self):
+        """
+        Drops the alias table, it's rebuilt at the next draw.
+        """
+        self.uniform = not self.cells or (all(self.enabled) and len(set(self.weights)) == 1 and self.weights[0] > 0)
+        self.prob = self.alias = self.columns = None
+
+    def build(self):
+        """
+        Builds the alias table of the enabled destinations with a weight.
+        """
+        self.columns = [i for i, weight in enumerate(self.weights) if self.enabled[i] and weight > 0]
+        count = len(self.columns)
+        total = sum(self.weights[i] for i in self.columns)
+        scaled = [self.weights[i] * count / total for i in self.columns] # Average of 1 per column
+        self.prob = [1.0] * count
+        self.alias = list(range(count))
+        small = [k for k, value in enumerate(scaled) if value < 1]
+        large = [k for k, value in enumerate(scaled) if value >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less] # The column keeps its own share
+            self.alias[less] = more # and the rest goes to a larger one
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+
+    def sample(self, random):
+        """
+        Draws a destination with a chance proportional to its weight.
+        Returns its cell, None if no destination can be drawn.
+        Args:
+            random: Random number generator to draw with, usually the model's
+        """
+        if self.uniform: # Same draws as before the weights existed
+            return random.choice(self.cells) if self.cells else None
+        if self.columns is None:
+            self.build()
+        if not self.columns:
+            return None
+        k = int(random.random() * len(self.columns))
+        if random.random() >= self.prob[k]:
+            k = self.alias[k]
+        return self.cells[self.columns[k]]
+
+    def __len__(self):
+        return len(self.cells)
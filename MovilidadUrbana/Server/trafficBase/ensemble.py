@@ -0,0 +1,149 @@
+import contextlib
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from model import CityModel
+from demand import DemandModel
+
+KPIS = ("car_removed", "spawned", "in_map", "trip_mean", "trip_p50", "trip_p95", "steps_per_second") # Results of every run that are aggregated
+
+def sweep(seeds, steps = 500, **options):
+    """
+    Returns the runs of every combination of options, once per seed.
+    Args:
+        seeds: Seeds of the runs, a number n means 0 to n - 1
+        steps: Steps of every run
+        options: List of values of each option tried, see run
+    """
+    seeds = range(seeds) if isinstance(seeds, int) else seeds
+    names = sorted(options)
+    return [dict(zip(names, values), seed=seed, steps=steps) for values in itertools.product(*(options[name] for name in names)) for seed in seeds]
+
+def run(spec):
+    """
+    Runs one simulation and returns its results. The model's prints are dropped.
+    Args:
+        spec: Dictionary with the seed and steps of the run, and optionally
+            agents: First argument of CityModel
+            rate: Cars per step arriving at every corner, through a DemandModel, instead of the default spawns
+            light_time: Steps every traffic light stays green and red
+            any keyword argument of CityModel
+    """
+    options = dict(spec)
+    seed, steps = options.pop("seed"), options.pop("steps")
+    agents = options.pop("agents", 5)
+    rate = options.pop("rate", None)
+    light_time = options.pop("light_time", None)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        model = CityModel(agents, seed = seed, **options)
+        if light_time is not None:
+            model.set_light_time(light_time)
+        if rate is not None:
+            model.demand = DemandModel.for_model(model, rate)
+        try:
+            for step in range(steps):
+                model.step()
+        finally:
+            if hasattr(model.fleet, "close"): # The partitioned engine has processes of its own
+                model.fleet.close()
+        seconds = time.perf_counter() - start
+    trips = np.array(model.trip_times, dtype=float)
+    spawned = model.num_agents - agents # Cars created during the run
+    return {
+        "spec": spec,
+        "car_removed": model.car_removed,
+        "spawned": spawned,
+        "in_map": spawned - model.car_removed,
+        "trip_mean": float(trips.mean()) if trips.size else None,
+        "trip_p50": float(np.percentile(trips, 50)) if trips.size else None,
+        "trip_p95": float(np.percentile(trips, 95)) if trips.size else None,
+        "seconds": seconds,
+        "steps_per_second": steps / seconds if seconds > 0 else None,
+    }
+
+def failure(spec, error):
+    """
+    Returns the result of a run that raised an error, so the other runs of the ensemble go on.
+    """
+    return {"spec": spec, "error": f"{type(error).__name__}: {error}"}
+
+def attempt(spec):
+    """
+    Runs one simulation, returning a failure instead of raising.
+    """
+    try:
+        return run(spec)
+    except Exception as error:
+        return failure(spec, error)
+
+def pooled(spec, processes):
+    """
+    Returns the spec of a run in a pool. A partitioned run without regions only gets one per core the pool leaves free,
+    (1, 1) if the pool already uses every core, instead of the (2, 2) regions of CityModel.
+    """
+    if spec.get("engine") != "partitioned" or "regions" in spec:
+        return spec
+    return dict(spec, regions = (max(1, (os.cpu_count() or 1) // processes), 1))
+
+def run_ensemble(specs, processes = None):
+    """
+    Runs every spec over a pool of processes, yielding the results as they finish, not in order.
+    Every run only draws from its own seed, so the results don't depend on the process that ran it.
+    A run that raises yields a result with its spec and the error instead of its KPIs, the others go on.
+    The workers aren't daemons, so runs of the partitioned engine can start the processes of their regions.
+    Args:
+        specs: Runs to do, see run
+        processes: Size of the pool, one per core if None. With 1 the runs are done in this process
+    """
+    if processes == 1:
+        yield from map(attempt, specs)
+        return
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(processes) as pool:
+        specs = [pooled(spec, processes) for spec in specs]
+        futures = {pool.submit(run, spec): spec for spec in specs} # One run at a time per process, they take long enough
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as error: # Raised by the run, or its worker died
+                yield failure(futures[future], error)
+
+def summarize(results):
+    """
+    Aggregates the results of the runs that only differ in their seed.
+    Returns one dictionary per group with its options, the number of runs, the number of failed runs and
+    the mean, standard deviation, minimum and maximum of every KPI of the runs that didn't fail.
+    """
+    groups = {}
+    for result in results:
+        options = {name: value for name, value in result["spec"].items() if name != "seed"}
+        groups.setdefault(json.dumps(options, sort_keys = True, default = str), (options, []))[1].append(result)
+    summary = []
+    for key in sorted(groups):
+        options, runs = groups[key]
+        failed = sum("error" in result for result in runs)
+        runs = [result for result in runs if "error" not in result]
+        kpis = {}
+        for kpi in KPIS:
+            values = np.array([result[kpi] for result in runs if result[kpi] is not None], dtype=float)
+            if values.size:
+                kpis[kpi] = {"mean": float(values.mean()), "std": float(values.std()), "min": float(values.min()), "max": float(values.max())}
+        summary.append({"options": options, "runs": len(runs), "failed": failed, "kpis": kpis})
+    return summary
+
+if __name__ == "__main__":
+    # python ensemble.py <seeds> <steps> [processes] [engine ...], one JSON line per run as they finish and the summary at the end
+    # e.g. python ensemble.py 2 20 2 agents fleet partitioned runs every engine over a pool
+    arguments = [int(value) for value in sys.argv[1:4] if value.isdigit()]
+    engines = [value for value in sys.argv[1:] if not value.isdigit()]
+    specs = sweep(arguments[0], arguments[1], engine = engines) if engines else sweep(arguments[0], arguments[1])
+    results = []
+    for result in run_ensemble(specs, arguments[2] if len(arguments) > 2 else None):
+        print(json.dumps(result), flush = True)
+        results.append(result)
+    print(json.dumps(summarize(results), indent = 2))
@@ -0,0 +1,144 @@
+from array import array
+import heapq
+
+class FlatAStar:
+    """
+    A* on flat cell indices with buffers that are allocated once and reused by every search.
+    Visited cells are marked with the number of the search that reached them, so nothing has
+    to be cleared between searches. It finds the same paths as a_star_search.
+    """
+    def __init__(self, graph):
+        """
+        Creates a new search engine.
+        Args:
+            graph: RoadGraph with the legal moves out of each cell
+        """
+        self.graph = graph
+        cells = graph.width * graph.height # Number of cells in the map
+        self.cells = cells
+        self.positions = tuple(graph.position(i) for i in range(cells)) # Cell of every index, so searches don't build tuples
+        self.xs = array("i", (pos[0] for pos in self.positions)) # Column of every index
+        self.ys = array("i", (pos[1] for pos in self.positions)) # Row of every index
+        self.order = array("i", (x * graph.height + y for x, y in self.positions)) # Tie-break rank of every index, the same as comparing (x, y)
+        self.by_order = array("i", [0]) * cells # Index of every tie-break rank
+        for i, rank in enumerate(self.order):
+            self.by_order[rank] = i
+
+        self.offsets = array("i", [0]) * (cells + 1) # Successors of index i are targets[offsets[i]:offsets[i + 1]]
+        self.targets = array("i")
+        for i, pos in enumerate(self.positions):
+            self.targets.extend(graph.index(next) for next in graph.successors(pos))
+            self.offsets[i + 1] = len(self.targets)
+
+        self.cost = array("i", [0]) * cells # Cost so far of every cell reached by the current search
+        self.parent = array("i", [0]) * cells # Where the path to every cell came from
+        self.seen = array("I", [0]) * cells # Number of the last search that reached every cell
+        self.generation = 0 # Number of the current search
+        self.heap = [] # Priority queue of priority * cells + rank, reused between searches
+        self.searches = 0 # Number of searches done
+        self.expanded = 0 # Number of cells expanded by all the searches
+
+    def search(self, start, goal, blocked=None):
+        """
+        Finds the shortest path between two cells.
+        Returns the cell indices from start to goal as a read-only array, empty if there is no path.
+        Args:
+            start, goal: Cells where the path starts and ends
+            blocked: Optional function that tells if a cell can't be entered right now
+        """
+        self.generation += 1
+        if self.generation == 2 ** 32: # The marks would overflow, start them again
+            self.seen = array("I", [0]) * self.cells
+            self.generation = 1
+        generation = self.generation
+        cells, cost, parent, seen = self.cells, self.cost, self.parent, self.seen
+        offsets, targets, order, by_order = self.offsets, self.targets, self.order, self.by_order
+        xs, ys, positions = self.xs, self.ys, self.positions
+        source = self.graph.index(start)
+        target = self.graph.index(goal)
+        gx, gy = goal
+
+        seen[source] = generation
+        cost[source] = 0
+        parent[source] = -1
+        heap = self.heap
+        heap.clear()
+        push, pop = heapq.heappush, heapq.heappop
+        push(heap, order[source]) # The start has priority 0
+        expanded = 0 # Cells expanded by this search
+        while heap:
+            current = by_order[pop(heap) % cells] # Get the cell with the lowest cost
+            expanded += 1
+            if current == target: # If the goal is reached, stop
+                break
+            new_cost = cost[current] + 1 # Cost to get to the neighbors
+            for next in targets[offsets[current]:offsets[current + 1]]: # Cells that can be reached from the current cell
+                if seen[next] == generation and new_cost >= cost[next]: # If the neighbor was already reached as cheap, skip it
+                    continue
+                if blocked is not None and blocked(positions[next]): # If the cell is blocked, skip it
+                    continue
+                seen[next] = generation
+                cost[next] = new_cost
+                parent[next] = current
+                push(heap, (new_cost + abs(gx - xs[next]) + abs(gy - ys[next])) * cells + order[next])
+        self.searches += 1
+        self.expanded += expanded
+
+        path = array("i")
+        if seen[target] != generation or source == target: # If no path was found,
+            return memoryview(path).toreadonly()
+        current = target
+        while current != -1: # Walk back from the goal to the start
+            path.append(current)
+            current = parent[current]
+        path.reverse()
+        return memoryview(path).toreadonly()
+
+class ArrayPath:
+    """
+    Path of one car along an array of cell indices.
+    It behaves like the path dictionaries returned by a_star_search (get and in).
+    The array can be shared, the path only keeps how far the car got.
+    """
+    def __init__(self, search, cells):
+        """
+        Creates a new path.
+        Args:
+            search: FlatAStar that found the path
+            cells: Cell indices from the start to the goal
+        """
+        self.index = search.graph.index
+        self.positions = search.positions
+        self.cells = cells
+        self.cursor = 0 # Where the car was last seen
+
+    def find(self, pos):
+        """
+        Returns where pos is on the path, looking from the car's last position onwards.
+        The goal is left out, nothing comes after it.
+        """
+        i = self.index(pos)
+        count = len(self.cells) - 1
+        for k in range(count):
+            k = self.cursor + k if self.cursor + k < count else self.cursor + k - count # The car is usually where it was or just ahead
+            if self.cells[k] == i:
+                return k
+        return None
+
+    def get(self, pos, default=None):
+        """
+        Returns the cell that comes after pos on the path.
+        """
+        if pos is None:
+            return default
+        k = self.find(pos)
+        if k is None: # pos is not on the path, or it's the goal
+            return default
+        self.cursor = k # Remember where the car is
+        return self.positions[self.cells[k + 1]]
+
+    def __contains__(self, pos):
+        return self.find(pos) is not None
+
+    def __bool__(self):
+        return len(self.cells) > 0
@@ -0,0 +1,312 @@
+import numpy as np
+from routing import RoutingTables, NO_HOP, FAR
+from roadgraph import NEIGHBORS
+from layers import DIRECTIONS
+
+VERTICAL = (DIRECTIONS.index("Up"), DIRECTIONS.index("Down")) # Direction codes of the vertical roads
+HORIZONTAL = (DIRECTIONS.index("Right"), DIRECTIONS.index("Left")) # Direction codes of the horizontal roads
+GREEDINESS, CARELESS, RANK = 1, 2, 3 # Streams of the random numbers drawn for each car
+
+def draw(seed, tick, numbers, stream):
+    """
+    Returns a random 64-bit number for each car number, for one step and one stream.
+    The numbers only depend on the arguments (a SplitMix64 hash), so whatever process holds a car draws the same for it.
+    """
+    with np.errstate(over="ignore"):
+        x = np.asarray(numbers, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        x ^= np.uint64(seed) ^ np.uint64(tick) * np.uint64(0xD1B54A32D192ED03) ^ np.uint64(stream) * np.uint64(0x8CB92BA72F3D8DD7)
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    return x
+
+def first_claimers(group, eligible):
+    """
+    Marks the first eligible claimer of every group. Claimers are sorted by group, then by the order they act in.
+    """
+    before = np.concatenate(([0], np.cumsum(eligible)))[np.searchsorted(group, group)] # Eligible claimers before each group
+    return eligible & (np.cumsum(eligible) - before == 1)
+
+def compiled_tables(compiled):
+    """
+    Returns the arguments of FleetCore after the size, read from a compiled map.
+    """
+    width = compiled.width
+    return (compiled.array("offsets"), compiled.array("targets"), compiled.array("direction").T.ravel(),
+            [y * width + x for x, y in compiled.meta["destinations"]], [y * width + x for x, y, state, time in compiled.meta["lights"]])
+
+def light_states(model):
+    """
+    Returns whether each traffic light id of a model is green.
+    """
+    if model.signals is not None: # The controller already has every state in an array
+        return model.signals.state
+    return np.fromiter((light.state for light in model.traffic_lights), dtype=bool, count=len(model.traffic_lights))
+
+class FleetCore:
+    """
+    Cars kept in arrays and the rules that move them, without a model.
+    Every step has an intent phase, where each car picks the cell it wants following the shared
+    next-hop tables with the same rules as Car.move, and a commit phase that lets the cars in
+    following a random order, like RandomActivation does, so no two cars end up in the same cell.
+    """
+    def __init__(self, width, height, offsets, targets, direction, goals, lights, seed, capacity = 1024, tables = None):
+        """
+        Creates an empty fleet. Cells are flat indices, y * width + x.
+        Args:
+            width, height: The size of the map
+            offsets, targets: Moves out of every cell, the ones out of cell i are targets[offsets[i]:offsets[i + 1]]
+            direction: Road direction code of every cell
+            goals: Cell of each destination id
+            lights: Cell of each traffic light id
+            seed: Seed of every random draw
+            capacity: How many cars fit before the arrays grow
+            tables: RoutingTables with distances of the same map to share with another fleet, a new one if None
+        """
+        self.width = width
+        cells = width * height # Number of cells in the map
+        if tables is None: # Only the destinations of the cars are built
+            tables = RoutingTables(width, height, offsets, targets, goals, distances = True)
+        self.tables = tables
+        self.moves = np.zeros(NO_HOP + 1, dtype=np.int64) # Index offset of every next-hop code, 0 for none
+        self.moves[:len(NEIGHBORS)] = [dx + dy * width for dx, dy in NEIGHBORS]
+        self.goals = np.asarray(goals, dtype=np.int32)
+        self.direction = np.asarray(direction)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        sources = np.repeat(np.arange(cells), np.diff(offsets)) # Cell each move starts from
+        self.successors = np.full((cells, len(NEIGHBORS)), -1, dtype=np.int32) # Legal moves out of every cell, -1 for none
+        self.successors[sources, np.arange(len(sources)) - offsets[sources]] = targets
+        self.light_cells = np.asarray(lights, dtype=np.int64)
+        self.red = np.zeros(cells, dtype=bool) # Cells with a red light
+        self.occupant = np.full(cells, -1, dtype=np.int32) # Slot of the car in every cell, -1 if it's empty
+        self.seed = seed
+        self.ticks = 0 # Steps done
+
+        self.position = np.zeros(capacity, dtype=np.int32) # Cell of each car
+        self.destination = np.zeros(capacity, dtype=np.int32) # Destination id of each car
+        self.greediness = np.zeros(capacity, dtype=np.int32) # Chance of running a red light
+        self.stay = np.zeros(capacity, dtype=np.int32) # Steps spent without moving, like Car.cont_stay
+        self.number = np.zeros(capacity, dtype=np.int64) # Number in the id of each car, Car_<number>
+        self.detour = np.zeros(capacity, dtype=bool) # Cars that go around the car in front at their next move
+        self.alive = np.zeros(capacity, dtype=bool) # Slots in use
+        self.born = np.zeros(capacity, dtype=np.int64) # Step each car entered the map
+        self.free = [] # Slots of the cars that left
+        self.count = 0 # Slots used so far
+        self.arrivals = 0 # Cars that reached their destination
+
+    def grow(self):
+        """
+        Doubles the size of the car arrays.
+        """
+        for name in ("position", "destination", "greediness", "stay", "number", "detour", "alive", "born"):
+            old = getattr(self, name)
+            new = np.zeros(len(old) * 2, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, cell, destination, number, greediness = None, stay = 0, detour = False, born = None):
+        """
+        Adds a car at a cell going to a destination id. New cars draw their greediness and are born at the current step.
+        """
+        if self.free: # Reuse the slot of a car that left
+            slot = self.free.pop()
+        else:
+            if self.count == len(self.alive):
+                self.grow()
+            slot = self.count
+            self.count += 1
+        if self.tables.row[destination] < 0: # First car going there
+            self.tables.build(destination)
+        if greediness is None: # Like random.randint(0, 100)
+            greediness = int(draw(self.seed, 0, number, GREEDINESS) % np.uint64(101))
+        self.position[slot] = cell
+        self.destination[slot] = destination
+        self.greediness[slot] = greediness
+        self.stay[slot] = stay
+        self.number[slot] = number
+        self.detour[slot] = detour
+        self.alive[slot] = True
+        self.born[slot] = self.ticks if born is None else born
+        self.occupant[cell] = slot
+        return slot
+
+    def discard(self, slots):
+        """
+        Takes cars out of the arrays, the cells they were in are left as they are.
+        """
+        self.alive[slots] = False
+        self.free.extend(slots.tolist())
+
+    def slots(self):
+        """
+        Returns the slots of the cars in the fleet.
+        """
+        return np.flatnonzero(self.alive[:self.count])
+
+    def ranks(self, cars, tick):
+        """
+        Returns the order the cars act in at a step, lower first.
+        """
+        return draw(self.seed, tick, self.number[cars], RANK)
+
+    def intend(self, cars, occupied, tick):
+        """
+        Intent phase: the same rules as Car.move, for every car at once.
+        Only the cells up to two moves away from the cars are read from occupied.
+        Returns the cell, destination id and the cell each car wants to move to.
+        """
+        pos = self.position[cars]
+        dest = self.destination[cars]
+        width = self.width
+        careless = draw(self.seed, tick, self.number[cars], CARELESS) % np.uint64(201) < self.greediness[cars].astype(np.uint64) # descuido
+        row = self.tables.row[dest] # Table of the destination of each car
+        codes = self.tables.codes
+        hop = codes[row, pos]
+        routed = hop != NO_HOP # Cars that can still reach their destination
+        next = pos + self.moves[hop]
+        target = np.where(routed & ~(self.red[next] & ~careless), next, pos) # Wait behind a red light
+
+        moving = target != pos
+        hop = codes[row, target]
+        has_after = moving & (hop != NO_HOP) # Cell after the next one, none at the destination
+        after = np.where(has_after, target + self.moves[hop], pos)
+        here, there = self.direction[pos], self.direction[after]
+        same_road = (here == there) | (here == 0) # Car.needs_lane_change only looks at these
+        dx = after % width - pos % width
+        dy = after // width - pos // width
+        lane_change = moving & has_after & ~careless & ~occupied[next] & ~occupied[after] & same_road & ((np.isin(there, VERTICAL) & (dx != 0)) | (np.isin(there, HORIZONTAL) & (dy != 0)))
+        target = np.where(lane_change, after, target)
+
+        detour = self.detour[cars] & moving & occupied[next] # Cars that got stuck behind another car go around it
+        self.detour[cars] = False
+        if detour.any(): # Take the closest free cell that still leads to the destination
+            options = self.successors[pos[detour]] # Moves out of the cell of each stuck car
+            valid = options >= 0
+            options = np.where(valid, options, 0)
+            left = self.tables.distance[row[detour][:, None], options] # Moves to the destination from each option
+            valid &= ~occupied[options] & (left != FAR)
+            left = np.where(valid, left, FAR)
+            best = np.argmin(left, axis=1)
+            found = valid[np.arange(len(best)), best]
+            sidestep = target[detour]
+            sidestep[found] = options[np.arange(len(best)), best][found]
+            target[detour] = sidestep
+        return pos, dest, target
+
+    def commit(self, cars, pos, target, rank):
+        """
+        Commit phase: cars act in the order of their rank, like RandomActivation, and a car only gets into a cell
+        that was empty or that was left by a car that acted before it, and only if nobody got there first.
+        Returns which cars move.
+        """
+        local = np.full(len(self.alive), -1, dtype=np.int64) # Position in cars of every slot
+        local[cars] = np.arange(cars.size)
+        movers = np.flatnonzero(target != pos)
+        movers = movers[np.lexsort((rank[movers], target[movers]))] # Movers grouped by target, first to act first
+        group = np.ones(movers.size, dtype=bool) # Where each group starts
+        group[1:] = target[movers[1:]] != target[movers[:-1]]
+        group = np.cumsum(group) - 1 # Group of each mover
+        ahead = self.occupant[target[movers]]
+        ahead = np.where(ahead >= 0, local[np.maximum(ahead, 0)], -1) # Car in the target cell before the step
+        state = np.full(cars.size, -1, dtype=np.int8) # 1 moves, -1 stays, 0 not decided yet
+        state[movers] = 0
+        while movers.size:
+            pending = state[movers] == 0
+            if not pending.any():
+                break
+            known = (ahead < 0) | (state[ahead] != 0) # The car in the target cell, if any, already moved or stayed
+            eligible = known & ((ahead < 0) | ((state[ahead] == 1) & (rank[movers] > rank[ahead]))) # The cell is free when the mover acts
+            winner = first_claimers(group, eligible)
+            decide = pending & known
+            if not decide.any(): # Cars waiting for each other in a circle stay
+                state[movers[pending]] = -1
+                break
+            state[movers[decide]] = np.where(winner[decide], 1, -1)
+        return state == 1
+
+    def settle(self, cars, pos, dest, target, moved):
+        """
+        Moves the cars that got their cell and updates how long the others have been stuck.
+        The cars that reached their destination are taken out.
+        Returns the new cell of every car and which of them arrived.
+        """
+        new = np.where(moved, target, pos)
+        stay = self.stay[cars] + ~moved
+        stuck = stay > 2 # Cars that would reroute in Car.move
+        stay[stuck] = 0
+        self.stay[cars] = stay
+        self.detour[cars[stuck]] = True
+
+        self.occupant[pos[moved]] = -1
+        self.occupant[new[moved]] = cars[moved]
+        self.position[cars] = new
+        arrived = new == self.goals[dest] # Cars that reached their destination leave the map
+        if arrived.any():
+            self.occupant[new[arrived]] = -1
+            self.discard(cars[arrived])
+            self.arrivals += int(arrived.sum())
+        return new, arrived
+
+class FleetEngine(FleetCore):
+    """
+    Moves all the cars of a model at once, keeping them in arrays instead of agents.
+    """
+    def __init__(self, model, capacity = 1024, tables = None):
+        """
+        Creates a new engine for the map of a model.
+        Args:
+            model: CityModel with the map, the traffic lights and the occupancy layer
+            capacity: How many cars fit before the arrays grow
+            tables: RoutingTables of another fleet on the same map, to share the rows it already built
+        """
+        self.model = model
+        graph = model.road_graph
+        layers = model.layers
+        if model.compiled_map is not None: # Read the moves straight from the mapped file
+            arrays = compiled_tables(model.compiled_map)
+        else:
+            arrays = graph.csr() + (layers.direction.T.ravel(), [graph.index(pos) for pos in layers.destinations],
+                                    [graph.index(pos) for pos in layers.lights])
+        super().__init__(graph.width, graph.height, *arrays, model.random.getrandbits(64), capacity, tables)
+
+    def spawn(self, pos, destination, number):
+        """
+        Adds a car at pos going to the destination cell.
+        """
+        self.model.layers.occupancy[pos] += 1
+        return self.add(self.model.road_graph.index(pos), self.model.layers.destination[destination], number)
+
+    def step(self):
+        """
+        Moves every car one step.
+        """
+        tick = self.ticks
+        self.ticks += 1
+        cars = self.slots() # Slots of the cars in the map
+        if cars.size == 0:
+            return
+        self.red[self.light_cells] = ~light_states(self.model)
+        pos, dest, target = self.intend(cars, self.occupant >= 0, tick)
+        moved = self.commit(cars, pos, target, self.ranks(cars, tick))
+        new, arrived = self.settle(cars, pos, dest, target, moved)
+
+        width = self.width
+        occupancy = self.model.layers.occupancy
+        np.subtract.at(occupancy, (pos[moved] % width, pos[moved] // width), 1)
+        np.add.at(occupancy, (new[moved] % width, new[moved] // width), 1)
+        np.subtract.at(occupancy, (new[arrived] % width, new[arrived] // width), 1)
+        self.model.car_removed += int(arrived.sum())
+        if self.model.metrics.enabled:
+            self.model.metrics.count("fleet_moves", int(moved.sum()))
+            self.model.metrics.count("fleet_stays", int(moved.size - moved.sum()))
+        gone = cars[arrived] # The slots keep their values until reused
+        self.model.finish_trips(self.number[gone].tolist(), dest[arrived].tolist(), (tick - self.born[gone]).tolist())
+
+    def cars(self):
+        """
+        Returns the id and cell of every car in the map.
+        """
+        cars = self.slots()
+        return [(f"Car_{number}", (cell % self.width, cell // self.width)) for number, cell in zip(self.number[cars].tolist(), self.position[cars].tolist())]
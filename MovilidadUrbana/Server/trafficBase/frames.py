@@ -0,0 +1,82 @@
+import uuid
+from collections import OrderedDict
+import numpy as np
+
+class FrameHistory:
+    """
+    Cars and light states of a model at its last steps, to tell a client only what changed since
+    the last step it has. A client that is too far behind, has nothing yet or has frames of another
+    model (another session) gets a whole keyframe. Nothing is recorded until a client asks for frames with start.
+    """
+    def __init__(self, model, keep = 64):
+        """
+        Creates an empty history.
+        Args:
+            model: CityModel whose steps are recorded
+            keep: Steps kept, a client further behind than that gets a keyframe
+        """
+        self.model = model
+        self.keep = keep
+        self.session = uuid.uuid4().hex # Sent with every frame, the steps of two models can't be mixed up
+        self.frames = OrderedDict() # Cell of every car by id, and state of every light, at each recorded step
+        self.light_ids = [light.unique_id for light in model.traffic_lights] # Id of each light id
+        self.recording = False # Whether some client asked for frames, the steps are only kept from then on
+
+    def record(self):
+        """
+        Keeps the state of the model at its current step. Called after every step, does nothing before start.
+        """
+        if not self.recording:
+            return
+        model = self.model
+        self.frames[model.step_count] = (dict(model.car_positions()), np.array([light.state for light in model.traffic_lights], dtype=bool))
+        self.frames.move_to_end(model.step_count)
+        while len(self.frames) > self.keep:
+            self.frames.popitem(last = False)
+
+    def start(self):
+        """
+        Starts recording, from the current step. Called by every request for frames, only the first one does something.
+        """
+        if not self.recording:
+            self.recording = True
+            self.record()
+
+    def keyframe(self):
+        """
+        Returns every car and light of the current step, ready to be sent as JSON.
+        """
+        model = self.model
+        return {
+            "session": self.session, "step": model.step_count, "base": None, "keyframe": True,
+            "cars": [{"id": unique_id, "x": x, "y": 0, "z": z} for unique_id, (x, z) in model.car_positions()],
+            "lights": [{"id": light.unique_id, "x": light.pos[0], "y": 0, "z": light.pos[1], "state": light.state} for light in model.traffic_lights],
+        }
+
+    def delta(self, since, session):
+        """
+        Returns what changed between step since and the current step, ready to be sent as JSON:
+        the cars spawned and moved with their cell, the ids of the cars removed and the lights that toggled.
+        Returns a keyframe if since is from another session, wasn't recorded or is no longer kept.
+        Args:
+            since: Step of the last frame the client has
+            session: Session of that frame
+        """
+        step = self.model.step_count
+        if session != self.session or since is None or since not in self.frames or step not in self.frames:
+            return self.keyframe()
+        before, before_lights = self.frames[since]
+        now, lights = self.frames[step]
+        spawned, moved = [], []
+        for unique_id, (x, z) in now.items():
+            old = before.get(unique_id)
+            if old is None:
+                spawned.append({"id": unique_id, "x": x, "y": 0, "z": z})
+            elif old != (x, z):
+                moved.append({"id": unique_id, "x": x, "y": 0, "z": z})
+        return {
+            "session": self.session, "step": step, "base": since, "keyframe": False,
+            "spawned": spawned, "moved": moved,
+            "removed": [unique_id for unique_id in before if unique_id not in now],
+            "lights": [{"id": self.light_ids[light], "state": bool(lights[light])} for light in np.flatnonzero(lights != before_lights).tolist()],
+        }
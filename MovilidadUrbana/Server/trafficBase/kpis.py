@@ -0,0 +1,306 @@
+import csv
+import os
+import queue
+import threading
+import numpy as np
+
+MOVES = {"Right": (1, 0), "Left": (-1, 0), "Up": (0, 1), "Down": (0, -1)} # Cell a car on each road direction goes to
+FORMATS = ("csv", "npz", "parquet")
+
+class ColumnBuffer:
+    """
+    Preallocated columns that are filled one row (or a batch of rows) at a time.
+    """
+    def __init__(self, columns, capacity):
+        """
+        Creates empty columns.
+        Args:
+            columns: dtype and shape of one value of each column, {name: (dtype, shape)}
+            capacity: Rows that fit
+        """
+        self.columns = {name: np.zeros((capacity,) + tuple(shape), dtype=dtype) for name, (dtype, shape) in columns.items()}
+        self.capacity = capacity
+        self.size = 0 # Rows filled
+
+    def free(self):
+        """
+        Returns how many more rows fit.
+        """
+        return self.capacity - self.size
+
+    def append(self, values):
+        """
+        Writes the next row, values has one value per column.
+        """
+        for name, value in values.items():
+            self.columns[name][self.size] = value
+        self.size += 1
+
+    def extend(self, values, rows):
+        """
+        Writes the next rows, values has one array of rows values per column.
+        """
+        for name, value in values.items():
+            self.columns[name][self.size:self.size + rows] = value
+        self.size += rows
+
+    def view(self):
+        """
+        Returns the filled part of every column.
+        """
+        return {name: column[:self.size] for name, column in self.columns.items()}
+
+class ColumnRing:
+    """
+    Columns kept in a ring of preallocated buffers. A full buffer is handed to a writer and the next
+    free one is filled, so the memory never grows. If the writer falls behind, the step waits for it.
+    """
+    def __init__(self, name, columns, capacity, buffers, output):
+        """
+        Creates the ring.
+        Args:
+            name: Name of the table, passed to the writer
+            columns: dtype and shape of each column, see ColumnBuffer
+            capacity: Rows of each buffer
+            buffers: Buffers in the ring, at least 2 so one can be filled while another is written
+            output: Queue of the writer, it gets (name, buffer, ring) and gives the buffer back with release
+        """
+        self.name = name
+        self.output = output
+        self.free = queue.Queue() # Buffers ready to be filled
+        for buffer in range(max(buffers, 2)):
+            self.free.put(ColumnBuffer(columns, capacity))
+        self.current = self.free.get()
+        self.written = 0 # Rows handed to the writer
+
+    def append(self, values):
+        """
+        Writes one row.
+        """
+        self.current.append(values)
+        if not self.current.free():
+            self.flush()
+
+    def extend(self, values, rows):
+        """
+        Writes rows at once, values has one array per column.
+        """
+        start = 0
+        while start < rows:
+            count = min(self.current.free(), rows - start)
+            self.current.extend({name: value[start:start + count] for name, value in values.items()}, count)
+            start += count
+            if not self.current.free():
+                self.flush()
+
+    def flush(self):
+        """
+        Hands the current buffer to the writer, if it has rows, and takes the next free one.
+        """
+        if self.current.size == 0:
+            return
+        self.written += self.current.size
+        self.output.put((self.name, self.current, self))
+        self.current = self.free.get() # Waits for the writer if every buffer is full
+
+    def release(self, buffer):
+        """
+        Gives a written buffer back to the ring.
+        """
+        buffer.size = 0
+        self.free.put(buffer)
+
+class TableWriter:
+    """
+    Appends buffers of rows to one file per table, or to numbered NPZ files.
+    """
+    def __init__(self, prefix, format):
+        """
+        Args:
+            prefix: Path of the files without the table name, <prefix>_<table>.<format>
+            format: "csv", "npz" or "parquet", which needs pyarrow
+        """
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format: {format}")
+        if format == "parquet": # Only this format needs pyarrow, checked here so a missing one fails before the run
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError as error:
+                raise ImportError("The parquet format needs pyarrow (pip install pyarrow), or use csv or npz") from error
+        self.prefix = prefix
+        self.format = format
+        self.files = {} # Open file or parquet writer of each table
+        self.chunks = {} # NPZ files written of each table
+
+    def flat(self, columns):
+        """
+        Splits the columns with more than one value per row into one column per value, name_0, name_1...
+        """
+        flat = {}
+        for name, column in columns.items():
+            if column.ndim == 1:
+                flat[name] = column
+            else:
+                for i in range(column.shape[1]):
+                    flat[f"{name}_{i}"] = column[:, i]
+        return flat
+
+    def write(self, table, columns):
+        """
+        Appends rows to a table.
+        """
+        if self.format == "npz": # A numbered file per buffer, columns keep their shape
+            chunk = self.chunks.get(table, 0)
+            np.savez(f"{self.prefix}_{table}_{chunk:05d}.npz", **columns)
+            self.chunks[table] = chunk + 1
+            return
+        columns = self.flat(columns)
+        if self.format == "csv":
+            if table not in self.files:
+                self.files[table] = open(f"{self.prefix}_{table}.csv", "w", newline="")
+                csv.writer(self.files[table]).writerow(list(columns))
+            csv.writer(self.files[table]).writerows(zip(*(column.tolist() for column in columns.values())))
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            batch = pyarrow.table({name: pyarrow.array(column) for name, column in columns.items()})
+            if table not in self.files:
+                self.files[table] = pyarrow.parquet.ParquetWriter(f"{self.prefix}_{table}.parquet", batch.schema)
+            self.files[table].write_table(batch)
+
+    def close(self):
+        """
+        Closes every file.
+        """
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+class KPICollector:
+    """
+    Records the KPIs of every step and every trip of a model into columnar ring buffers,
+    written to disk in bulk by a background thread.
+    Steps table: step, cars in the map, cars spawned and arrived at the step, mean, p50 and p95 travel time
+    of the trips that ended at the step and the queue behind every traffic light.
+    Trips table: step it ended, car number, destination id and travel time.
+    Attach it with model.collector = KPICollector(model, prefix) and call close at the end of the run.
+    """
+    def __init__(self, model, prefix, format = "csv", capacity = 4096, buffers = 2, max_queue = 20):
+        """
+        Creates the collector and starts its writer thread.
+        Args:
+            model: CityModel to record
+            prefix: Path of the output files without the table name and extension
+            format: "csv", "npz" or "parquet" (needs pyarrow)
+            capacity: Rows of every buffer
+            buffers: Buffers in each ring, the memory used is fixed
+            max_queue: Cells behind each traffic light where the queue is counted
+        """
+        self.model = model
+        self.writer = TableWriter(prefix, format)
+        folder = os.path.dirname(prefix)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.queue_cells = self.approaches(max_queue)
+        lights = len(model.layers.lights)
+        self.output = queue.Queue()
+        self.steps = ColumnRing("steps", {
+            "step": (np.int64, ()), "cars": (np.int64, ()), "spawned": (np.int64, ()), "arrived": (np.int64, ()),
+            "travel_mean": (np.float64, ()), "travel_p50": (np.float64, ()), "travel_p95": (np.float64, ()),
+            "queue": (np.int32, (lights,)),
+        }, capacity, buffers, self.output)
+        self.trips = ColumnRing("trips", {
+            "step": (np.int64, ()), "car": (np.int64, ()), "destination": (np.int32, ()), "travel": (np.int64, ()),
+        }, capacity, buffers, self.output)
+        self.step_trips = [] # Travel times of the trips that ended in the current step
+        self.last_spawned = model.num_agents # Cars created before the current step
+        self.last_removed = model.car_removed # Cars arrived before the current step
+        self.error = None # Exception raised by the writer thread
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def approaches(self, length):
+        """
+        Returns the cells where the queue of each traffic light forms, up to length cells straight back from it,
+        as x and y index arrays of shape (lights, length), and which of them are real cells.
+        """
+        graph = self.model.road_graph
+        cells = np.zeros((len(self.model.layers.lights), length, 2), dtype=np.int64)
+        valid = np.zeros((len(self.model.layers.lights), length), dtype=bool)
+        for light, pos in enumerate(self.model.layers.lights):
+            for k in range(length):
+                behind = [prev for prev in graph.predecessors(pos) # The road cell that leads straight into pos
+                          if graph.direction(prev) in MOVES and (prev[0] + MOVES[graph.direction(prev)][0], prev[1] + MOVES[graph.direction(prev)][1]) == pos]
+                if not behind:
+                    break
+                pos = behind[0]
+                cells[light, k] = pos
+                valid[light, k] = True
+        return cells[:, :, 0], cells[:, :, 1], valid
+
+    def add_trips(self, step, numbers, destinations, times):
+        """
+        Records the trips that ended at a step.
+        """
+        count = len(times)
+        if count == 0:
+            return
+        times = np.asarray(times, dtype=np.int64)
+        self.step_trips.append(times)
+        self.trips.extend({"step": np.full(count, step), "car": np.asarray(numbers, dtype=np.int64),
+                           "destination": np.asarray(destinations, dtype=np.int32), "travel": times}, count)
+
+    def collect(self):
+        """
+        Records the aggregates of the step that just ended.
+        """
+        model = self.model
+        xs, ys, valid = self.queue_cells
+        occupied = (model.layers.occupancy[xs, ys] > 0) & valid
+        queues = np.cumprod(occupied, axis=1).sum(axis=1) # Cars in a row right behind each light
+        mean = p50 = p95 = np.nan # No trip ended at this step
+        if self.step_trips:
+            times = np.concatenate(self.step_trips)
+            mean = times.mean()
+            p50, p95 = np.percentile(times, (50, 95))
+            self.step_trips = []
+        self.steps.append({
+            "step": model.step_count, "cars": int(model.layers.occupancy.sum()),
+            "spawned": model.num_agents - self.last_spawned, "arrived": model.car_removed - self.last_removed,
+            "travel_mean": mean, "travel_p50": p50, "travel_p95": p95, "queue": queues,
+        })
+        self.last_spawned = model.num_agents
+        self.last_removed = model.car_removed
+        if self.error is not None:
+            raise self.error
+
+    def write(self):
+        """
+        Loop of the writer thread.
+        """
+        while True:
+            item = self.output.get()
+            if item is None:
+                break
+            name, buffer, ring = item
+            try:
+                if self.error is None:
+                    self.writer.write(name, buffer.view())
+            except Exception as error: # Raised in the stepping thread at the next step
+                self.error = error
+            ring.release(buffer)
+
+    def close(self):
+        """
+        Writes the rows left and waits for the writer to finish.
+        """
+        self.steps.flush()
+        self.trips.flush()
+        self.output.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.model.collector is self:
+            self.model.collector = None
+        if self.error is not None:
+            raise self.error
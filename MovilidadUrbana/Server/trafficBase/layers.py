@@ -0,0 +1,77 @@
+import copy
+import numpy as np
+
+EMPTY, ROAD, OBSTACLE, TRAFFIC_LIGHT, DESTINATION = range(5) # Kind of each cell
+DIRECTIONS = (None, "Right", "Left", "Up", "Down") # Road direction of each code
+
+class MapLayers:
+    """
+    Typed arrays with the static layout of the map and the cars in each cell.
+    Every layer is indexed like the grid, layer[x, y].
+    """
+    def __init__(self, width, height):
+        """
+        Creates empty layers.
+        Args:
+            width, height: The size of the map
+        """
+        self.width = width
+        self.height = height
+        self.kind = np.zeros((width, height), dtype=np.uint8) # What is in each cell
+        self.direction = np.zeros((width, height), dtype=np.uint8) # Index in DIRECTIONS of each road
+        self.light = np.full((width, height), -1, dtype=np.int32) # Traffic light id of each cell, -1 if there is none
+        self.destination = np.full((width, height), -1, dtype=np.int32) # Destination id of each cell, -1 if there is none
+        self.occupancy = np.zeros((width, height), dtype=np.int32) # Number of cars in each cell
+        self.lights = [] # Cell of each traffic light id
+        self.destinations = [] # Cell of each destination id
+
+    def without_cars(self):
+        """
+        Returns layers that share the static arrays of these ones, with no cars.
+        """
+        layers = copy.copy(self)
+        layers.occupancy = np.zeros_like(self.occupancy)
+        return layers
+
+    def add_road(self, pos, direction):
+        """
+        Marks a cell as a road going in direction.
+        """
+        self.kind[pos] = ROAD
+        self.direction[pos] = DIRECTIONS.index(direction)
+
+    def add_obstacle(self, pos):
+        """
+        Marks a cell as an obstacle.
+        """
+        self.kind[pos] = OBSTACLE
+
+    def add_light(self, pos):
+        """
+        Marks a cell as a traffic light and returns its id.
+        """
+        self.kind[pos] = TRAFFIC_LIGHT
+        self.light[pos] = len(self.lights)
+        self.lights.append(pos)
+        return self.light[pos]
+
+    def add_destination(self, pos):
+        """
+        Marks a cell as a destination and returns its id.
+        """
+        self.kind[pos] = DESTINATION
+        self.destination[pos] = len(self.destinations)
+        self.destinations.append(pos)
+        return self.destination[pos]
+
+    def cells(self, kind):
+        """
+        Returns the cells of one kind, ordered by x and then y.
+        """
+        return [(int(x), int(y)) for x, y in np.argwhere(self.kind == kind)]
+
+    def road_direction(self, pos):
+        """
+        Returns the direction of the road at pos, None if it isn't a road.
+        """
+        return DIRECTIONS[self.direction[pos]]
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from layers import MapLayers, ROAD, TRAFFIC_LIGHT, DESTINATION
+from roadgraph import RoadGraph
+from routing import RoutingTables
+
+FORMAT_VERSION = 2 # Changes every time the layout of the compiled maps changes
+CITY_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "trafficBase", "city_files") # Maps shared by both servers
+CACHE_DIR = os.path.join(CITY_FILES, "compiled") # Where the compiled maps are kept
+
+def parse_map(map_path, dictionary_path):
+    """
+    Reads a text map, where each character is a cell, and its dictionary.
+    Returns the layers of the map and the (initial state, timeToChange) of each traffic light id.
+    """
+    dataDictionary = json.load(open(dictionary_path)) # Maps the characters in the map file to what they are
+    with open(map_path) as baseFile:
+        width = len(baseFile.readline().rstrip("\n")) # Width of the map
+        height = 1 + sum(1 for line in baseFile) # Height of the map
+    layers = MapLayers(width, height)
+    lights = [] # Initial state and time to change of each traffic light
+    with open(map_path) as baseFile: # Read it again line by line, big maps are never held whole
+        for r, row in enumerate(baseFile): # The first line is the top of the grid
+            for c, col in enumerate(row.rstrip("\n")):
+                pos = (c, height - r - 1)
+                if col in ["v", "^", ">", "<"]:
+                    layers.add_road(pos, dataDictionary[col])
+                elif col in ["S", "s"]:
+                    layers.add_light(pos) # The id of the light is its index in traffic_lights
+                    lights.append((col == "s", int(dataDictionary[col]))) # "S" starts red, "s" starts green
+                elif col == "#":
+                    layers.add_obstacle(pos)
+                elif col == "D":
+                    layers.add_destination(pos)
+    return layers, lights
+
+def map_hash(map_path, dictionary_path):
+    """
+    Returns the content hash that names the compiled version of a map.
+    """
+    digest = hashlib.sha256(f"version {FORMAT_VERSION}\n".encode())
+    for path in (dictionary_path, map_path):
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(b"\0") # Keep the two files apart
+    return digest.hexdigest()
+
+def compile_map(map_path, dictionary_path, cache_dir = CACHE_DIR):
+    """
+    Compiles a text map into a folder with its layers and road graph as .npy arrays.
+    The routing tables aren't stored, they are built per destination when a model asks for them.
+    The folder is named after the content hash, so a map is only compiled once. Returns its path.
+    """
+    key = map_hash(map_path, dictionary_path)
+    path = os.path.join(cache_dir, key)
+    if os.path.isdir(path):
+        return path
+    layers, lights = parse_map(map_path, dictionary_path)
+    graph = RoadGraph.from_layers(layers)
+    offsets, targets = graph.csr() # Successors of index i are targets[offsets[i]:offsets[i + 1]]
+    arrays = {
+        "kind": layers.kind, "direction": layers.direction, "light": layers.light, "destination": layers.destination,
+        "offsets": offsets, "targets": targets,
+    }
+    meta = {
+        "version": FORMAT_VERSION, "hash": key, "source": os.path.basename(map_path),
+        "width": layers.width, "height": layers.height,
+        "lights": [[x, y, state, time] for (x, y), (state, time) in zip(layers.lights, lights)],
+        "destinations": [list(pos) for pos in layers.destinations],
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    building = tempfile.mkdtemp(dir=cache_dir) # Written aside and renamed, so a half written map is never loaded
+    try:
+        for name, values in arrays.items():
+            np.save(os.path.join(building, f"{name}.npy"), values)
+        with open(os.path.join(building, "meta.json"), "w") as file:
+            json.dump(meta, file)
+        os.rename(building, path)
+    except OSError:
+        shutil.rmtree(building, ignore_errors=True)
+        if not os.path.isdir(path): # Another process may have compiled it first
+            raise
+    return path
+
+class CompiledMap:
+    """
+    Map compiled by compile_map. The arrays are memory-mapped the first time they are used,
+    so every process that loads the same map shares the same pages.
+    """
+    def __init__(self, path):
+        """
+        Opens a compiled map.
+        Args:
+            path: Folder returned by compile_map
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as file:
+            self.meta = json.load(file)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Compiled map {path} has version {self.meta['version']}, expected {FORMAT_VERSION}")
+        self.width = self.meta["width"]
+        self.height = self.meta["height"]
+        self.arrays = {} # Arrays mapped so far
+
+    def array(self, name):
+        """
+        Returns one of the stored arrays, read-only.
+        """
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r").view(np.ndarray) # Plain array over the mapped file
+        return self.arrays[name]
+
+    def layers(self):
+        """
+        Returns the layers of the map. The static ones are the mapped arrays, only the occupancy is new.
+        """
+        layers = MapLayers(self.width, self.height)
+        layers.kind = self.array("kind")
+        layers.direction = self.array("direction")
+        layers.light = self.array("light")
+        layers.destination = self.array("destination")
+        layers.lights = [(x, y) for x, y, state, time in self.meta["lights"]]
+        layers.destinations = [tuple(pos) for pos in self.meta["destinations"]]
+        return layers
+
+    def lights(self):
+        """
+        Returns the (initial state, timeToChange) of each traffic light id.
+        """
+        return [(state, time) for x, y, state, time in self.meta["lights"]]
+
+    def road_graph(self, layers):
+        """
+        Returns the road graph, rebuilt from the stored moves instead of checking every neighbor.
+        """
+        kind = self.array("kind")
+        directions = {pos: layers.road_direction(pos) for pos in layers.cells(ROAD)}
+        offsets, targets = self.array("offsets").tolist(), self.array("targets").tolist()
+        successors = {} # Same order as RoadGraph.from_layers
+        for x, y in np.argwhere((kind == ROAD) | (kind == TRAFFIC_LIGHT) | (kind == DESTINATION)).tolist():
+            i = y * self.width + x
+            successors[(x, y)] = [(j % self.width, j // self.width) for j in targets[offsets[i]:offsets[i + 1]]]
+        return RoadGraph(self.width, self.height, directions, successors)
+
+    def routing_tables(self, distances = False):
+        """
+        Returns the next-hop tables of every destination, over the stored moves. Each one is built the first time it is used.
+        """
+        return RoutingTables(self.width, self.height, self.array("offsets"), self.array("targets"),
+                             [y * self.width + x for x, y in self.meta["destinations"]], distances)
+
+LOADED = {} # Maps already opened by this process, by content hash
+
+def load_map(map_path, dictionary_path, cache_dir = CACHE_DIR):
+    """
+    Returns the compiled version of a text map, compiling it the first time.
+    """
+    path = compile_map(map_path, dictionary_path, cache_dir)
+    if path not in LOADED:
+        LOADED[path] = CompiledMap(path)
+    return LOADED[path]
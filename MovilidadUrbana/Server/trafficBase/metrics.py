@@ -0,0 +1,236 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+class SamplingProfiler:
+    """
+    Profiler that looks at the stack of one thread at a fixed interval from a thread of its own.
+    It costs the same whatever the code does, unlike cProfile that traces every call.
+    """
+    def __init__(self, interval = 0.001):
+        """
+        Creates a stopped profiler.
+        Args:
+            interval: Seconds between samples
+        """
+        self.interval = interval
+        self.samples = 0 # Stacks looked at
+        self.own = Counter() # Samples where each function was running
+        self.total = Counter() # Samples where each function was in the stack
+        self.thread = None # Thread that takes the samples
+        self.target = None # Id of the thread sampled
+        self.active = False # Whether the samples are being taken
+        self.closed = False
+
+    def enable(self):
+        """
+        Starts sampling the thread that calls it.
+        """
+        self.target = threading.get_ident()
+        self.active = True
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        """
+        Loop of the sampling thread.
+        """
+        while not self.closed:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.target) if self.active else None
+            if frame is not None:
+                self.samples += 1
+                self.own[self.name(frame)] += 1
+                seen = set() # Recursive functions are counted once per sample
+                while frame is not None:
+                    name = self.name(frame)
+                    if name not in seen:
+                        seen.add(name)
+                        self.total[name] += 1
+                    frame = frame.f_back
+
+    def name(self, frame):
+        """
+        Returns the name a function is reported with.
+        """
+        code = frame.f_code
+        return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+    def disable(self):
+        """
+        Pauses sampling.
+        """
+        self.active = False
+
+    def close(self):
+        """
+        Stops the sampling thread.
+        """
+        self.active = False
+        self.closed = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def report(self, limit = 30):
+        """
+        Returns the functions seen the most, as text.
+        """
+        lines = [f"{self.samples} samples every {self.interval * 1000:g} ms", f"{'own':>7} {'total':>7}  function"]
+        for name, total in self.total.most_common(limit):
+            lines.append(f"{self.own[name] / max(self.samples, 1):>7.1%} {total / max(self.samples, 1):>7.1%}  {name}")
+        return "\n".join(lines)
+
+class StepMetrics:
+    """
+    Phase timers and event counters of a model, off by default.
+    The instrumented code checks enabled before measuring anything, so when it is off
+    a step only pays for those checks.
+    """
+    def __init__(self):
+        self.enabled = False # Whether the phases are timed and the events counted
+        self.times = {} # Seconds spent in each phase
+        self.calls = {} # Times each phase ran
+        self.counters = {} # Times each event happened
+        self.steps = 0 # Steps measured
+        self.start = 0 # When the current step started
+        self.last = 0 # When the current phase started
+        self.profiler = None # cProfile or SamplingProfiler running
+        self.profile_steps = 0 # Steps left to profile
+        self.profile_kind = None # Kind of the last profile
+        self.profile_report = None # Text of the last finished profile
+
+    def enable(self):
+        """
+        Starts timing and counting.
+        """
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stops timing and counting, what was measured is kept.
+        """
+        self.enabled = False
+
+    def reset(self):
+        """
+        Forgets everything measured so far.
+        """
+        self.times, self.calls, self.counters = {}, {}, {}
+        self.steps = 0
+
+    def active(self):
+        """
+        Returns the metrics if they are on, None otherwise. For the functions that take them as an argument.
+        """
+        return self if self.enabled else None
+
+    def count(self, name, amount = 1):
+        """
+        Adds to the counter of an event.
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add(self, phase, seconds):
+        """
+        Adds time to a phase.
+        """
+        self.times[phase] = self.times.get(phase, 0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def since(self, phase, start):
+        """
+        Adds the time since start, a time.perf_counter() value, to a phase.
+        """
+        self.add(phase, time.perf_counter() - start)
+
+    def begin(self):
+        """
+        Starts timing a step, the laps that follow are measured from here.
+        """
+        self.steps += 1
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, phase):
+        """
+        Adds the time since the last lap to a phase.
+        """
+        now = time.perf_counter()
+        self.add(phase, now - self.last)
+        self.last = now
+
+    def end(self):
+        """
+        Finishes timing a step.
+        """
+        self.add("step", time.perf_counter() - self.start)
+
+    def profile(self, steps, kind = "cprofile", interval = 0.001):
+        """
+        Profiles the next steps, whether the metrics are on or not. The report is kept in profile_report.
+        Args:
+            steps: Steps to profile
+            kind: "cprofile" to trace every call, "sampling" to look at the stack every interval seconds
+            interval: Seconds between samples of the sampling profiler
+        """
+        if kind not in ("cprofile", "sampling"):
+            raise ValueError(f"Unknown profiler: {kind}")
+        self.stop_profile()
+        self.profiler = cProfile.Profile() if kind == "cprofile" else SamplingProfiler(interval)
+        self.profile_kind = kind
+        self.profile_steps = steps
+
+    def profile_step(self):
+        """
+        Called at the start of every step while there are steps left to profile.
+        The profiler only runs during the steps, which may each be run by a different thread of the server.
+        """
+        self.profiler.enable()
+
+    def profile_step_end(self):
+        """
+        Called at the end of every step while there are steps left to profile.
+        """
+        self.profiler.disable()
+        self.profile_steps -= 1
+        if self.profile_steps <= 0:
+            self.stop_profile()
+
+    def stop_profile(self):
+        """
+        Keeps the report of the current profile and drops the profiler.
+        """
+        if self.profiler is None:
+            return
+        if isinstance(self.profiler, SamplingProfiler):
+            self.profiler.close()
+            self.profile_report = self.profiler.report()
+        elif not self.profiler.getstats(): # No step ran since the profile was asked for
+            self.profile_report = "No steps were profiled"
+        else:
+            text = io.StringIO()
+            pstats.Stats(self.profiler, stream=text).sort_stats("cumulative").print_stats(30)
+            self.profile_report = text.getvalue()
+        self.profiler = None
+        self.profile_steps = 0
+
+    def report(self):
+        """
+        Returns everything measured, ready to be sent as JSON.
+        """
+        step = self.times.get("step", 0)
+        return {
+            "enabled": self.enabled,
+            "steps": self.steps,
+            "phases": {phase: {"seconds": seconds, "calls": self.calls[phase], "mean_ms": seconds / self.calls[phase] * 1000,
+                               "share": seconds / step if step > 0 else None}
+                       for phase, seconds in sorted(self.times.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "profiling": self.profile_steps,
+            "profile": {"kind": self.profile_kind, "report": self.profile_report} if self.profile_report is not None else None,
+        }
@@ -2,99 +2,377 @@ from mesa import Model
 from mesa.time import RandomActivation
 from mesa.space import MultiGrid
 from agent import *
+from roadgraph import RoadGraph
+from layers import EMPTY, ROAD, OBSTACLE, TRAFFIC_LIGHT, DESTINATION
+from mapcompiler import CITY_FILES, CACHE_DIR, parse_map, load_map
+from routing import RouteCache, RoutingTables
+from replanning import DStarLite
+from contraction import ContractedGraph, ContractedPath
+from flatsearch import FlatAStar, ArrayPath
+from scheduling import EventScheduler
+from signals import SignalController
+from destinations import DestinationIndex
+from metrics import StepMetrics
 import json
 import os
+import numpy as np
 import requests
 
+OCCUPANCY_LOG_LIMIT = 4096 # Occupancy changes kept for the incremental planners
+CONGESTION_WEIGHT = 2 # Extra cost of entering a cell for every car in it
+STATIC_PREFIXES = {ROAD: "r", OBSTACLE: "ob", TRAFFIC_LIGHT: "tl", DESTINATION: "d"} # Prefix of the ids of the agents of each kind of cell
+
 class CityModel(Model):
     """ 
         Creates a model based on a city map.
 
         Args:
             N: Number of agents in the simulation
+            routing: "astar" to let every car search its own path, "table" to follow the shared next-hop tables,
+                "contracted" to search on the graph with the corridors collapsed,
+                "batch" to solve the paths of all the cars of a step together,
+                "congestion" to weigh every cell by the cars in it and the expected wait at red lights
+            route_cache_size: How many A* paths are kept for reuse, 0 disables the cache
+            reroute: "astar" to search again from scratch when a car is stuck, "incremental" to repair the car's last search
+            search: "dict" to run A* on dictionaries, "flat" to run it on reusable arrays of cell indices
+            static_agents: Whether roads, obstacles and destinations are also created as agents, the layers are always built.
+                The visualization server needs them, the simulation itself doesn't
+            engine: "agents" to move every car as its own agent, "fleet" to keep the cars in arrays and move them all at once,
+                "partitioned" to split the map into regions and move the cars of each one in its own process
+            scheduler: "random" to step every agent at every step, "event" to toggle the lights on timed events
+                and let the stopped cars sleep until the light or the car in front of them changes
+            signals: "agents" to let every traffic light toggle itself, "plan" to update them all at once from the signal plans
+            demand: DemandModel that decides when and where the cars enter, None to spawn at the corners every few steps
+            map_file: Map to load, in city_files unless it is an absolute path
+            map_cache: Folder with the compiled maps, None to parse the text map every time
+            regions: Regions along x and along y of the partitioned engine
+            seed: Seed of the model's random generator, every draw of the run comes from it. Read by mesa, a random one if None
+            _parent: Model with the same map and options whose static structures (layers, road graph, routing tables,
+                contracted graph, compiled map) are shared instead of built again. Only used by fork
     """
-    def __init__(self, N):
-#C:\Users\carlo\OneDrive\Escritorio\2023\ITESM\MULTIAGENTES\PROYECTOR\activities_TC2008B\MovilidadUrbana\Server\trafficBase\city_files
-        # Load the map dictionary. The dictionary maps the characters in the map file to the corresponding agent.
-        mapAbsPath = os.path.abspath("city_files/mapDictionary.json")#("MovilidadUrbana/Server/trafficBase/city_files/mapDictionary.json")
-        dataDictionary = json.load(open(mapAbsPath)) # Load the map dictionary. The dictionary maps the characters in the map file to the corresponding agent.
+    def __init__(self, N, routing = "astar", route_cache_size = 256, reroute = "astar", search = "dict", static_agents = True, engine = "agents", scheduler = "random", signals = "agents", demand = None, map_file = "2023_base.txt", map_cache = None, regions = (2, 2), seed = None, _parent = None):
+        self.options = dict(routing = routing, route_cache_size = route_cache_size, reroute = reroute, search = search, static_agents = static_agents,
+                            engine = engine, scheduler = scheduler, signals = signals, map_file = map_file, map_cache = map_cache, regions = regions) # To build the same model again from a snapshot
+        map_path = os.path.join(CITY_FILES, map_file) # Maps are found next to the code, not in the working directory
+        dictionary_path = os.path.join(CITY_FILES, "mapDictionary.json") # Maps the characters in the map file to the corresponding agent
+        self.compiled_map = None # Arrays of the compiled map, only with a cache
+        if map_cache is None and engine == "partitioned": # The workers map the compiled files
+            map_cache = CACHE_DIR
+        if _parent is not None: # The map never changes, only the cars in it are new
+            self.compiled_map = _parent.compiled_map
+            self.layers = _parent.layers.without_cars()
+            lights = [(light.state, light.timeToChange) for light in _parent.traffic_lights] # Overwritten by the snapshot
+        elif map_cache is not None: # Load the compiled map, it is only compiled the first time
+            self.compiled_map = load_map(map_path, dictionary_path, map_cache)
+            self.layers, lights = self.compiled_map.layers(), self.compiled_map.lights()
+        else: # Parse the text map
+            self.layers, lights = parse_map(map_path, dictionary_path)
+        self.width = self.layers.width # Width of the map
+        self.height = self.layers.height # Height of the map
 
         self.traffic_lights = [] # List of all the traffic lights
+        self.metrics = StepMetrics() # Phase timers and counters, off until enabled
         self.car_removed = 0 # Number of cars that have reached their destination
+        self.trip_times = [] # Steps each car that reached its destination spent in the map
+        self.cars = {} # Car agents in the map by id, in the order they were spawned
+        self.static_registry = {} if _parent is None else _parent.static_registry # Id and cell of every cell of each kind, built when first asked for
+
+        self.grid = MultiGrid(self.width, self.height, torus = False) # Create a grid with the width and height of the map
+        self.schedule = EventScheduler(self) if scheduler == "event" else RandomActivation(self) # Create the scheduler
+        self.add_map_agents(lights, static_agents, signals == "agents")
 
-        # Load the map file. The map file is a text file where each character represents an agent.
-        with open("city_files/2023_base.txt") as baseFile:#('MovilidadUrbana/Server/trafficBase/city_files/2022_base.txt') as baseFile:
-            lines = baseFile.readlines() # Read the lines of the map file
-            self.width = len(lines[0])-1 # Width of the map
-            self.height = len(lines) # Height of the map
-
-            self.grid = MultiGrid(self.width, self.height, torus = False) # Create a grid with the width and height of the map
-            self.schedule = RandomActivation(self) # Create a random activation scheduler
-
-            # Goes through each character in the map file and creates the corresponding agent.
-            for r, row in enumerate(lines): # Iterate through the lines of the map file
-                for c, col in enumerate(row): # Iterate through the characters of the line
-                    if col in ["v", "^", ">", "<"]: # If the character is a road,
-                        agent = Road(f"r_{r*self.width+c}", self, dataDictionary[col]) # Create a road agent
-                        self.grid.place_agent(agent, (c, self.height - r - 1)) # Place the agent on the grid
-
-                    elif col in ["S", "s"]: # If the character is a traffic light,
-                        agent = Traffic_Light(f"tl_{r*self.width+c}", self, False if col == "S" else True, int(dataDictionary[col])) # Create a traffic light agent
-                        self.grid.place_agent(agent, (c, self.height - r - 1)) # Place the agent on the grid
-                        self.schedule.add(agent) # Add the agent to the scheduler
-                        self.traffic_lights.append(agent) # Add the agent to the list of traffic lights
-
-                    elif col == "#": # If the character is an obstacle,
-                        agent = Obstacle(f"ob_{r*self.width+c}", self) # Create an obstacle agent
-                        self.grid.place_agent(agent, (c, self.height - r - 1)) # Place the agent on the grid
-
-                    elif col == "D": # If the character is a destination,
-                        agent = Destination(f"d_{r*self.width+c}", self) # Create a destination agent
-                        self.grid.place_agent(agent, (c, self.height - r - 1)) # Place the agent on the grid
-                        self.schedule.add(agent) # Add the agent to the scheduler
+        self.signals = SignalController.from_lights(self.traffic_lights, self.layers.lights) if signals == "plan" else None # Plans of every light
+        self.destinations = DestinationIndex(self.layers.destinations) # Demand weight of each destination, for the spawns
+        if _parent is not None:
+            self.road_graph = _parent.road_graph
+        elif self.compiled_map is not None: # The compiled map already has the moves out of every cell
+            self.road_graph = self.compiled_map.road_graph(self.layers)
+        else:
+            self.road_graph = RoadGraph.from_layers(self.layers) # Compile the static road layout once
+        self.routing = routing # How the cars plan their path
+        self.routing_tables = {} # Next-hop table of each destination
+        if _parent is not None: # Built the same way whatever model asks for them
+            self.routing_tables = _parent.routing_tables
+        elif routing == "table" and self.compiled_map is not None: # The compiled map already has the moves they are built on
+            self.routing_tables = self.compiled_map.routing_tables()
+        elif routing == "table": # Each table is built the first time a car goes to its destination
+            self.routing_tables = RoutingTables.from_graph(self.road_graph, self.layers.destinations)
+        self.search = search # Which A* implementation is used
+        self.route_requests = [] # Cars waiting for a path, with the type of path, solved together
+        if _parent is not None: # A search never stops halfway, so the two models can take turns with the same buffers
+            self.contracted_graph, self.flat_search, self.batch_router = _parent.contracted_graph, _parent.flat_search, _parent.batch_router
+        else:
+            self.contracted_graph = ContractedGraph(self.road_graph) if routing == "contracted" else None # Graph between intersections
+            self.flat_search = FlatAStar(self.road_graph) if search == "flat" else None # Buffers shared by every search
+            self.batch_router = None # Solves the waiting requests on a sparse matrix
+            if routing == "batch": # Only this mode needs scipy, it is imported when asked for
+                from batchrouting import BatchRouter
+                self.batch_router = BatchRouter(self.road_graph)
+        self.route_cache = RouteCache(route_cache_size) # Paths from the spawns, they never change
+        self.reroute_cache = RouteCache(route_cache_size) # Paths around the cars, cleared every step
+        self.reroute = reroute # How stuck cars find a new path
+        self.light_delays = {light.pos: light.timeToChange / 4 for light in self.traffic_lights} # Expected wait at each light: red half the time, for half a phase on average
+        if self.signals is not None: # The plans can have any cycle and green time
+            self.light_delays = dict(zip(self.layers.lights, self.signals.expected_delays().tolist()))
+        self.occupancy_log = [] # Cells whose occupancy changed, oldest first
+        self.occupancy_log_start = 0 # How many changes were dropped from the front of the log
+        self.fleet = None # Arrays with every car when they aren't agents
+        if engine == "fleet": # The forks share the routing rows built so far
+            from fleet import FleetEngine
+            self.fleet = FleetEngine(self, tables = _parent.fleet.tables if _parent is not None else None)
+        elif engine == "partitioned":
+            from partition import PartitionedFleet
+            self.fleet = PartitionedFleet(self, regions)
 
+        if demand is not None: # Its od matrix must have a column per destination of this map
+            demand.check(len(self.layers.destinations))
+        self.demand = demand # Arrivals and spawn queues of the cars
+        self.collector = None # Records the KPIs of every step and trip, see kpis.KPICollector
         self.num_agents = N # Number of agents in the simulation
         self.running = True # Whether the simulation is running or not
         self.step_count = 0 # Number of steps in the simulation
         
+    def add_map_agents(self, lights, static_agents, step_lights):
+        """
+        Creates the agents of the map, in the order of the map file.
+        Args:
+            lights: Initial state and time to change of each traffic light id
+            static_agents: Whether roads, obstacles and destinations are created too, the traffic lights always are
+            step_lights: Whether the traffic lights are added to the scheduler
+        """
+        if static_agents:
+            cells = np.argwhere(self.layers.kind[:, ::-1].T != EMPTY).tolist() # Row and column of every cell with something, row by row from the top
+        else:
+            cells = [[self.height - y - 1, x] for x, y in self.layers.lights] # The lights are already in file order
+        for r, c in cells:
+            pos = (c, self.height - r - 1) # Cell of the character, the first line is the top of the grid
+            kind = self.layers.kind[pos]
+            if kind == ROAD: # If the cell is a road,
+                agent = Road(f"r_{r*self.width+c}", self, self.layers.road_direction(pos)) # Create a road agent
+                self.grid.place_agent(agent, pos) # Place the agent on the grid
+
+            elif kind == TRAFFIC_LIGHT: # If the cell is a traffic light,
+                state, time = lights[self.layers.light[pos]] # The id of the light is its index in traffic_lights
+                agent = Traffic_Light(f"tl_{r*self.width+c}", self, state, time) # Create a traffic light agent
+                self.grid.place_agent(agent, pos) # Place the agent on the grid
+                if step_lights: # The signal plans change the lights without stepping them
+                    self.schedule.add(agent) # Add the agent to the scheduler
+                self.traffic_lights.append(agent) # Add the agent to the list of traffic lights
+
+            elif kind == OBSTACLE: # If the cell is an obstacle,
+                agent = Obstacle(f"ob_{r*self.width+c}", self) # Create an obstacle agent
+                self.grid.place_agent(agent, pos) # Place the agent on the grid
+
+            elif kind == DESTINATION: # If the cell is a destination,
+                agent = Destination(f"d_{r*self.width+c}", self) # Create a destination agent
+                self.grid.place_agent(agent, pos) # Place the agent on the grid
+                self.schedule.add(agent) # Add the agent to the scheduler
+
+    def set_light_time(self, time):
+        """
+        Changes how many steps every traffic light stays green and red. Meant to be called before the first step,
+        when every light toggles for the first time.
+        """
+        for light in self.traffic_lights:
+            light.timeToChange = time
+        self.light_delays = {light.pos: time / 4 for light in self.traffic_lights}
+        if self.signals is not None: # Same plans as SignalController.from_lights
+            self.signals.set_plan(np.arange(len(self.traffic_lights)), 2 * time, time, [time if light.state else 0 for light in self.traffic_lights])
+            self.light_delays = dict(zip(self.layers.lights, self.signals.expected_delays().tolist()))
+
     def set_destination(self):
         """
         Set the destination of the car.
         """
-        destinations = [] # List of all the destinations
-        for agent in self.schedule.agents: # Iterate through all the agents
-            if isinstance(agent, Destination): # If the agent is a destination,
-                destinations.append(agent.pos) # Add the position of the destination to the list of destinations
-        #print(f"Number of destinations: {len(destinations)}")
-        return self.random.choice(destinations) if destinations else None # Return a random destination if there are any destinations, otherwise return None
+        return self.destinations.sample(self.random) # Return a random destination weighted by its demand, None if none can be drawn
 
     def create_car(self):
         """
         Create cars agent and add them to the model.
         """
-        corners = [(0, 0), (self.width-1, 0), (0, self.height-2), (self.width-1, self.height-2)] # List of all the corners of the grid
-        for corner in corners: # Iterate through all the corners
+        for corner in self.corners(): # Iterate through all the corners
             #print(f"Placing car at: {corner}")
-            if 0 <= corner[0] < self.height and 0 <= corner[1] < self.width: # If the corner is valid,
-                cell_contents = self.grid.get_cell_list_contents([corner]) # Get the contents of the cell
-                if not any(isinstance(agent, Car) for agent in cell_contents):
+            if 0 <= corner[0] < self.width and 0 <= corner[1] < self.height: # If the corner is valid,
+                if not self.has_car(corner): # If there is no car in the corner,
                     destination = self.set_destination()  # Set the destination of the car
-                    agent = Car(f"Car_{self.num_agents + 1}", self, corner, destination)  # Create a unique ID for the car, and pass the model and the destination
-                    self.grid.place_agent(agent, corner)  # Place the car on the grid
-                    agent.initialize_path(0)  # Initialize the path after placing the car
-                    self.schedule.add(agent)  # Add the car to the scheduler
-                    self.num_agents += 1  # Increment the number of agents
+                    if destination is not None: # If some destination is enabled,
+                        self.spawn_car(corner, destination)
                 else:
                     print(f"There is already a car in corner: {corner}")
+                    if self.metrics.enabled:
+                        self.metrics.count("dropped_spawns")
             else: # If the corner is invalid,
                 print(f"Invalid corner: {corner}") # Print the invalid corner
     
+    def corners(self):
+        """
+        Returns the corners of the grid where the cars are spawned.
+        """
+        return [(0, 0), (self.width-1, 0), (0, self.height-2), (self.width-1, self.height-2)] # List of all the corners of the grid
+
+    def spawn_car(self, pos, destination):
+        """
+        Creates a car at pos going to destination. The cell has to be free.
+        """
+        if self.fleet is not None: # The car only lives in the fleet arrays
+            self.fleet.spawn(pos, destination, self.num_agents + 1)
+        else:
+            agent = Car(f"Car_{self.num_agents + 1}", self, pos, destination)  # Create a unique ID for the car, and pass the model and the destination
+            self.place_car(agent, pos)  # Place the car on the grid
+            self.cars[agent.unique_id] = agent
+            agent.initialize_path(0)  # Initialize the path after placing the car
+            self.schedule.add(agent)  # Add the car to the scheduler
+        self.num_agents += 1  # Increment the number of agents
+
+    def finish_trips(self, numbers, destinations, times):
+        """
+        Records the trips of the cars that reached their destination.
+        Args:
+            numbers: Number in the id of each car, Car_<number>
+            destinations: Destination id of each car
+            times: Steps each car spent in the map
+        """
+        self.trip_times.extend(times)
+        if self.collector is not None:
+            self.collector.add_trips(self.step_count, numbers, destinations, times)
+
+    def has_car(self, pos):
+        """
+        Checks if there is a car in the cell.
+        """
+        return self.layers.occupancy[pos] > 0
+
+    def congestion_cost(self, pos):
+        """
+        Cost of entering a cell: one move, plus the cars queued in it and the expected wait at a red light.
+        """
+        return 1 + CONGESTION_WEIGHT * int(self.layers.occupancy[pos]) + self.light_delays.get(pos, 0)
+
+    def occupy(self, pos, cars):
+        """
+        Adds cars to the occupancy of a cell (negative to take them out) and logs the change.
+        """
+        self.layers.occupancy[pos] += cars
+        self.occupancy_log.append(pos)
+        if cars < 0 and self.layers.occupancy[pos] == 0 and isinstance(self.schedule, EventScheduler): # Wake up the cars waiting for the cell
+            self.schedule.cell_changed(pos)
+
+    def wait(self, agent, reason):
+        """
+        Lets a stopped car sleep until the car or the traffic light in front of it changes, if the scheduler allows it.
+        It still wakes up when it would reroute, and a car at a red light when it would run it.
+        """
+        if not isinstance(self.schedule, EventScheduler):
+            return
+        if agent.cont_stay >= 2: # It would reroute at its next step anyway
+            return
+        until = self.schedule.steps + 3 - agent.cont_stay # Step when it would reroute
+        if isinstance(reason, Traffic_Light) and self.signals is not None: # The plan tells when the light changes
+            light = self.layers.light[reason.pos]
+            self.schedule.sleep(agent, until = min(until, self.signals.next_change(light, self.schedule.steps)), chance = agent.greediness / 201)
+        elif isinstance(reason, Traffic_Light):
+            self.schedule.sleep(agent, light = reason, until = until, chance = agent.greediness / 201) # descuido is randint(0, 200) < greediness
+        else:
+            self.schedule.sleep(agent, cell = reason, until = until)
+
+    def occupancy_changes(self, since):
+        """
+        Returns the cells whose occupancy changed since the log position since, and the current log position.
+        The cells are None if that part of the log was already dropped.
+        """
+        end = self.occupancy_log_start + len(self.occupancy_log) # Current log position
+        if since < self.occupancy_log_start: # If the log was trimmed,
+            return None, end
+        return set(self.occupancy_log[since - self.occupancy_log_start:]), end
+
+    def new_planner(self, start, goal):
+        """
+        Creates an incremental planner that avoids the cells occupied by cars.
+        """
+        return DStarLite(self.road_graph, start, goal, self.has_car)
+
+    def shortest_path(self, cache, start, goal, blocked = None):
+        """
+        Finds the path from start to goal with A*, reusing the paths kept in cache.
+        """
+        if self.search == "flat": # Every car follows the shared array with its own cursor
+            return ArrayPath(self.flat_search, cache.get(start, goal, lambda: self.flat_search.search(start, goal, blocked)))
+        return cache.get(start, goal, lambda: a_star_search(self.road_graph, start, goal, blocked, metrics = self.metrics.active()))
+
+    def request_route(self, agent, type):
+        """
+        Gives a spawned car its path at once, from the search kept for its destination,
+        and adds a stuck car to the routes around the other cars that will be solved together at the next step.
+        """
+        if type == 0: # The path from the spawn doesn't depend on the other cars, the car has it before it first moves
+            agent.path = self.batch_router.route(agent.spawn, agent.destination)
+            return
+        self.route_requests.append((agent, type))
+
+    def solve_routes(self):
+        """
+        Solves every waiting route request and gives the paths to the cars.
+        Spawned cars search from their spawn, stuck cars from where they are around the other cars.
+        """
+        requests, self.route_requests = self.route_requests, []
+        for type in (0, 1):
+            cars = [agent for agent, kind in requests if kind == type and agent.pos is not None] # Cars removed since asking don't need a path
+            blocked = None
+            if type == 1: # Avoid the cells with cars
+                blocked = self.layers.occupancy.T.ravel() > 0 # Flat cell indices go row by row
+            paths = self.batch_router.solve([(agent.spawn if type == 0 else agent.pos, agent.destination) for agent in cars], blocked)
+            for agent, path in zip(cars, paths):
+                if path or type == 0: # A stuck car keeps its path if there is no way around
+                    agent.path = path
+
+    def contracted_path(self, start, goal):
+        """
+        Creates a path that follows the cached route between intersections from start to goal.
+        """
+        return ContractedPath(self.route_cache.get(start, goal, lambda: self.contracted_graph.find_route(start, goal)))
+
+    def place_car(self, agent, pos):
+        """
+        Place a car on the grid.
+        """
+        self.grid.place_agent(agent, pos)
+        self.occupy(pos, 1)
+
+    def move_car(self, agent, pos):
+        """
+        Move a car to another cell.
+        """
+        if pos != agent.pos: # If the car actually moves,
+            self.occupy(agent.pos, -1)
+            self.occupy(pos, 1)
+        self.grid.move_agent(agent, pos)
+
     def remove_car(self, agent):
         """
         Remove a car from the model.
         """
+        self.occupy(agent.pos, -1)
         self.schedule.remove(agent) # Remove the agent from the scheduler
         self.grid.remove_agent(agent) # Remove the agent from the grid
+        self.cars.pop(agent.unique_id, None)
+
+    def car_positions(self):
+        """
+        Returns the id and cell of every car in the map, in time proportional to the number of cars.
+        """
+        if self.fleet is not None: # The cars only live in the fleet arrays
+            return self.fleet.cars()
+        return [(unique_id, agent.pos) for unique_id, agent in self.cars.items()]
+
+    def static_cells(self, kind):
+        """
+        Returns the id and cell of every cell of one kind (ROAD, OBSTACLE, TRAFFIC_LIGHT or DESTINATION), ordered by x and then y.
+        The ids are the ones their agents have, even when static_agents is off. Built once per kind, the map never changes.
+        """
+        if kind not in self.static_registry:
+            prefix = STATIC_PREFIXES[kind]
+            self.static_registry[kind] = [(f"{prefix}_{(self.height - y - 1) * self.width + x}", (x, y)) for x, y in self.layers.cells(kind)]
+        return self.static_registry[kind]
     def postCar(self):
         url = "http://52.1.3.19:8585/api/attempts" #http://52.1.3.19:8585/api/validate_attempt
 
@@ -114,15 +392,77 @@ class CityModel(Model):
         print("Request " + "successful" if response.status_code == 200 else "failed", "Status code:", response.status_code)
         print("Response:", response.json())
 
+    def metrics_report(self):
+        """
+        Returns the phase timers and counters, with the counters kept by the flat search.
+        """
+        report = self.metrics.report()
+        if self.flat_search is not None:
+            report["counters"]["flat_searches"] = self.flat_search.searches
+            report["counters"]["flat_expanded"] = self.flat_search.expanded
+        return report
+
+    def snapshot(self):
+        """
+        Returns the dynamic state of the model, see snapshot.take_snapshot.
+        """
+        from snapshot import take_snapshot
+        return take_snapshot(self)
+
+    def fork(self):
+        """
+        Returns a new model in the same state as this one, that runs on its own from here.
+        """
+        from snapshot import take_snapshot, restore_snapshot
+        return restore_snapshot(take_snapshot(self), parent = self)
+
     def step(self):
         '''Advance the model by one step.'''
+        metrics = self.metrics
+        timing = metrics.enabled # Checked once per phase, the only cost when the metrics are off
+        if metrics.profile_steps: # A profile was asked for
+            metrics.profile_step()
+        if timing:
+            metrics.begin()
         self.step_count += 1 # Increment the step count
         #print("step: ", self.step_count)
-        if self.step_count == 1:
-            self.create_car() # Create cars at the beginning of the simulation
-        if self.step_count % 3 == 0:
-            self.create_car()  # Create new cars every 10 steps
+        if self.demand is not None: # The demand model queues the arrivals and spawns them when their corner is free
+            self.demand.release(self, self.step_count)
+        else:
+            if self.step_count == 1:
+                self.create_car() # Create cars at the beginning of the simulation
+            if self.step_count % 3 == 0:
+                self.create_car()  # Create new cars every 10 steps
         if self.step_count % 100 == 0:
             print("CAR REMOVED", self.car_removed)
             #self.postCar() #Postea los carros que llegaron a su destino
-        self.schedule.step()
\ No newline at end of file
+        if timing:
+            metrics.lap("spawn")
+        self.reroute_cache.clear() # The cars have moved since the last reroutes
+        if self.route_requests: # Give a path to the cars stuck since the last step
+            self.solve_routes()
+        if len(self.occupancy_log) > OCCUPANCY_LOG_LIMIT: # Keep only the recent changes, planners that fall behind start over
+            dropped = len(self.occupancy_log) - OCCUPANCY_LOG_LIMIT // 2
+            del self.occupancy_log[:dropped]
+            self.occupancy_log_start += dropped
+        if timing:
+            metrics.lap("routes")
+        if self.signals is not None: # Set every light for this step, like the lights toggling themselves
+            self.signals.update(self.schedule.steps)
+        if timing:
+            metrics.lap("signals")
+        self.schedule.step()
+        if timing:
+            metrics.lap("agents")
+        if self.fleet is not None: # Move the cars after the lights changed, like the cars added last to the schedule
+            self.fleet.step()
+            if timing:
+                metrics.lap("fleet")
+        if self.collector is not None:
+            self.collector.collect()
+            if timing:
+                metrics.lap("collect")
+        if timing:
+            metrics.end()
+        if metrics.profile_steps:
+            metrics.profile_step_end()
@@ -0,0 +1,315 @@
+import multiprocessing
+import numpy as np
+from fleet import FleetCore, compiled_tables, first_claimers, light_states
+from mapcompiler import CompiledMap
+
+REACH = 2 # A car reads the cells up to two moves away: the next one, the one after it and the ones around it
+
+def split_map(width, height, regions):
+    """
+    Splits a map into rectangles. Returns the region id of every flat cell index, regions are numbered row by row.
+    """
+    columns = np.linspace(0, width, regions[0] + 1).astype(int) # Where each column of regions starts
+    rows = np.linspace(0, height, regions[1] + 1).astype(int) # Where each row of regions starts
+    x = np.searchsorted(columns, np.arange(width), side="right") - 1
+    y = np.searchsorted(rows, np.arange(height), side="right") - 1
+    return (y[:, None] * regions[0] + x[None, :]).ravel().astype(np.int32)
+
+def halo(owned, width, height, reach = REACH):
+    """
+    Returns the flat indices of the cells outside a region that are up to reach moves away from it.
+    """
+    grid = owned.reshape(height, width)
+    near = np.zeros_like(grid)
+    for dx in range(-reach, reach + 1):
+        for dy in range(abs(dx) - reach, reach - abs(dx) + 1): # Manhattan distance
+            near[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] |= grid[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)]
+    return np.flatnonzero(near.ravel() & ~owned)
+
+def by_region(owner, cells, *columns):
+    """
+    Splits columns of values by the region that owns each cell. Returns {region: (cells, *columns)}.
+    """
+    regions = owner[cells]
+    return {int(region): (cells[regions == region],) + tuple(column[regions == region] for column in columns) for region in np.unique(regions)}
+
+class RegionWorker:
+    """
+    Cars of one region of the map, moved by their own process.
+    The region reads the cells of its neighbors around its border (the halo) from the master at every step,
+    and the cells of the other regions are claimed through the master, so each cell is only decided by its owner.
+    """
+    def __init__(self, path, seed, owner, region, halo):
+        """
+        Creates the fleet of a region.
+        Args:
+            path: Folder of the compiled map, every worker maps the same files and only builds the routing rows of its cars
+            seed: Seed of the random draws, the same for every region
+            owner: Region id of every flat cell index
+            region: Id of this region
+            halo: Cells of the other regions that the cars of this one can read
+        """
+        compiled = CompiledMap(path)
+        self.fleet = FleetCore(compiled.width, compiled.height, *compiled_tables(compiled), seed)
+        self.owner = owner
+        self.owned = owner == region # Cells decided by this region
+        self.halo = halo
+        self.claims = None # Claims on the cells of this region at the current step
+
+    def adopt(self, cars):
+        """
+        Adds the cars that entered the region: (cell, destination id, number, greediness, stay, detour, born) each.
+        New cars have a greediness of None and draw it.
+        """
+        for car in cars:
+            self.fleet.add(*car)
+
+    def intents(self, incoming, tick, states, occupied):
+        """
+        Picks the cell every car wants. Returns the claims on the cells of other regions,
+        {region: (cells, numbers, ranks)}.
+        Args:
+            incoming: Cars that entered the region since the last step
+            tick: Step of the fleet
+            states: Whether each traffic light id is green
+            occupied: Whether each halo cell has a car
+        """
+        self.adopt(incoming)
+        fleet = self.fleet
+        self.tick = tick
+        self.cars = fleet.slots()
+        fleet.red[fleet.light_cells] = ~states
+        cells = fleet.occupant >= 0
+        cells[self.halo] = occupied
+        self.pos, self.dest, self.target = fleet.intend(self.cars, cells, tick)
+        self.rank = np.append(fleet.ranks(self.cars, tick), np.uint64(0)) # The last one stands for no car, like ahead = -1
+        self.state = np.append(np.where(self.target != self.pos, 0, -1), -1).astype(np.int8) # 1 moves, -1 stays, 0 not decided yet
+        movers = np.flatnonzero(self.target != self.pos)
+        self.local_movers = movers[self.owned[self.target[movers]]]
+        exported = movers[~self.owned[self.target[movers]]] # Movers that claim a cell of another region
+        self.exported = dict(zip(fleet.number[self.cars[exported]].tolist(), exported.tolist())) # Position in cars of each of them, by number
+        self.claims = None
+        return by_region(self.owner, self.target[exported], fleet.number[self.cars[exported]], self.rank[exported])
+
+    def gather(self, claims):
+        """
+        Groups every claim on the cells of this region by cell, in the order the claimers act.
+        Args:
+            claims: Claims of the other regions, {region: (cells, numbers, ranks)}
+        """
+        movers = self.local_movers
+        target = [self.target[movers]] + [cells for cells, numbers, ranks in claims.values()]
+        rank = [self.rank[movers]] + [ranks for cells, numbers, ranks in claims.values()]
+        number = [self.fleet.number[self.cars[movers]]] + [numbers for cells, numbers, ranks in claims.values()]
+        local = [movers] + [np.full(len(cells), -1) for cells, numbers, ranks in claims.values()] # Position in cars, -1 for the cars of other regions
+        region = [np.full(len(movers), -1)] + [np.full(len(cells), region) for region, (cells, numbers, ranks) in claims.items()] # Region of each claimer, -1 for this one
+        target, rank, number, local, region = (np.concatenate(values) for values in (target, rank, number, local, region))
+        order = np.lexsort((rank, target))
+        self.claim_target, self.claim_rank, self.claim_number = target[order], rank[order], number[order]
+        self.claim_local, self.claim_region = local[order], region[order]
+        group = np.ones(order.size, dtype=bool) # Where each group starts
+        group[1:] = self.claim_target[1:] != self.claim_target[:-1]
+        self.group = np.cumsum(group) - 1
+        index = np.full(len(self.fleet.alive), -1, dtype=np.int64) # Position in cars of every slot
+        index[self.cars] = np.arange(self.cars.size)
+        ahead = self.fleet.occupant[self.claim_target] # Car in the target cell before the step, always one of this region
+        self.ahead = np.where(ahead >= 0, index[np.maximum(ahead, 0)], -1)
+        self.claim_state = np.zeros(order.size, dtype=np.int8)
+
+    def resolve(self, claims, decisions):
+        """
+        Decides every claim on the cells of this region that can be decided, with the same rule as FleetCore.commit.
+        Returns the decisions on the cars of other regions, {region: (numbers, moved)},
+        whether anything was decided and how many cars of this region are still waiting for a decision.
+        Args:
+            claims: Claims of the other regions on the cells of this one, only at the first round
+            decisions: Decisions of the other regions on the cars of this one, (numbers, moved) each
+        """
+        if self.claims is None:
+            self.claims = claims
+            self.gather(claims)
+        for numbers, moved in decisions:
+            self.state[[self.exported[number] for number in numbers.tolist()]] = np.where(moved, 1, -1)
+        ahead, local = self.ahead, self.claim_local
+        decided = np.zeros(self.claim_state.size, dtype=bool)
+        while True:
+            pending = self.claim_state == 0
+            known = (ahead < 0) | (self.state[ahead] != 0) # The car in the target cell, if any, already moved or stayed
+            decide = pending & known
+            if not decide.any():
+                break
+            eligible = known & ((ahead < 0) | ((self.state[ahead] == 1) & (self.claim_rank > self.rank[ahead]))) # The cell is free when the claimer acts
+            result = np.where(first_claimers(self.group, eligible), 1, -1).astype(np.int8)
+            self.claim_state[decide] = result[decide]
+            mine = decide & (local >= 0)
+            self.state[local[mine]] = result[mine]
+            decided |= decide
+        foreign = decided & (local < 0)
+        replies = {int(region): (self.claim_number[foreign & (self.claim_region == region)], self.claim_state[foreign & (self.claim_region == region)] == 1)
+                   for region in np.unique(self.claim_region[foreign])}
+        return replies, bool(decided.any()), int((self.state[:-1] == 0).sum())
+
+    def stall(self):
+        """
+        The cars still waiting for a decision wait for each other in a circle, they all stay.
+        """
+        self.state[self.state == 0] = -1
+
+    def settle(self):
+        """
+        Moves the cars that got their cell. Returns the cells they left, the cells they entered,
+        the cells where cars arrived, the trips of those cars (numbers, destination ids and steps in the map)
+        and the cars that moved to other regions, {region: [car, ...]}.
+        """
+        fleet = self.fleet
+        cars, pos, target = self.cars, self.pos, self.target
+        moved = self.state[:-1] == 1
+        new, arrived = fleet.settle(cars, pos, self.dest, target, moved)
+        leaving = np.flatnonzero(moved & ~arrived & ~self.owned[new])
+        outgoing = {} # Cars handed to the regions they moved into
+        slots = cars[leaving]
+        for cell, slot in zip(new[leaving].tolist(), slots.tolist()):
+            outgoing.setdefault(int(self.owner[cell]), []).append((cell, int(fleet.destination[slot]), int(fleet.number[slot]),
+                                                                   int(fleet.greediness[slot]), int(fleet.stay[slot]), bool(fleet.detour[slot]), int(fleet.born[slot])))
+        fleet.occupant[new[leaving]] = -1
+        fleet.discard(slots)
+        gone = cars[arrived] # The slots keep their values until reused
+        trips = (fleet.number[gone], self.dest[arrived], self.tick - fleet.born[gone])
+        return pos[moved], new[moved], new[arrived], trips, outgoing
+
+    def positions(self, incoming):
+        """
+        Returns the number and cell of every car in the region.
+        """
+        self.adopt(incoming)
+        cars = self.fleet.slots()
+        return self.fleet.number[cars], self.fleet.position[cars]
+
+def run_region(connection, *args):
+    """
+    Loop of a worker process: runs the commands of the master on its region until it is closed.
+    """
+    worker = RegionWorker(*args)
+    while True:
+        command, *values = connection.recv()
+        if command == "close":
+            break
+        connection.send(getattr(worker, command)(*values))
+    connection.close()
+
+class PartitionedFleet:
+    """
+    Moves the cars of a model like FleetEngine, with the map split into rectangular regions moved by one process each.
+    The draws of every car only depend on its number and the step, so the cars move exactly like in a FleetEngine
+    built from the same model. The master only keeps the occupancy layer, the lights and the messages between regions.
+    Every step costs a few rounds of messages, so it is only faster than FleetEngine with a free CPU per region
+    and many cars per region, benchmark.bench_partition finds where it starts paying off on a machine.
+    """
+    def __init__(self, model, regions = (2, 2)):
+        """
+        Starts one worker process per region.
+        Args:
+            model: CityModel with a compiled map, the workers map the same files
+            regions: Number of regions along x and along y
+        """
+        self.model = model
+        compiled = model.compiled_map
+        self.width, self.height = compiled.width, compiled.height
+        self.destination = model.layers.destination
+        self.owner = split_map(self.width, self.height, regions)
+        self.regions = regions[0] * regions[1]
+        seed = model.random.getrandbits(64) # The same draw as FleetEngine
+        self.halos = [] # Cells each region reads from its neighbors
+        self.connections = []
+        self.processes = []
+        context = multiprocessing.get_context()
+        for region in range(self.regions):
+            cells = halo(self.owner == region, self.width, self.height)
+            master, worker = context.Pipe()
+            process = context.Process(target=run_region, args=(worker, compiled.path, seed, self.owner, region, cells), daemon=True)
+            process.start()
+            worker.close()
+            self.halos.append((cells % self.width, cells // self.width)) # Halo cells as indices of the occupancy layer
+            self.connections.append(master)
+            self.processes.append(process)
+        self.incoming = [[] for region in range(self.regions)] # Cars waiting to be added to each region
+        self.ticks = 0 # Steps done
+        self.arrivals = 0 # Cars that reached their destination
+
+    def send(self, messages):
+        """
+        Sends one command to every worker and returns their answers, in region order.
+        """
+        for connection, message in zip(self.connections, messages):
+            connection.send(message)
+        return [connection.recv() for connection in self.connections]
+
+    def spawn(self, pos, destination, number):
+        """
+        Adds a car at pos going to the destination cell. It reaches its region at the next message.
+        """
+        self.model.layers.occupancy[pos] += 1
+        cell = pos[1] * self.width + pos[0]
+        self.incoming[self.owner[cell]].append((cell, int(self.destination[destination]), number, None, 0, False, self.ticks))
+
+    def take_incoming(self):
+        """
+        Returns the cars waiting for each region and empties the queues.
+        """
+        incoming, self.incoming = self.incoming, [[] for region in range(self.regions)]
+        return incoming
+
+    def step(self):
+        """
+        Moves every car one step. The claims on the cells of other regions are decided by their owners,
+        in rounds, until every car knows whether it moved.
+        """
+        tick = self.ticks
+        self.ticks += 1
+        states = light_states(self.model)
+        occupancy = self.model.layers.occupancy
+        claims = self.send([("intents", incoming, tick, states, occupancy[halo] > 0) for incoming, halo in zip(self.take_incoming(), self.halos)])
+        inbox = [{region: claim[target] for region, claim in enumerate(claims) if target in claim} for target in range(self.regions)] # Claims on the cells of each region
+        decisions = [[] for region in range(self.regions)]
+        while True:
+            replies = self.send([("resolve", inbox[region], decisions[region]) for region in range(self.regions)])
+            inbox = [{}] * self.regions # The claims are only sent at the first round
+            decisions = [[] for region in range(self.regions)]
+            for answer, progress, waiting in replies:
+                for region, decision in answer.items():
+                    decisions[region].append(decision)
+            if sum(waiting for answer, progress, waiting in replies) == 0:
+                break
+            if not any(progress for answer, progress, waiting in replies): # Cars waiting for each other in a circle stay
+                self.send([("stall",)] * self.regions)
+                break
+
+        width = self.width
+        for left, entered, arrived, trips, outgoing in self.send([("settle",)] * self.regions):
+            np.subtract.at(occupancy, (left % width, left // width), 1)
+            np.add.at(occupancy, (entered % width, entered // width), 1)
+            np.subtract.at(occupancy, (arrived % width, arrived // width), 1)
+            self.arrivals += len(arrived)
+            self.model.car_removed += len(arrived)
+            self.model.finish_trips(*(values.tolist() for values in trips))
+            for region, cars in outgoing.items():
+                self.incoming[region].extend(cars)
+
+    def cars(self):
+        """
+        Returns the id and cell of every car in the map.
+        """
+        cars = []
+        for numbers, cells in self.send([("positions", incoming) for incoming in self.take_incoming()]):
+            cars.extend((f"Car_{number}", (cell % self.width, cell // self.width)) for number, cell in zip(numbers.tolist(), cells.tolist()))
+        return cars
+
+    def close(self):
+        """
+        Stops the workers.
+        """
+        for connection, process in zip(self.connections, self.processes):
+            connection.send(("close",))
+            process.join()
+            connection.close()
+        self.connections, self.processes = [], []
@@ -0,0 +1,129 @@
+import heapq
+from agent import heuristic
+
+INFINITY = float("inf")
+
+class DStarLite:
+    """
+    Incremental planner (D* Lite) for a car that keeps rerouting to the same destination.
+    The search runs backwards from the destination, so when the car moves or some cells
+    get occupied or freed, only the costs around those cells are repaired.
+    """
+    def __init__(self, graph, start, goal, blocked):
+        """
+        Creates a new planner and finds the first path.
+        Args:
+            graph: RoadGraph with the legal moves out of each cell
+            start: Cell where the car is
+            goal: Destination of the car
+            blocked: Function that tells if a cell can't be entered right now
+        """
+        self.graph = graph
+        self.start = start
+        self.goal = goal
+        self.blocked = blocked
+        self.last = start # Where the car was when the keys were last computed
+        self.km = 0 # Offset added to the keys every time the car moves
+        self.g = {} # Cost to the goal found so far
+        self.rhs = {goal: 0} # One-step lookahead of the cost to the goal
+        self.queue = [] # Priority queue, outdated entries are skipped when popped
+        self.keys = {} # Current key of every cell in the queue
+        self.expanded = 0 # Number of cells expanded, to compare with a fresh search
+        self.push(goal)
+        self.compute_shortest_path()
+
+    def cost(self, current, next):
+        """
+        Cost of moving from current to next.
+        """
+        return INFINITY if self.blocked(next) else 1
+
+    def key(self, pos):
+        """
+        Priority of a cell in the queue.
+        """
+        best = min(self.g.get(pos, INFINITY), self.rhs.get(pos, INFINITY))
+        return (best + heuristic(self.start, pos) + self.km, best)
+
+    def push(self, pos):
+        """
+        Adds a cell to the queue, or updates its key if it's already there.
+        """
+        key = self.key(pos)
+        self.keys[pos] = key
+        heapq.heappush(self.queue, (key, pos))
+
+    def update_vertex(self, pos):
+        """
+        Recomputes the lookahead cost of a cell and puts it in the queue if it's inconsistent.
+        """
+        if pos != self.goal: # The goal always costs 0
+            self.rhs[pos] = min((self.cost(pos, next) + self.g.get(next, INFINITY) for next in self.graph.successors(pos)), default=INFINITY)
+        self.keys.pop(pos, None) # Remove the cell from the queue
+        if self.g.get(pos, INFINITY) != self.rhs.get(pos, INFINITY): # If the cell is inconsistent,
+            self.push(pos) # Add it back with its new key
+
+    def top_key(self):
+        """
+        Returns the smallest key in the queue, dropping outdated entries.
+        """
+        while self.queue:
+            key, pos = self.queue[0]
+            if self.keys.get(pos) == key: # If the entry is current,
+                return key
+            heapq.heappop(self.queue) # Drop the outdated entry
+        return (INFINITY, INFINITY)
+
+    def compute_shortest_path(self):
+        """
+        Expands cells until the cost of the start is known.
+        """
+        while self.top_key() < self.key(self.start) or self.rhs.get(self.start, INFINITY) != self.g.get(self.start, INFINITY):
+            old_key, pos = heapq.heappop(self.queue) # Get the cell with the lowest key
+            del self.keys[pos]
+            self.expanded += 1
+            new_key = self.key(pos)
+            if old_key < new_key: # If the key is outdated because the car moved,
+                self.push(pos) # Put it back with the new key
+            elif self.g.get(pos, INFINITY) > self.rhs.get(pos, INFINITY): # If the cell got cheaper,
+                self.g[pos] = self.rhs[pos]
+                for prev in self.graph.predecessors(pos): # Its predecessors may get cheaper too
+                    self.update_vertex(prev)
+            else: # If the cell got more expensive,
+                self.g[pos] = INFINITY
+                self.update_vertex(pos)
+                for prev in self.graph.predecessors(pos):
+                    self.update_vertex(prev)
+
+    def replan(self, start, changed):
+        """
+        Moves the start to the car's position and repairs the costs around the changed cells.
+        Args:
+            start: Cell where the car is now
+            changed: Cells whose occupancy changed since the last call
+        """
+        self.start = start
+        self.km += heuristic(self.last, start) # Keep the old keys comparable with the new ones
+        self.last = start
+        for pos in changed: # Entering a changed cell has a new cost,
+            if self.g.get(pos, INFINITY) == INFINITY: # unless no known cost goes through it
+                continue
+            for prev in self.graph.predecessors(pos): # so every cell leading to it needs a new lookahead
+                self.update_vertex(prev)
+        self.compute_shortest_path()
+
+    def path(self):
+        """
+        Returns the path from the start to the goal as a dictionary that maps each cell to the next one.
+        """
+        path = {}
+        current = self.start
+        while current != self.goal: # Follow the cheapest successor until the goal
+            if self.g.get(current, INFINITY) == INFINITY or current in path: # If there is no path,
+                return {}
+            next = min(self.graph.successors(current), key=lambda next: self.cost(current, next) + self.g.get(next, INFINITY))
+            if self.cost(current, next) == INFINITY:
+                return {}
+            path[current] = next
+            current = next
+        return path
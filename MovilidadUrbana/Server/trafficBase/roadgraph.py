@@ -0,0 +1,114 @@
+from types import MappingProxyType
+import numpy as np
+from layers import ROAD, TRAFFIC_LIGHT, DESTINATION
+
+NEIGHBORS = ((-1, 0), (0, -1), (0, 1), (1, 0)) # Von Neumann neighborhood, in the same order as the grid
+
+def is_direction_valid(current_pos, next_pos, road_direction):
+    """
+    Checks if moving from current_pos to next_pos is valid based on the road_direction.
+    Allow diagonal movement only if there is movement in the allowed direction.
+    """
+    dx = next_pos[0] - current_pos[0]  # Change in x
+    dy = next_pos[1] - current_pos[1]  # Change in y
+
+    if road_direction == "Right":  # If the road is going right,
+        return dx != -1   # Moving left is not allowed, only horizontal movement
+    elif road_direction == "Left":  # If the road is going left,
+        return dx != 1   # Moving right is not allowed, only horizontal movement
+    elif road_direction == "Up":  # If the road is going up,
+        return dy != -1  # Moving down is not allowed, only vertical movement
+    elif road_direction == "Down":  # If the road is going down,
+        return dy != 1   # Moving up is not allowed, only vertical movement
+
+    return False  # If the road direction is invalid, return False
+
+class RoadGraph:
+    """
+    Directed graph of the cells a car can drive through.
+    It is built once from the static layout of the map (roads, traffic lights and destinations)
+    and never changes afterwards, so the pathfinding does not have to look at the grid.
+    """
+    def __init__(self, width, height, directions, successors):
+        """
+        Creates a new road graph.
+        Args:
+            width, height: The size of the map
+            directions: Road direction of every road cell
+            successors: Cells that can be reached in one move from every drivable cell, lane changes included
+        """
+        self.width = width
+        self.height = height
+        self.directions = MappingProxyType(dict(directions))
+        self.successors_of = MappingProxyType({pos: tuple(nexts) for pos, nexts in successors.items()})
+        predecessors = {} # Reverse every edge of the graph
+        for pos, nexts in self.successors_of.items():
+            for next in nexts:
+                predecessors.setdefault(next, []).append(pos)
+        self.predecessors_of = MappingProxyType({pos: tuple(prevs) for pos, prevs in predecessors.items()})
+        self.flat = None # Moves as two arrays of flat indices, built when first asked for
+
+    @classmethod
+    def from_layers(cls, layers):
+        """
+        Compiles the graph from the static layers of the map.
+        """
+        directions = {pos: layers.road_direction(pos) for pos in layers.cells(ROAD)} # Road direction of each road cell
+        drivable = set(directions) | set(layers.cells(TRAFFIC_LIGHT)) | set(layers.cells(DESTINATION)) # Traffic lights and destinations can be crossed in any direction
+
+        successors = {} # Legal moves out of each drivable cell
+        for pos in sorted(drivable): # Iterate through all the drivable cells, always in the same order
+            nexts = [] # Cells reachable from the current cell
+            for dx, dy in NEIGHBORS: # Keep the grid's neighbor order
+                next = (pos[0] + dx, pos[1] + dy)
+                if next not in drivable: # Obstacles, empty cells and cells outside the map can't be entered
+                    continue
+                if next in directions and not is_direction_valid(pos, next, directions[next]): # Roads can only be entered along their direction
+                    continue
+                nexts.append(next)
+            successors[pos] = nexts
+        return cls(layers.width, layers.height, directions, successors)
+
+    def successors(self, pos):
+        """
+        Returns the cells that can be reached in one move from pos.
+        """
+        return self.successors_of.get(pos, ())
+
+    def predecessors(self, pos):
+        """
+        Returns the cells that can reach pos in one move.
+        """
+        return self.predecessors_of.get(pos, ())
+
+    def direction(self, pos, default=None):
+        """
+        Returns the direction of the road at pos, or default if pos is not a road.
+        """
+        return self.directions.get(pos, default)
+
+    def index(self, pos):
+        """
+        Returns the flat index of a cell, used by the array based structures.
+        """
+        return pos[1] * self.width + pos[0]
+
+    def position(self, index):
+        """
+        Returns the cell of a flat index.
+        """
+        return (index % self.width, index // self.width)
+
+    def csr(self):
+        """
+        Returns the moves out of every flat index as two arrays, the moves out of index i are targets[offsets[i]:offsets[i + 1]].
+        """
+        if self.flat is None:
+            cells = self.width * self.height
+            offsets = np.zeros(cells + 1, dtype=np.int32)
+            targets = [] # Successor indices, cell index by cell index
+            for i in range(cells):
+                targets.extend(self.index(next) for next in self.successors(self.position(i)))
+                offsets[i + 1] = len(targets)
+            self.flat = (offsets, np.array(targets, dtype=np.int32))
+        return self.flat
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from types import MappingProxyType
+import numpy as np
+from roadgraph import NEIGHBORS
+
+NO_HOP = 255 # Next-hop code of the cells that can't reach the destination, and of the destination itself
+FAR = np.iinfo(np.uint16).max # Distance of the cells that can't reach the destination, longer ones are kept as FAR - 1
+
+class RoutingTable:
+    """
+    Next-hop table towards one destination, shared by every car going there.
+    It behaves like the path dictionaries returned by a_star_search (get and in),
+    so a car can follow it without having its own copy of the route.
+    """
+    def __init__(self, tables, row, destination):
+        """
+        Creates a new routing table.
+        Args:
+            tables: RoutingTables that holds the table
+            row: Row of the destination in the tables
+            destination: Cell the table leads to
+        """
+        self.tables = tables
+        self.row = row
+        self.destination = destination
+
+    def get(self, pos, default=None):
+        """
+        Returns the next cell on the way to the destination.
+        """
+        if pos is None: # Cars look up the cell after the last one, which doesn't exist
+            return default
+        code = self.tables.codes[self.row, pos[1] * self.tables.width + pos[0]] # Move towards the next cell
+        if code == NO_HOP:
+            return default
+        dx, dy = NEIGHBORS[code]
+        return (pos[0] + dx, pos[1] + dy)
+
+    def __contains__(self, pos):
+        return self.get(pos) is not None
+
+    def __bool__(self):
+        return True
+
+class RoutingTables:
+    """
+    Next-hop tables of every destination of a map, built the first time a destination is asked for.
+    Each cell keeps the move towards its next cell in one byte (an index in NEIGHBORS), so the tables
+    take one byte per cell for every destination in use instead of a whole table per destination up front.
+    """
+    def __init__(self, width, height, offsets, targets, goals, distances = False):
+        """
+        Creates the tables, none is built yet. Cells are flat indices, y * width + x.
+        Args:
+            width, height: The size of the map
+            offsets, targets: Moves out of every cell, the ones out of cell i are targets[offsets[i]:offsets[i + 1]]
+            goals: Cell of each destination id
+            distances: Whether the moves left to the destination are kept too, two more bytes per cell
+        """
+        self.width = width
+        self.height = height
+        self.goals = np.asarray(goals, dtype=np.int64)
+        self.ids = {goal: k for k, goal in enumerate(self.goals.tolist())} # Destination id of each goal cell
+        self.keep_distances = distances
+        cells = width * height
+        offsets = np.asarray(offsets, dtype=np.int64)
+        sources = np.repeat(np.arange(cells), np.diff(offsets)) # Cell each move starts from
+        targets = np.asarray(targets, dtype=np.int64)
+        steps = {dx + dy * width: k for k, (dx, dy) in enumerate(NEIGHBORS)}
+        moves = np.array([steps[step] for step in (targets - sources).tolist()], dtype=np.uint8) # NEIGHBORS index of every move
+        order = np.lexsort((sources % width * height + sources // width, targets)) # By target, then in the order of RoadGraph.predecessors
+        self.before = np.searchsorted(targets[order], np.arange(cells + 1)) # Moves into cell i are order[before[i]:before[i + 1]]
+        self.sources = sources[order]
+        self.moves = moves[order]
+        self.row = np.full(len(self.goals), -1, dtype=np.int64) # Row of each destination id, -1 if it isn't built
+        self.codes = np.zeros((0, cells), dtype=np.uint8) # Move towards the next cell from every cell, per row
+        self.distance = np.zeros((0, cells), dtype=np.uint16) if distances else None # Moves to the destination, per row
+        self.built = 0 # Rows in use
+        self.views = {} # RoutingTable of each destination cell
+
+    @classmethod
+    def from_graph(cls, graph, destinations, distances = False):
+        """
+        Creates the tables of a RoadGraph.
+        """
+        return cls(graph.width, graph.height, *graph.csr(), [graph.index(pos) for pos in destinations], distances)
+
+    def ensure(self, destinations):
+        """
+        Builds the tables of the destination ids that aren't built yet.
+        """
+        for destination in np.unique(destinations).tolist():
+            if self.row[destination] < 0:
+                self.build(destination)
+
+    def build(self, destination):
+        """
+        Runs one reverse breadth-first search from a destination id, a whole level at a time.
+        Every move costs the same, so the first time a cell is reached is along a shortest path. Within a level,
+        cells are reached in the same order as a queue would reach them, so ties are broken the same way.
+        """
+        if self.built == len(self.codes): # Double the rows
+            rows = max(2 * len(self.codes), 1)
+            self.codes = np.concatenate((self.codes, np.zeros((rows - len(self.codes), self.codes.shape[1]), dtype=np.uint8)))
+            if self.distance is not None:
+                self.distance = np.concatenate((self.distance, np.zeros((rows - len(self.distance), self.distance.shape[1]), dtype=np.uint16)))
+        row = self.built
+        codes = np.full(self.codes.shape[1], NO_HOP, dtype=np.uint8)
+        distance = np.full(self.codes.shape[1], FAR, dtype=np.uint16)
+        goal = int(self.goals[destination])
+        reached = np.zeros(self.codes.shape[1], dtype=bool)
+        reached[goal] = True
+        distance[goal] = 0
+        frontier = np.array([goal], dtype=np.int64) # Cells of the current level, in the order they were reached
+        level = 0
+        while frontier.size:
+            level += 1
+            first, counts = self.before[frontier], self.before[frontier + 1] - self.before[frontier]
+            edges = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum()) # Moves into the frontier, cell by cell
+            cells = self.sources[edges]
+            new = ~reached[cells]
+            cells, edges = cells[new], edges[new]
+            cells, keep = np.unique(cells, return_index=True)
+            keep.sort() # First time each cell is reached, in order
+            frontier = self.sources[edges[keep]]
+            reached[frontier] = True
+            codes[frontier] = self.moves[edges[keep]]
+            distance[frontier] = min(level, FAR - 1)
+        self.codes[row] = codes
+        if self.distance is not None:
+            self.distance[row] = distance
+        self.row[destination] = row
+        self.built += 1
+
+    def get(self, destination, default = None):
+        """
+        Returns the RoutingTable of a destination cell, building it the first time.
+        """
+        table = self.views.get(destination)
+        if table is None:
+            k = self.ids.get(destination[1] * self.width + destination[0]) if 0 <= destination[0] < self.width else None
+            if k is None:
+                return default
+            self.ensure(k)
+            table = self.views[destination] = RoutingTable(self, int(self.row[k]), destination)
+        return table
+
+    def __len__(self):
+        return len(self.goals)
+
+class RouteCache:
+    """
+    Bounded cache of the paths found by A*, keyed by origin and destination.
+    The least recently used path is dropped when the cache is full.
+    Paths are stored read-only so every car asking for the same route shares one copy.
+    """
+    def __init__(self, maxsize = 256):
+        """
+        Creates a new route cache.
+        Args:
+            maxsize: Maximum number of paths kept, 0 disables the cache
+        """
+        self.maxsize = maxsize
+        self.routes = OrderedDict() # Paths ordered from least to most recently used
+        self.hits = 0 # Number of lookups that found a path
+        self.misses = 0 # Number of lookups that had to search
+
+    def get(self, origin, destination, search):
+        """
+        Returns the cached path from origin to destination, calling search() to find it on a miss.
+        """
+        key = (origin, destination)
+        route = self.routes.get(key)
+        if route is not None: # If the path is cached,
+            self.hits += 1
+            self.routes.move_to_end(key) # Mark it as the most recently used
+            return route
+        self.misses += 1
+        route = search() # Search the path
+        if isinstance(route, dict): # Make path dictionaries read-only
+            route = MappingProxyType(route)
+        if self.maxsize > 0: # If the cache is enabled,
+            self.routes[key] = route
+            if len(self.routes) > self.maxsize: # If the cache is full,
+                self.routes.popitem(last=False) # Drop the least recently used path
+        return route
+
+    def clear(self):
+        """
+        Drops every cached path, the counters are kept.
+        """
+        self.routes.clear()
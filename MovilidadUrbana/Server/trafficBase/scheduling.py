@@ -0,0 +1,151 @@
+import heapq
+import math
+from mesa.time import BaseScheduler
+from agent import Traffic_Light, Destination, Obstacle, Road
+
+STATIC = (Destination, Obstacle, Road) # Agents that never change, they are kept but never stepped
+
+class EventScheduler(BaseScheduler):
+    """
+    Scheduler that only steps the agents that can change something.
+    Traffic lights don't step, they toggle on timed events. Cars step in a random order like
+    RandomActivation, but a car that can't move sleeps until the light or the cell in front of
+    it changes, and isn't stepped in the meantime.
+    """
+    def __init__(self, model):
+        """
+        Creates an empty scheduler.
+        Args:
+            model: Model the agents belong to
+        """
+        super().__init__(model)
+        self.active = {} # Agents stepped every step, by id
+        self.events = [] # Priority queue of (step, number, kind, agent)
+        self.count = 0 # Number of events scheduled so far, keeps events of the same step in order
+        self.sleeping = {} # Since when, cell, light and wake-up event of every sleeping agent, by id
+        self.cell_waiters = {} # Ids of the agents waiting for each cell to get free, as dictionary keys so they wake up in the order they slept
+        self.light_waiters = {} # Ids of the agents waiting for each light to change, also in the order they slept
+        self.order = None # Agents left to step in the current step
+        self.cursor = 0 # Position in order of the agent being stepped
+        self.activations = 0 # Number of agent steps done
+
+    def add(self, agent):
+        """
+        Adds an agent. Lights get their next toggle scheduled, static agents are never stepped.
+        """
+        super().add(agent)
+        if isinstance(agent, Traffic_Light):
+            self.schedule(-(-self.steps // agent.timeToChange) * agent.timeToChange, "toggle", agent) # Next multiple of its time to change
+        elif not isinstance(agent, STATIC):
+            self.active[agent.unique_id] = agent
+
+    def remove(self, agent):
+        """
+        Removes an agent, awake or sleeping.
+        """
+        super().remove(agent)
+        self.active.pop(agent.unique_id, None)
+        self.forget(agent)
+
+    def schedule(self, step, kind, agent):
+        """
+        Adds an event for an agent at a step, returns its number.
+        """
+        self.count += 1
+        heapq.heappush(self.events, (step, self.count, kind, agent))
+        return self.count
+
+    def sleep(self, agent, cell = None, light = None, until = None, chance = 0):
+        """
+        Stops stepping an agent until something changes.
+        Args:
+            agent: Agent that just stepped
+            cell: Cell whose getting free wakes the agent up
+            light: Traffic light whose change wakes the agent up
+            until: Step when the agent wakes up anyway
+            chance: Chance of waking up at each step, for the cars that run red lights
+        """
+        event = None
+        if chance > 0: # Draw the first step the agent would have taken its chance
+            draw = 1 - self.model.random.random()
+            wait = 1 if chance >= 1 else int(math.log(draw) / math.log(1 - chance)) + 1
+            if until is None or self.steps + wait < until:
+                event = self.schedule(self.steps + wait, "careless", agent)
+        if event is None and until is not None:
+            event = self.schedule(until, "wake", agent)
+        del self.active[agent.unique_id]
+        self.sleeping[agent.unique_id] = (self.steps, cell, light, event)
+        if cell is not None:
+            self.cell_waiters.setdefault(cell, {})[agent.unique_id] = None
+        if light is not None:
+            self.light_waiters.setdefault(light.unique_id, {})[agent.unique_id] = None
+
+    def forget(self, agent):
+        """
+        Takes an agent out of every waiting list. Returns when it fell asleep, None if it wasn't sleeping.
+        """
+        record = self.sleeping.pop(agent.unique_id, None)
+        if record is None:
+            return None
+        since, cell, light, event = record
+        if cell in self.cell_waiters:
+            self.cell_waiters[cell].pop(agent.unique_id, None)
+        if light is not None and light.unique_id in self.light_waiters:
+            self.light_waiters[light.unique_id].pop(agent.unique_id, None)
+        return since
+
+    def wake(self, agent, careless = False):
+        """
+        Starts stepping a sleeping agent again. During a step, it gets a random place among the agents
+        that haven't stepped yet, or waits for the next step, as it would with RandomActivation.
+        """
+        since = self.forget(agent)
+        if since is None:
+            return
+        first = self.steps # Step where the agent acts again
+        if since == self.steps: # It already stepped in this step
+            first += 1
+        elif self.order is not None:
+            place = self.model.random.randrange(len(self.order) + 1)
+            if place >= self.cursor: # It acts after the agent that woke it up
+                self.order.insert(place, agent)
+            else:
+                first += 1
+        agent.cont_stay += first - since - 1 # Steps it stayed without being stepped
+        agent.careless = careless
+        self.active[agent.unique_id] = agent
+
+    def cell_changed(self, pos):
+        """
+        Wakes up the agents waiting for a cell that just got free.
+        """
+        waiters = self.cell_waiters.pop(pos, None)
+        for unique_id in waiters or ():
+            self.wake(self._agents[unique_id])
+
+    def step(self):
+        """
+        Runs the events of this step, then steps the awake agents in a random order.
+        """
+        while self.events and self.events[0][0] <= self.steps:
+            step, number, kind, agent = heapq.heappop(self.events)
+            if kind == "toggle":
+                agent.toggle()
+                self.schedule(self.steps + agent.timeToChange, "toggle", agent)
+                for unique_id in self.light_waiters.pop(agent.unique_id, ()):
+                    self.wake(self._agents[unique_id])
+            elif agent.unique_id in self.sleeping and self.sleeping[agent.unique_id][3] == number: # Only the last event of each sleep counts
+                self.wake(agent, kind == "careless")
+
+        self.order = list(self.active.values())
+        self.model.random.shuffle(self.order)
+        self.cursor = 0
+        while self.cursor < len(self.order):
+            agent = self.order[self.cursor]
+            self.cursor += 1
+            if agent.unique_id in self.active: # It may have been removed during this step
+                agent.step()
+                self.activations += 1
+        self.order = None
+        self.steps += 1
+        self.time += 1
@@ -0,0 +1,108 @@
+import numpy as np
+
+class SignalController:
+    """
+    Signal plans of every traffic light, kept in arrays and updated all at once.
+    A light is green during the first green steps of every cycle, counting from its offset,
+    so the state of any light at any step can be computed without stepping it.
+    """
+    def __init__(self, lights, positions, cycle, green, offset):
+        """
+        Creates a new controller.
+        Args:
+            lights: Traffic_Light of each light id, their state is kept up to date
+            positions: Cell of each light id
+            cycle: Steps of a whole green and red cycle of each light
+            green: Steps each light stays green in every cycle
+            offset: Step when the first cycle of each light starts
+        """
+        self.lights = lights
+        self.positions = np.array(positions, dtype=np.int64).reshape(len(lights), 2)
+        self.cycle = np.array(cycle, dtype=np.int64)
+        self.green = np.array(green, dtype=np.int64)
+        self.offset = np.array(offset, dtype=np.int64)
+        self.state = np.array([light.state for light in lights], dtype=bool) # Current state of each light, True = green
+
+    @classmethod
+    def from_lights(cls, lights, positions):
+        """
+        Builds the plans that give the same states as the Traffic_Light agents.
+        A light toggles at every multiple of timeToChange, starting at step 0,
+        so it is green for timeToChange steps in a cycle twice as long.
+        """
+        period = [light.timeToChange for light in lights]
+        offset = [time if light.state else 0 for light, time in zip(lights, period)] # Lights that start green turn red at step 0
+        return cls(lights, positions, [2 * time for time in period], period, offset)
+
+    def phase(self, t, lights = slice(None)):
+        """
+        Returns how far into its cycle each light is at step t.
+        """
+        return (t - self.offset[lights]) % self.cycle[lights]
+
+    def states(self, t, lights = slice(None)):
+        """
+        Returns the state of the lights at step t, True = green.
+        """
+        return self.phase(t, lights) < self.green[lights]
+
+    def state_at(self, light, t):
+        """
+        Returns whether a light is green at step t.
+        """
+        return bool(self.states(t, light))
+
+    def next_change(self, light, t):
+        """
+        Returns the first step after t when a light changes.
+        """
+        phase = int(self.phase(t, light))
+        green = int(self.green[light])
+        return t + (green - phase if phase < green else int(self.cycle[light]) - phase)
+
+    def expected_delays(self):
+        """
+        Returns the expected wait of a car arriving at each light at a random step:
+        red for part of the cycle, for half of the red phase on average.
+        """
+        red = self.cycle - self.green
+        return red / self.cycle * red / 2
+
+    def set_plan(self, lights, cycle = None, green = None, offset = None):
+        """
+        Changes the plan of a group of lights. Every argument is a single value for the whole group or one per light.
+        Args:
+            lights: Ids of the lights
+            cycle, green, offset: New plan, the parts left as None are kept
+        """
+        lights = np.asarray(lights, dtype=np.int64)
+        if cycle is not None:
+            self.cycle[lights] = cycle
+        if green is not None:
+            self.green[lights] = green
+        if offset is not None:
+            self.offset[lights] = offset
+
+    def green_wave(self, lights, start = 0, travel = 1):
+        """
+        Staggers the offsets of the lights along a corridor, so a car that gets a green light at the first one
+        gets it at the next ones too. The lights keep their cycle and green time.
+        Args:
+            lights: Ids of the lights, in the order the cars meet them
+            start: Offset of the first light
+            travel: Steps a car takes to move one cell
+        """
+        lights = np.asarray(lights, dtype=np.int64)
+        steps = np.abs(np.diff(self.positions[lights], axis=0)).sum(axis=1) # Cells between consecutive lights
+        self.offset[lights] = start + travel * np.concatenate(([0], np.cumsum(steps)))
+
+    def update(self, t):
+        """
+        Sets every light to its state at step t. Returns the ids of the lights that changed.
+        """
+        state = self.states(t)
+        changed = np.flatnonzero(state != self.state)
+        self.state = state
+        for light in changed.tolist(): # Only the lights that toggled are touched
+            self.lights[light].state = bool(state[light])
+        return changed
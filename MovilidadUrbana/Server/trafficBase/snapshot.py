@@ -0,0 +1,223 @@
+import copy
+import pickle
+import zlib
+import numpy as np
+from model import CityModel
+from agent import Car
+from layers import DIRECTIONS
+from scheduling import EventScheduler
+
+FORMAT = 1 # Version of the snapshot layout, restore refuses the others
+PATH_NONE, PATH_CELLS, PATH_TABLE = range(3) # How each car's path is kept: none, the cells left, the shared table of its destination
+FLEET_ARRAYS = ("position", "destination", "greediness", "stay", "number", "detour", "alive", "born") # Arrays of a car slot
+
+def map_checksum(layers):
+    """
+    Returns a checksum of the static layout of a map, to check that a snapshot is restored on the same map.
+    """
+    return zlib.crc32(layers.direction.tobytes(), zlib.crc32(layers.kind.tobytes()))
+
+def path_cells(graph, path, pos):
+    """
+    Returns the cell indices a car at pos still follows on its path, from pos to the goal. Empty if pos isn't on it.
+    Every kind of path (dictionaries, ArrayPath, ContractedPath) only gives the cell after pos, so this is all
+    a car can still use of it.
+    """
+    cells = []
+    if pos not in path:
+        return cells
+    limit = graph.width * graph.height # A path never goes through a cell twice
+    while pos is not None and len(cells) <= limit:
+        cells.append(graph.index(pos))
+        pos = path.get(pos)
+    return cells
+
+def take_snapshot(model):
+    """
+    Returns the dynamic state of a model: step counters, random generator, lights, cars with their paths,
+    scheduler, fleet arrays and demand queues. The map itself is only referenced by its file and a checksum.
+    The snapshot shares nothing with the model, it can be kept, saved with save_snapshot and restored any number of times.
+    Args:
+        model: CityModel to take the snapshot of, between steps
+    """
+    if model.fleet is not None and not hasattr(model.fleet, "number"):
+        raise ValueError("Snapshots of the partitioned engine are not supported, its cars live in the worker processes")
+    graph = model.road_graph
+    layers = model.layers
+    cars = list(model.cars.values()) # In the order they were spawned, like in the scheduler
+    offsets, cells = [0], []
+    kinds = np.zeros(len(cars), dtype=np.uint8)
+    for i, car in enumerate(cars):
+        if car.path is not None and car.path is model.routing_tables.get(car.destination): # Shared by every car going there
+            kinds[i] = PATH_TABLE
+        elif car.path is not None:
+            kinds[i] = PATH_CELLS
+            cells.extend(path_cells(graph, car.path, car.pos))
+        offsets.append(len(cells))
+    snapshot = {
+        "format": FORMAT,
+        "map": {"file": model.options["map_file"], "checksum": map_checksum(layers), "width": model.width, "height": model.height},
+        "options": dict(model.options),
+        "seed": model._seed,
+        "random": model.random.getstate(),
+        "step_count": model.step_count,
+        "num_agents": model.num_agents,
+        "car_removed": model.car_removed,
+        "running": model.running,
+        "trip_times": np.array(model.trip_times, dtype=np.int64),
+        "occupancy": layers.occupancy.copy(),
+        "light_state": np.array([light.state for light in model.traffic_lights], dtype=bool),
+        "light_time": np.array([light.timeToChange for light in model.traffic_lights], dtype=np.int64),
+        "light_delays": np.array([model.light_delays.get(pos, 0) for pos in layers.lights], dtype=float),
+        "signals": None,
+        "destination_weights": list(model.destinations.weights),
+        "destination_enabled": list(model.destinations.enabled),
+        "schedule": {"steps": model.schedule.steps, "time": model.schedule.time, "order": list(model.schedule._agents)},
+        "cars": {
+            "number": np.array([int(car.unique_id.split("_")[1]) for car in cars], dtype=np.int64),
+            "pos": np.array([car.pos for car in cars], dtype=np.int32).reshape(-1, 2),
+            "spawn": np.array([car.spawn for car in cars], dtype=np.int32).reshape(-1, 2),
+            "destination": np.array([car.destination for car in cars], dtype=np.int32).reshape(-1, 2),
+            "greediness": np.array([car.greediness for car in cars], dtype=np.int32),
+            "cont_stay": np.array([car.cont_stay for car in cars], dtype=np.int32),
+            "careless": np.array([car.careless for car in cars], dtype=bool),
+            "spawn_step": np.array([car.spawn_step for car in cars], dtype=np.int64),
+            "direction": np.array([DIRECTIONS.index(getattr(car, "direction", None)) for car in cars], dtype=np.uint8),
+            "path_kind": kinds,
+            "path_offsets": np.array(offsets, dtype=np.int64), # Cells of car i are path_cells[path_offsets[i]:path_offsets[i + 1]]
+            "path_cells": np.array(cells, dtype=np.int32),
+        },
+        "route_requests": [(agent.unique_id, type) for agent, type in model.route_requests],
+        "fleet": None,
+        "demand": copy.deepcopy(model.demand),
+    }
+    if model.signals is not None:
+        signals = model.signals
+        snapshot["signals"] = {"cycle": signals.cycle.copy(), "green": signals.green.copy(), "offset": signals.offset.copy(), "state": signals.state.copy()}
+    if isinstance(model.schedule, EventScheduler): # Who is awake, asleep and the pending events
+        schedule = model.schedule
+        snapshot["schedule"].update({
+            "active": list(schedule.active),
+            "events": [(step, number, kind, agent.unique_id) for step, number, kind, agent in schedule.events],
+            "count": schedule.count,
+            "activations": schedule.activations,
+            "sleeping": {unique_id: (since, cell, light.unique_id if light is not None else None, event)
+                         for unique_id, (since, cell, light, event) in schedule.sleeping.items()},
+            "cell_waiters": {cell: list(waiters) for cell, waiters in schedule.cell_waiters.items()},
+            "light_waiters": {light: list(waiters) for light, waiters in schedule.light_waiters.items()},
+        })
+    if model.fleet is not None:
+        fleet = model.fleet
+        count = fleet.count
+        snapshot["fleet"] = dict({name: getattr(fleet, name)[:count].copy() for name in FLEET_ARRAYS},
+                                 occupant=fleet.occupant.copy(), seed=fleet.seed, ticks=fleet.ticks, count=count,
+                                 free=list(fleet.free), arrivals=fleet.arrivals)
+    return snapshot
+
+def restore_snapshot(snapshot, demand = None, parent = None):
+    """
+    Creates a new model in the state of a snapshot, on the same map and with the same options.
+    The new model continues exactly like the one the snapshot was taken of, except that the incremental
+    planners (reroute = "incremental") start their next search from scratch and the route caches start empty.
+    Args:
+        snapshot: Returned by take_snapshot or load_snapshot
+        demand: DemandModel to use instead of the snapshot's, for what-if runs with another demand
+        parent: Model the snapshot was taken of, whose map, road graph and routing tables the new model shares
+            instead of building them again, like CityModel.fork does
+    """
+    if snapshot["format"] != FORMAT:
+        raise ValueError(f"Unknown snapshot format: {snapshot['format']}")
+    model = CityModel(0, seed = snapshot["seed"], _parent = parent, **snapshot["options"])
+    layers = model.layers
+    if map_checksum(layers) != snapshot["map"]["checksum"]:
+        raise ValueError(f"The map {snapshot['map']['file']} changed since the snapshot was taken")
+    graph = model.road_graph
+    model.step_count = snapshot["step_count"]
+    model.num_agents = snapshot["num_agents"]
+    model.car_removed = snapshot["car_removed"]
+    model.running = snapshot["running"]
+    model.trip_times = snapshot["trip_times"].tolist()
+
+    for light, state, time in zip(model.traffic_lights, snapshot["light_state"].tolist(), snapshot["light_time"].tolist()):
+        light.state = state
+        light.timeToChange = time
+    model.light_delays = dict(zip(layers.lights, snapshot["light_delays"].tolist()))
+    if snapshot["signals"] is not None:
+        for name, values in snapshot["signals"].items():
+            setattr(model.signals, name, values.copy())
+    model.destinations.weights = list(snapshot["destination_weights"])
+    model.destinations.enabled = list(snapshot["destination_enabled"])
+    model.destinations.changed()
+
+    agents = {light.unique_id: light for light in model.traffic_lights} # Every agent a car, event or request refers to
+    cars = snapshot["cars"]
+    offsets, cells = cars["path_offsets"].tolist(), cars["path_cells"].tolist()
+    for i, (number, pos, spawn, destination, greediness, stay, careless, spawn_step, direction, kind) in enumerate(zip(
+            cars["number"].tolist(), cars["pos"].tolist(), cars["spawn"].tolist(), cars["destination"].tolist(),
+            cars["greediness"].tolist(), cars["cont_stay"].tolist(), cars["careless"].tolist(), cars["spawn_step"].tolist(),
+            cars["direction"].tolist(), cars["path_kind"].tolist())):
+        agent = Car(f"Car_{number}", model, tuple(spawn), tuple(destination)) # Its greediness draw is undone with the generator state below
+        agent.greediness = greediness
+        agent.cont_stay = stay
+        agent.careless = careless
+        agent.spawn_step = spawn_step
+        if direction:
+            agent.direction = DIRECTIONS[direction]
+        if kind == PATH_TABLE:
+            agent.path = model.routing_tables.get(agent.destination)
+        elif kind == PATH_CELLS:
+            path = [graph.position(cell) for cell in cells[offsets[i]:offsets[i + 1]]]
+            agent.path = dict(zip(path, path[1:]))
+        model.grid.place_agent(agent, tuple(pos)) # The occupancy is copied whole below
+        model.schedule.add(agent)
+        model.cars[agent.unique_id] = agent
+        agents[agent.unique_id] = agent
+    layers.occupancy[...] = snapshot["occupancy"]
+    model.route_requests = [(agents[unique_id], type) for unique_id, type in snapshot["route_requests"]]
+
+    schedule = model.schedule
+    state = snapshot["schedule"]
+    schedule._agents = {unique_id: schedule._agents[unique_id] for unique_id in state["order"]} # RandomActivation shuffles them in this order
+    schedule.steps = state["steps"]
+    schedule.time = state["time"]
+    if isinstance(schedule, EventScheduler):
+        schedule.active = {unique_id: agents[unique_id] for unique_id in state["active"]}
+        schedule.events = [(step, number, kind, agents[unique_id]) for step, number, kind, unique_id in state["events"]] # Same order, still a heap
+        schedule.count = state["count"]
+        schedule.activations = state["activations"]
+        schedule.sleeping = {unique_id: (since, cell, agents[light] if light is not None else None, event)
+                             for unique_id, (since, cell, light, event) in state["sleeping"].items()}
+        schedule.cell_waiters = {cell: dict.fromkeys(waiters) for cell, waiters in state["cell_waiters"].items()}
+        schedule.light_waiters = {light: dict.fromkeys(waiters) for light, waiters in state["light_waiters"].items()}
+
+    if snapshot["fleet"] is not None:
+        fleet, state = model.fleet, snapshot["fleet"]
+        while len(fleet.alive) < state["count"]:
+            fleet.grow()
+        for name in FLEET_ARRAYS:
+            getattr(fleet, name)[:state["count"]] = state[name]
+        fleet.occupant[:] = state["occupant"]
+        fleet.seed = state["seed"]
+        fleet.ticks = state["ticks"]
+        fleet.count = state["count"]
+        fleet.free = list(state["free"])
+        fleet.arrivals = state["arrivals"]
+        fleet.tables.ensure(fleet.destination[:fleet.count][fleet.alive[:fleet.count]]) # Tables of the destinations of the cars
+
+    model.demand = demand if demand is not None else copy.deepcopy(snapshot["demand"]) # Every fork gets its own queues
+    model.random.setstate(snapshot["random"]) # Last, creating the cars drew from it
+    return model
+
+def save_snapshot(snapshot, path):
+    """
+    Writes a snapshot to a binary file. The demand profile must be picklable, like the ones in demand.py.
+    """
+    with open(path, "wb") as file:
+        pickle.dump(snapshot, file, protocol = pickle.HIGHEST_PROTOCOL)
+
+def load_snapshot(path):
+    """
+    Reads a snapshot written by save_snapshot. Only load files you trust, they are pickles.
+    """
+    with open(path, "rb") as file:
+        return pickle.load(file)
@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # The modules import each other by name, like when run from trafficBase
+
+from .helpers import build
+
+@pytest.fixture(scope="session")
+def city():
+    """
+    Model of the base map without cars, only its static structures are used.
+    """
+    return build(0, static_agents = False, seed = 0)
@@ -0,0 +1,18 @@
+import contextlib
+import os
+
+def build(*args, **options):
+    """
+    Creates a CityModel without its prints.
+    """
+    from model import CityModel
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return CityModel(*args, **options)
+
+def steps(model, count):
+    """
+    Steps a model count times without its prints.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for step in range(count):
+            model.step()
@@ -0,0 +1,20 @@
+import random
+import pytest
+from .helpers import build, steps
+
+@pytest.mark.parametrize("regions", [(2, 1), (2, 2)])
+def test_partitioned_fleet_matches_the_fleet(regions):
+    random.seed(1)
+    fleet = build(5, engine = "fleet", seed = 3)
+    random.seed(1)
+    partitioned = build(5, engine = "partitioned", regions = regions, seed = 3)
+    try:
+        for step in range(60):
+            steps(fleet, 1)
+            steps(partitioned, 1)
+            assert sorted(partitioned.fleet.cars()) == sorted(fleet.fleet.cars()), f"step {step}"
+            assert partitioned.car_removed == fleet.car_removed
+        assert sorted(partitioned.trip_times) == sorted(fleet.trip_times)
+        assert (partitioned.layers.occupancy == fleet.layers.occupancy).all()
+    finally:
+        partitioned.fleet.close()
@@ -0,0 +1,91 @@
+import random
+from collections import deque
+import pytest
+from agent import a_star_search
+from replanning import DStarLite
+from contraction import ContractedGraph, ContractedPath
+from flatsearch import FlatAStar, ArrayPath
+from batchrouting import BatchRouter
+from routing import RoutingTables, FAR
+
+def length(path, start, goal):
+    """
+    Returns the moves of a path from start to goal, None if it doesn't get there.
+    """
+    moves, current = 0, start
+    while current != goal:
+        current = path.get(current)
+        moves += 1
+        if current is None or moves > 100000:
+            return None
+    return moves
+
+def bfs(graph, start, goal, blocked = frozenset()):
+    """
+    Returns the fewest moves from start to goal avoiding the blocked cells, None if it can't be reached.
+    """
+    moves = {start: 0}
+    queue = deque([start])
+    while queue:
+        current = queue.popleft()
+        if current == goal:
+            return moves[current]
+        for next in graph.successors(current):
+            if next not in moves and next not in blocked:
+                moves[next] = moves[current] + 1
+                queue.append(next)
+    return None
+
+@pytest.fixture(scope="module")
+def pairs(city):
+    """
+    Random road cells paired with random destinations.
+    """
+    rng = random.Random(4)
+    cells = sorted(city.road_graph.successors_of)
+    return [(rng.choice(cells), rng.choice(city.layers.destinations)) for i in range(60)]
+
+def test_every_routing_mode_finds_the_shortest_path(city, pairs):
+    graph = city.road_graph
+    contracted = ContractedGraph(graph)
+    flat = FlatAStar(graph)
+    batch = BatchRouter(graph)
+    tables = RoutingTables.from_graph(graph, city.layers.destinations)
+    solved = batch.solve(pairs)
+    for (start, goal), batched in zip(pairs, solved):
+        expected = bfs(graph, start, goal)
+        if expected is None or start == goal:
+            continue
+        assert length(a_star_search(graph, start, goal), start, goal) == expected
+        assert length(ArrayPath(flat, flat.search(start, goal)), start, goal) == expected
+        assert length(ContractedPath(contracted.find_route(start, goal)), start, goal) == expected
+        assert length(batch.route(start, goal), start, goal) == expected
+        assert length(batched, start, goal) == expected
+        assert length(tables.get(goal), start, goal) == expected
+
+def test_routing_tables_keep_the_distances(city, pairs):
+    graph = city.road_graph
+    tables = RoutingTables.from_graph(graph, city.layers.destinations, distances = True)
+    for start, goal in pairs:
+        expected = bfs(graph, start, goal)
+        table = tables.get(goal)
+        distance = int(tables.distance[table.row, graph.index(start)])
+        assert distance == (FAR if expected is None else expected)
+
+@pytest.mark.parametrize("seed", range(3))
+def test_d_star_lite_matches_a_star_under_occupancy(city, pairs, seed):
+    graph = city.road_graph
+    rng = random.Random(seed)
+    cells = sorted(graph.successors_of)
+    for start, goal in pairs[:20]:
+        occupied = set(rng.sample(cells, len(cells) // 10)) - {start, goal}
+        blocked = lambda pos: pos in occupied
+        planner = DStarLite(graph, start, goal, blocked)
+        expected = length(a_star_search(graph, start, goal, blocked), start, goal)
+        assert expected == bfs(graph, start, goal, occupied)
+        assert length(planner.path(), start, goal) == expected
+
+        changed = set(rng.sample(cells, len(cells) // 20)) - {start, goal} # Cars come and go
+        occupied ^= changed
+        planner.replan(start, changed)
+        assert length(planner.path(), start, goal) == length(a_star_search(graph, start, goal, blocked), start, goal)
@@ -0,0 +1,40 @@
+import pytest
+from .helpers import build, steps
+from snapshot import take_snapshot, restore_snapshot
+
+def state(model):
+    """
+    Everything that changes while a model runs, and the next number it draws.
+    """
+    if model.fleet is not None:
+        cars = sorted(model.fleet.cars())
+    else:
+        cars = sorted((agent.unique_id, agent.pos) for agent in model.schedule._agents.values() if agent.unique_id.startswith("Car"))
+    return (model.car_removed, model.num_agents, list(model.trip_times), cars, [light.state for light in model.traffic_lights], model.random.random())
+
+CONFIGS = [dict(), dict(scheduler = "event"), dict(engine = "fleet"), dict(routing = "table"), dict(routing = "batch"),
+           dict(routing = "contracted"), dict(search = "flat"), dict(signals = "plan"), dict(routing = "table", engine = "fleet")]
+
+@pytest.mark.parametrize("options", CONFIGS, ids = lambda options: ",".join(f"{name}={value}" for name, value in options.items()) or "default")
+def test_fork_and_restore_run_like_the_original(options):
+    model = build(5, seed = 7, **options)
+    steps(model, 100)
+    restored = restore_snapshot(take_snapshot(model))
+    fork = model.fork()
+    for step in range(100):
+        steps(model, 1)
+        steps(restored, 1)
+        steps(fork, 1)
+    expected = state(model) # Draws a number, once per model
+    assert state(fork) == expected
+    assert state(restored) == expected
+
+def test_fork_shares_the_static_structures():
+    model = build(5, seed = 7, routing = "table")
+    fork = model.fork()
+    assert fork.road_graph is model.road_graph
+    assert fork.routing_tables is model.routing_tables
+    assert fork.layers.occupancy is not model.layers.occupancy
+    cars = model.layers.occupancy.copy()
+    steps(fork, 20)
+    assert (model.layers.occupancy == cars).all() # The fork's cars don't move the original's
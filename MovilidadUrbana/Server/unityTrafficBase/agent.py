@@ -1,6 +1,6 @@
 from mesa import Agent
 import heapq
-import random
+import time
 
 def heuristic(a, b):
     """
@@ -8,9 +8,15 @@ def heuristic(a, b):
     """
     return abs(a[0] - b[0]) + abs(a[1] - b[1])
 
-def a_star_search(graph, start, goal, pathclear):
+def a_star_search(graph, start, goal, blocked=None, cost=None, metrics=None):
     """
     Finds the shortest path between two cells using A*.
+    Args:
+        graph: RoadGraph with the legal moves out of each cell
+        start, goal: Cells where the path starts and ends
+        blocked: Optional function that tells if a cell can't be entered right now
+        cost: Optional function that gives the cost of entering a cell, at least 1, every move costs 1 without it
+        metrics: StepMetrics that count the searches and the cells they reach, None to count nothing
     """
     #print(f"Starting A* search from {start} to {goal}")
     obstacles = [] # Priority queue
@@ -24,15 +30,18 @@ def a_star_search(graph, start, goal, pathclear):
         if current == goal: # If the goal is reached, stop
             #print("Goal reached in A* search")
             break
-        for next in graph.get_neighborhood(current, moore=False, include_center=False): # Get the neighbors of the current cell
-            if not pathclear(current, next): # If the path is not clear,
+        for next in graph.successors(current): # Get the cells that can be reached from the current cell
+            if blocked is not None and blocked(next): # If the cell is blocked,
                 continue # Skip this neighbor
-            new_cost = sofar[current] + 1 # Calculate the cost to get to the neighbor
+            new_cost = sofar[current] + (1 if cost is None else cost(next)) # Calculate the cost to get to the neighbor
             if next not in sofar or new_cost < sofar[next]: # If the neighbor has not been visited or the cost is lower than the previous cost,
                 sofar[next] = new_cost # Update the cost
                 priority = new_cost + heuristic(goal, next) # Calculate the priority
                 heapq.heappush(obstacles, (priority, next)) # Add the neighbor to the queue
                 wherefrom[next] = current # Update the path
+    if metrics is not None:
+        metrics.count("astar_searches")
+        metrics.count("astar_nodes", len(sofar)) # Cells reached by the search
     path = {} # Dictionary to keep track of the path
     current = goal # Start at the goal
     while current != start: # While the start is not reached,
@@ -66,110 +75,97 @@ class Car(Agent):
         self.destination = destination
         self.spawn = spawn
         self.path = None
-        self.greediness = random.randint(0, 100)
+        self.greediness = self.model.random.randint(0, 100) # Drawn from the model's generator, so a seed repeats the run
+        self.spawn_step = model.step_count # Step when the car entered the map
         self.cont_stay = 0
+        self.careless = False # Set when the car wakes up to run the red light it was waiting at
+        self.planner = None # Incremental search kept between reroutes
+        self.planner_log_position = 0 # Occupancy log position the planner is up to date with
         #self.status = False
         #self.stepsCrash = 0
     
     def initialize_path(self,type):
         """
         Initializes the path for the agent.
+        In batch routing a stuck car keeps its current path until the model solves the requests of the step together.
         """
+        if self.model.routing == "batch": # Spawned cars get their path at once, stuck ones wait for the batch
+            self.model.request_route(self, type)
+            return
         self.path = self.find_path(type)
 
-    def is_direction_valid(self, current_pos, next_pos, road_direction):
-        """
-        Checks if moving from current_pos to next_pos is valid based on the road_direction.
-        Allow diagonal movement only if there is movement in the allowed direction.
-        """
-        dx = next_pos[0] - current_pos[0]  # Change in x
-        dy = next_pos[1] - current_pos[1]  # Change in y
-
-        if road_direction == "Right":  # If the road is going right,
-            return dx != -1   # Moving left is not allowed, only horizontal movement
-        elif road_direction == "Left":  # If the road is going left,
-            return dx != 1   # Moving right is not allowed, only horizontal movement
-        elif road_direction == "Up":  # If the road is going up,
-            return dy != -1  # Moving down is not allowed, only vertical movement
-        elif road_direction == "Down":  # If the road is going down,
-            return dy != 1   # Moving up is not allowed, only vertical movement
-
-        return False  # If the road direction is invalid, return False
-
     def find_path(self, type):
         """
         Finds the path from spawn to destination.
+        type 0 plans from the spawn ignoring traffic, type 1 plans from the current position around other cars.
         """
         if self.destination: # If the destination is set,
             #print(f"Finding path for Car {self.unique_id} from {self.spawn} to {self.destination}")
-            def pathclear(current, next): # Function to check if the path is clear
-                cell_contents = self.model.grid.get_cell_list_contents([next]) # Get the contents of the next cell
-
-                # Check if the next cell contains an obstacle
-                if any(isinstance(agent, Obstacle) for agent in cell_contents):
-                    #print(f"Obstacle found at {next}")  # Debug
-                    return False
-                
-                 # Check if the next cell contains an obstacle
-                if any(isinstance(agent, Car) for agent in cell_contents) and type == 1:
-                    #print(f"Obstacle found at {next}")  # Debug
-                    return False
-
-                # Check if the next cell is a road, traffic light, or destination
-                if any(isinstance(agent, (Road, Traffic_Light, Destination)) for agent in cell_contents):
-                    # If it's a road, check the direction
-                    roads = [agent for agent in cell_contents if isinstance(agent, Road)]
-                    if roads: # If there is a road in the cell
-                        road = roads[0]  # Get the first road
-                        return self.is_direction_valid(current, next, road.direction) # Check if the direction is valid
-                    return True  # If it's a traffic light or destination, movement is allowed
-                return False  # Cell without road, traffic light, or destination is not valid
-            if type == 0:
-                return a_star_search(self.model.grid, self.spawn, self.destination, pathclear) # Find the path
-            elif type == 1:
-                return a_star_search(self.model.grid, self.pos, self.destination, pathclear) # Find the path
+            if type == 0 and self.model.routing == "table": # Follow the shared table of the destination
+                return self.model.routing_tables.get(self.destination)
+            if type == 0 and self.model.routing == "contracted": # Search between intersections, the car expands the cells as it goes
+                return self.model.contracted_path(self.spawn, self.destination)
+            if type == 0 and self.model.routing == "congestion": # Avoid the busy cells and the red lights
+                return a_star_search(self.model.road_graph, self.spawn, self.destination, cost=self.model.congestion_cost, metrics=self.model.metrics.active())
+            if type == 0: # The static path only depends on the spawn and the destination
+                return self.model.shortest_path(self.model.route_cache, self.spawn, self.destination) # Find the path
+            elif type == 1 and self.model.reroute == "incremental": # Repair the last search around the cars
+                return self.replan()
+            elif type == 1 and self.model.routing == "congestion": # Go around the cars, preferring the less busy cells
+                return a_star_search(self.model.road_graph, self.pos, self.destination, self.model.has_car, self.model.congestion_cost, self.model.metrics.active())
+            elif type == 1: # Avoiding cars is only valid during the current step
+                return self.model.shortest_path(self.model.reroute_cache, self.pos, self.destination, self.model.has_car) # Find the path
         #print("No destination set for Car, no path to find")  # in case the destination is not reachable or not able to be set
         return None # If the destination is not set, return None
 
 
+    def replan(self):
+        """
+        Finds a path around the other cars reusing the car's previous search.
+        """
+        changed, self.planner_log_position = self.model.occupancy_changes(self.planner_log_position) # Cells that changed since the last search
+        if self.planner is None or changed is None or self.planner.goal != self.destination: # If there is nothing to reuse,
+            self.planner = self.model.new_planner(self.pos, self.destination) # Search from scratch
+        else:
+            self.planner.replan(self.pos, changed) # Repair only around the changed cells
+        return self.planner.path()
+
     def move(self):
         """ 
         Determines if the agent can move in the direction that was chosen
         """        
-        descuido = random.randint(0, 200) < self.greediness #descuido choque
+        descuido = self.careless or self.model.random.randint(0, 200) < self.greediness #descuido choque
+        self.careless = False
+        metrics = self.model.metrics.active() # Phase timers and counters, None when they are off
+        waiting = None # Cell or traffic light the car is waiting for
         if self.path and self.pos in self.path: # If the path is set and the current position is in the path,
             next_pos = self.path.get(self.pos) # Get the next position
-            if isinstance(self.model.grid[self.path.get(self.pos)[0]][self.path.get(self.pos)[1]], list): # Verifica si la celda contiene una lista
-                # Itera sobre los agentes en la lista
-                for agent_in_cell in self.model.grid[self.path.get(self.pos)[0]][self.path.get(self.pos)[1]]: # Verifica si el agente es un carro
-                    if type(agent_in_cell) == Car: # Verifica si el agente es un carro
-                        next_pos = self.pos # Se queda en la misma posición
-                    elif type(agent_in_cell) == Traffic_Light and descuido == False: # Verifica si el agente es un semáforo
-                        if agent_in_cell.state == False: # Verifica si el semáforo está en rojo
-                            next_pos = self.pos # Se queda en la misma posición
-                        else: # Si el semáforo está en verde
-                            next_pos = self.path.get(self.pos) # Get the next position
-                    else: # Si el agente no es un carro ni un semáforo
-                        next_pos = self.path.get(self.pos) # Get the next position
+            light = self.model.layers.light[next_pos] # Id of the traffic light in the next cell, -1 if there is none
+            if self.model.has_car(next_pos): # Verifica si hay un carro en la siguiente celda
+                waiting = next_pos
+                next_pos = self.pos # Se queda en la misma posición
+                if metrics is not None:
+                    metrics.count("blocked_by_car")
+            elif light >= 0 and descuido == False and self.model.traffic_lights[light].state == False: # Verifica si el semáforo está en rojo
+                waiting = self.model.traffic_lights[light]
+                next_pos = self.pos # Se queda en la misma posición
+                if metrics is not None:
+                    metrics.count("blocked_by_light")
+            if metrics is not None:
+                start = time.perf_counter()
             next_next_pos = self.path.get(next_pos) # Get the next next position
             if next_next_pos is not None and descuido == False: # If the next next position is not None,
-                road_direction_at_pos = "beg" # Initialize the road direction at the current position
-                road_direction_at_next_next_pos = "beg" # Initialize the road direction at the next next position
-                if isinstance(self.model.grid[self.pos[0]][self.pos[1]], list): # Verifica si la celda contiene una lista
-                    # Itera sobre los agentes en la lista
-                    for agent_in_cell in self.model.grid[self.pos[0]][self.pos[1]]: # Verifica si el agente es un carro
-                        if type(agent_in_cell) == Road:
-                            road_direction_at_pos = agent_in_cell.direction # Get the road direction at the current position
-                if isinstance(self.model.grid[next_next_pos[0]][next_next_pos[1]], list): # Verifica si la celda contiene una lista
-                    # Itera sobre los agentes en la lista
-                    for agent_in_cell in self.model.grid[next_next_pos[0]][next_next_pos[1]]:
-                        if type(agent_in_cell) == Road: 
-                            road_direction_at_next_next_pos = agent_in_cell.direction # Get the road direction at the next next position
-                        if type(agent_in_cell) == Car:
-                            road_direction_at_pos = "no" # Get the road direction at the current position
+                road_direction_at_pos = self.model.road_graph.direction(self.pos, "beg") # Get the road direction at the current position
+                road_direction_at_next_next_pos = self.model.road_graph.direction(next_next_pos, "beg") # Get the road direction at the next next position
+                if self.model.has_car(next_next_pos): # If there is a car at the next next position,
+                    road_direction_at_pos = "no" # Don't change lanes into it
                 if self.needs_lane_change(self.pos, next_next_pos, road_direction_at_pos, road_direction_at_next_next_pos):
                     #print(f"Car {self.unique_id} is changing lanes from {self.pos} to {next_next_pos}")
                     next_pos = next_next_pos # Change the next position to the next next position
+                    if metrics is not None:
+                        metrics.count("lane_changes")
+            if metrics is not None:
+                metrics.since("lane_change_checks", start)
             """
             if isinstance(self.model.grid[self.path.get(self.pos)[0]][self.path.get(self.pos)[1]], list):
                 # Itera sobre los agentes en la lista
@@ -183,20 +179,31 @@ class Car(Agent):
             if self.pos == next_pos: # If the next position is the same as the current position,
                 self.cont_stay = self.cont_stay + 1 # Increment the counter
             if self.cont_stay > 2: # If the counter is greater than 2,
+                if metrics is not None:
+                    metrics.count("reroutes")
+                    start = time.perf_counter()
                 path = self.path # Save the path
                 self.initialize_path(1) # Initialize the path
-                if self.path == {}: # If the path is empty,
+                if not self.path: # If the path is empty,
                     self.path = path # Restore the path
                 self.cont_stay = 0 # Reset the counter
+                waiting = None # The new path may go another way
+                if metrics is not None:
+                    metrics.since("reroutes", start)
             if next_pos is not None: # If the next position is not None,
-                self.model.grid.move_agent(self, next_pos) # Move the agent to the next position
+                self.model.move_car(self, next_pos) # Move the agent to the next position
                 self.direction = self.get_direction(self.pos, next_pos) # Get the direction the agent should face
                 if next_pos == self.destination: # If the destination is reached,
                     #print(f"Car {self.unique_id} reached destination {self.destination}") 
                     self.model.remove_car(self) # Remove the car from the model
                     self.model.car_removed = self.model.car_removed + 1 # Increment the number of cars removed
+                    self.model.finish_trips([int(self.unique_id.split("_")[1])], [self.model.layers.destination[self.destination]], [self.model.step_count - self.spawn_step]) # Steps it took to get there
+                elif waiting is not None and next_pos == self.pos: # If the car is stopped,
+                    self.model.wait(self, waiting) # Let it sleep until what it waits for changes
             else: # If the next position is None,
                 print("No valid next position found.") 
+                if metrics is not None:
+                    metrics.count("no_next_position")
 
     def needs_lane_change(self,current_pos, next_next_pos, road_direction_at_pos, road_direction_at_next_next_pos):
         """
@@ -278,7 +285,13 @@ class Traffic_Light(Agent):
         To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
         """
         if self.model.schedule.steps % self.timeToChange == 0: # If the number of steps is a multiple of the time to change,
-            self.state = not self.state # Change the state of the traffic light
+            self.toggle()
+
+    def toggle(self):
+        """
+        Changes the traffic light from green to red or from red to green.
+        """
+        self.state = not self.state # Change the state of the traffic light
 
 class Destination(Agent):
     """
@@ -1,30 +1,77 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from model import CityModel
-from agent import Car, Obstacle, Traffic_Light, Destination, Road
+from mapcompiler import CACHE_DIR
+from snapshot import restore_snapshot, map_checksum
+from frames import FrameHistory
+from layers import ROAD, OBSTACLE, TRAFFIC_LIGHT, DESTINATION
+import gzip
+import hashlib
+import json
 
 # Size of the board:
 number_agents = 5
 cityModel = None
-currentStep = 0
+frameHistory = None # Recent steps of the model, for the deltas of /frame
+warmSnapshots = {} # Snapshot of a model after each number of warm-up steps, run once and forked at every /init
+mapKey = None # Map of the current model, its file and the checksum of its layout
+staticPayloads = {} # JSON body, gzipped body and ETag of each kind of static cell of each map, shared by every model on it
     
 app = Flask("Traffic example")
 
+def staticPositions(kind):
+    """
+    Positions of the cells of one kind of the map, with the ids their agents would have.
+    """
+    return [{"id": unique_id, "x": x, "y": 0, "z": z} for unique_id, (x, z) in cityModel.static_cells(kind)]
+
+def staticResponse(kind):
+    """
+    Response with the positions of the cells of one kind. The body is serialized and compressed once per map,
+    gzipped if the client accepts it, and a request with the same ETag in If-None-Match gets an empty 304.
+    """
+    key = (mapKey, kind)
+    if key not in staticPayloads:
+        body = json.dumps({"positions": staticPositions(kind)}, separators=(",", ":")).encode()
+        staticPayloads[key] = (body, gzip.compress(body, mtime=0), hashlib.sha1(body).hexdigest())
+    body, compressed, etag = staticPayloads[key]
+    response = Response(body, mimetype="application/json")
+    if request.accept_encodings.best_match(["gzip", "identity"]) == "gzip": # Not when the client refuses it with q=0
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = "gzip"
+        etag += "-gzip" # Another representation, so another ETag
+    response.headers["Vary"] = "Accept-Encoding" # Both representations, the body depends on the header
+    response.headers["Cache-Control"] = "no-cache" # Cached, but checked with the ETag, /init may load another map
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
 @app.route('/init', methods=['POST'])
 def initModel():
-    global currentStep, cityModel, number_agents
-    cityModel = CityModel(number_agents)
-    return jsonify({"message":"Parameters recieved, model initiated."})
+    """
+    Creates the model. An optional JSON body {"warmup": steps} starts it from the state after that many steps,
+    which are only run by the first /init that asks for them.
+    """
+    global cityModel, frameHistory, mapKey, number_agents
+    options = request.get_json(silent=True) or {}
+    warmup = int(options.get("warmup", 0))
+    if warmup > 0:
+        if warmup not in warmSnapshots:
+            model = CityModel(number_agents, static_agents = False, map_cache = CACHE_DIR)
+            for step in range(warmup):
+                model.step()
+            warmSnapshots[warmup] = model.snapshot()
+        cityModel = restore_snapshot(warmSnapshots[warmup])
+    else:
+        cityModel = CityModel(number_agents, static_agents = False, map_cache = CACHE_DIR)
+    mapKey = (cityModel.options["map_file"], map_checksum(cityModel.layers))
+    frameHistory = FrameHistory(cityModel) # Records from the first /frame, clients of /update alone don't need it
+    return jsonify({"message":"Parameters recieved, model initiated.", "session": frameHistory.session, "currentStep": cityModel.step_count})
 
 @app.route('/getAgents', methods=['GET'])
 def getAgents():
     global cityModel
 
     if request.method == 'GET':
-        carPositions = [{"id": str(car.unique_id), "x": x, "y": 0, "z": z}
-                for x in range(cityModel.grid.width)
-                for z in range(cityModel.grid.height)
-                for car in cityModel.grid.get_cell_list_contents((x, z))
-                if isinstance(car, Car)]
+        carPositions = [{"id": unique_id, "x": x, "y": 0, "z": z} for unique_id, (x, z) in cityModel.car_positions()]
 
         return jsonify({'positions':carPositions})
     
@@ -33,25 +80,15 @@ def getObstacles():
     global cityModel
 
     if request.method == 'GET':
-        obstaclePositions = [{"id": str(obstacle.unique_id), "x": x, "y": 0, "z": z}
-                for x in range(cityModel.grid.width)
-                for z in range(cityModel.grid.height)
-                for obstacle in cityModel.grid.get_cell_list_contents((x, z))
-                if isinstance(obstacle, Obstacle)]
-
-
-        return jsonify({'positions':obstaclePositions})
+        return staticResponse(OBSTACLE)
     
 @app.route('/getTrafficLights', methods=['GET'])
 def getTrafficLights():
     global cityModel
 
     if request.method == 'GET':
-        trafficLightPositions = [{"id": str(trafficLight.unique_id), "x": x, "y":0, "z":z, "state":trafficLight.state}
-                                 for x in range(cityModel.grid.width)
-                                 for z in range(cityModel.grid.height)
-                                 for trafficLight in cityModel.grid.get_cell_list_contents((x, z))
-                                 if isinstance(trafficLight, Traffic_Light)]
+        trafficLightPositions = [{"id": unique_id, "x": x, "y":0, "z":z, "state":cityModel.traffic_lights[cityModel.layers.light[x, z]].state}
+                                 for unique_id, (x, z) in cityModel.static_cells(TRAFFIC_LIGHT)]
         
         return jsonify({'positions':trafficLightPositions})
 
@@ -60,36 +97,67 @@ def getDestinations():
     global cityModel
 
     if request.method == 'GET':
-        destinationPositions = [{"id": str(destination.unique_id), "x": x, "y":0, "z":z}
-                                for x in range(cityModel.grid.width)
-                                for z in range(cityModel.grid.height)
-                                for destination in cityModel.grid.get_cell_list_contents((x, z))
-                                if isinstance(destination, Destination)]
-
-        return jsonify({'positions':destinationPositions})
+        return staticResponse(DESTINATION)
     
 @app.route('/getRoads', methods=['GET'])
 def getRoads():
     global cityModel
 
     if request.method == 'GET':
-        roadPositions = [{"id": str(road.unique_id), "x": x, "y":0, "z":z}
-                         for x in range(cityModel.grid.width)
-                         for z in range(cityModel.grid.height)
-                         for road in cityModel.grid.get_cell_list_contents((x, z))
-                         if isinstance(road, Road)]
-
-        return jsonify({'positions':roadPositions})
+        return staticResponse(ROAD)
     
+@app.route('/metrics', methods=['GET', 'POST'])
+def metrics():
+    """
+    GET returns the phase timers and counters of the model.
+    POST changes them with a JSON body: {"enabled": bool, "reset": bool, "profile": steps, "profiler": "cprofile" or "sampling"}
+    """
+    global cityModel
+    if cityModel is None:
+        return jsonify({'error': 'Model not initialized, call /init.'}), 400
+    if request.method == 'POST':
+        options = request.get_json(silent=True) or {}
+        if options.get("reset"):
+            cityModel.metrics.reset()
+        if options.get("enabled") is True:
+            cityModel.metrics.enable()
+        elif options.get("enabled") is False:
+            cityModel.metrics.disable()
+        if options.get("profile"):
+            try:
+                cityModel.metrics.profile(int(options["profile"]), options.get("profiler", "cprofile"))
+            except ValueError as error:
+                return jsonify({'error': str(error)}), 400
+    return jsonify(cityModel.metrics_report())
+
 @app.route('/update', methods=['GET'])
 def updateModel():
-    global currentStep, cityModel
+    global cityModel
     if request.method == 'GET':
         if cityModel is None:
             return jsonify({'error': 'Model not initialized, call /init.'}), 400
         cityModel.step()
-        currentStep += 1
-        return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
+        frameHistory.record()
+        return jsonify({'message':f'Model updated to step {cityModel.step_count}.', 'currentStep':cityModel.step_count}) # The step /frame reports too
+
+@app.route('/frame', methods=['GET'])
+def frame():
+    """
+    Steps the model and returns what changed since the step the client acknowledges, in one request.
+    Query parameters: session and ack, the session and last step of the frame the client has (a keyframe with
+    everything is sent without them, when the step is too old or when the model was initialized again since),
+    and steps, how many steps to advance first (1 by default, 0 to only fetch, at most one less than the steps the history keeps).
+    """
+    global cityModel
+    if cityModel is None:
+        return jsonify({'error': 'Model not initialized, call /init.'}), 400
+    ack = request.args.get('ack', type=int)
+    steps = min(max(request.args.get('steps', 1, type=int), 0), frameHistory.keep - 1) # The acknowledged step is still kept after them
+    frameHistory.start()
+    for step in range(steps):
+        cityModel.step()
+        frameHistory.record()
+    return jsonify(frameHistory.delta(ack, request.args.get('session')))
 
 
 if __name__=='__main__':